@@ -0,0 +1,47 @@
+# python
+import sys
+import time
+
+# project
+from benchmarks.unfriend import build_network
+from src.neighborhood_builder import STRATEGIES, choose_strategy, estimate_costs, intern_friends
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+# Compares the strategies to compute the Dth degree network of every user
+# (see src.neighborhood_builder): a search from every user (bfs) versus
+# the networks built level by level from the friends' networks (bitset,
+# matrix). Prints the measured and estimated time of each strategy, and
+# the strategy that 'auto' picks. The networks must be the same.
+#
+# Usage (from the top directory):
+#   python -m benchmarks.builder [users] [relationships] [D]
+
+def main(Nusers=2000, Nrelationships=10000, D=2):
+	network = build_network(Nusers, Nrelationships, D)
+	costs = estimate_costs(intern_friends(network.friends)[1], D)
+
+	print 'Network of %d users and %d relationships (D=%d)' \
+			%(network.get_number_users(), Nrelationships, D)
+
+	expected = None
+	for builder in STRATEGIES[1:]:
+		if builder not in costs:
+			print '%-8s too many users' % builder
+			continue
+		network.builder = builder
+		t0 = time.time()
+		network.update_network()
+		t = time.time() - t0
+
+		if expected is None:
+			expected = network.network
+		assert network.network == expected
+		print '%-8s %8.3f seconds (estimated %.3f)' %(builder, t, costs[builder])
+
+	print 'auto:    %s' % choose_strategy(network.friends, D)
+
+
+if __name__ == '__main__':
+	main(*[int(arg) for arg in sys.argv[1:]])
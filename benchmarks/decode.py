@@ -0,0 +1,80 @@
+# python 
+import json
+import random
+import sys
+import tempfile
+import time
+
+# project 
+from src.event_reader import DECODERS, read_lines
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+# Measures the events/second of reading and decoding an event log with
+# each available decoder, and of the original readline() + json.loads().
+#
+# Usage (from the top directory):
+#   python -m benchmarks.decode [log file]
+# Without a log file, 200,000 synthetic events are decoded.
+
+def write_events(f, Nevents, seed=0):
+	''' Writes synthetic batch/stream events to a file '''
+	generator = random.Random(seed)
+	for i in range(Nevents):
+		timestamp = '2017-06-13 11:%02d:%02d' %(i/60 % 60, i % 60)
+		if generator.random() < 0.7:
+			f.write('{"event_type":"purchase", "timestamp":"%s", "id": "%d", "amount": "%.2f"}\n' \
+						%(timestamp, generator.randrange(10000), generator.uniform(1, 100)))
+		else:
+			f.write('{"event_type":"befriend", "timestamp":"%s", "id1": "%d", "id2": "%d"}\n' \
+						%(timestamp, generator.randrange(10000), generator.randrange(10000)))
+
+
+def readline_json(f):
+	''' The original loop: one readline() and json.loads() per event '''
+	N = 0
+	while True:
+		line = f.readline().strip()
+		if not line:
+			break
+		json.loads(line)
+		N += 1
+	return N
+
+
+def read_decode(f, decode):
+	''' Bulk line reading with the given decoder '''
+	N = 0
+	for line in read_lines(f):
+		line = line.strip()
+		if line:
+			decode(line)
+			N += 1
+	return N
+
+
+def measure(filename, function, *args):
+	''' Returns the events/second of a reading function '''
+	f = open(filename)
+	t0 = time.time()
+	N = function(f, *args)
+	t = time.time() - t0
+	f.close()
+	return N/t
+
+
+def main(filename=None):
+	if filename is None:
+		f = tempfile.NamedTemporaryFile(suffix='.json')
+		write_events(f, 200000)
+		f.flush()
+		filename = f.name
+
+	print 'readline + json:      %10.0f events/second' % measure(filename, readline_json)
+	for name in sorted(DECODERS):
+		print 'read_lines + %-8s: %10.0f events/second' %(name, measure(filename, read_decode, DECODERS[name]))
+
+
+if __name__ == '__main__':
+	main(*sys.argv[1:])
@@ -0,0 +1,92 @@
+# python 
+import sys
+import time
+
+# project 
+from src.anomaly_detection import AnomalyDetection
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+# Measures the per-event overhead of dispatching events to their handlers:
+# the original if/elif chain on the event type and data type, against the
+# handler tables of AnomalyDetection, whose batch handlers are bound
+# directly to the network and purchase history. The network and purchase history are
+# replaced by objects that do nothing, so only the dispatch is measured.
+#
+# Usage (from the top directory):
+#   python -m benchmarks.dispatch [number of events]
+
+class NullState:
+	''' Network and purchase history that ignore the events '''
+	def add_purchase(self, event):
+		pass
+
+	def add_friend(self, event, update_needed=False):
+		pass
+
+	def remove_friend(self, event, update_needed=False):
+		pass
+
+
+def if_chain_dispatch(session, event, data_type):
+	''' The original dispatch of AnomalyDetection.process_event '''
+	if event['event_type'] == 'purchase':
+		if data_type == 'stream':
+			session.Nstream += 1
+			session.check_for_anomaly(event)
+		session.purchases.add_purchase(event)
+
+	elif event['event_type'] == 'befriend':
+		if data_type == 'stream':
+			session.Nstream += 1
+			session.network.add_friend(event, update_needed=True)
+		else:
+			session.network.add_friend(event)
+
+	elif event['event_type'] == 'unfriend':
+		if data_type == 'stream':
+			session.Nstream += 1
+			session.network.remove_friend(event, update_needed=True)
+		else:
+			session.network.remove_friend(event)
+
+
+def measure_if_chain(session, events, data_type):
+	''' Returns the nanoseconds/event of the if/elif chain '''
+	t0 = time.time()
+	for event in events:
+		if_chain_dispatch(session, event, data_type)
+	return 1e9*(time.time()-t0)/len(events)
+
+
+def measure_table(session, events, data_type):
+	''' Returns the nanoseconds/event of the handler table, looked up
+		once for all the events as in AnomalyDetection.process_events '''
+	handlers = session.handlers[data_type]
+	t0 = time.time()
+	for event in events:
+		handler = handlers.get(event['event_type'])
+		if handler:
+			handler(event)
+	return 1e9*(time.time()-t0)/len(events)
+
+
+def main(Nevents=300000):
+	Nevents = int(Nevents)
+	session = AnomalyDetection(None, None, None, verbose=False)
+	session.network = session.purchases = NullState()
+	session.check_for_anomaly = lambda event: None
+	session.specialize_handlers()
+
+	# unfriend events are the last branch of the chain
+	for event_type in ('purchase', 'befriend', 'unfriend'):
+		events = [{'event_type': event_type}]*Nevents
+		for data_type in ('batch', 'stream'):
+			print '%-8s %-6s: if/elif %6.0f ns/event, table %6.0f ns/event' \
+					%(event_type, data_type, measure_if_chain(session, events, data_type), 
+						measure_table(session, events, data_type))
+
+
+if __name__ == '__main__':
+	main(*sys.argv[1:])
@@ -0,0 +1,144 @@
+# python
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# project
+from benchmarks.workload import add_workload_arguments, generate_workload, get_workload_options
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+# Measures how the detection scales with the number of users. For each
+# scale, a synthetic workload (see benchmarks.workload) is generated and
+# processed in a separate process, which measures:
+#   - the time to load the batch log,
+#   - the stream events/second,
+#   - the p50/p99 latency of the stream events,
+#   - the peak resident memory of the process.
+# The results are printed and written as JSON.
+#
+# Usage (from the top directory):
+#   python -m benchmarks.scaling [--scales 1000,10000] [--output results.json]
+#                                [--option compact_network=true ...]
+# See --help for the parameters of the workload. The options are passed to
+# AnomalyDetection, with JSON values.
+
+
+def measure(batch_file, stream_file, options):
+	''' Processes a workload in this process and returns its measurements '''
+	# imported here so that the suite itself does not load the project
+	from src.anomaly_detection import AnomalyDetection
+
+	directory = tempfile.mkdtemp()
+	try:
+		session = AnomalyDetection(batch_file, stream_file,
+									os.path.join(directory, 'flagged_purchases.json'),
+									verbose=False, **options)
+		t0 = time.time()
+		session.analyze_batch_data()
+		batch_time = time.time() - t0
+
+		lines = [line.strip() for line in open(stream_file) if line.strip()]
+		latencies = []
+		t0 = time.time()
+		for line in lines:
+			t1 = time.time()
+			session.process_event(session.decode(line), 'stream')
+			latencies.append(time.time() - t1)
+		stream_time = time.time() - t0
+		session.close()
+	finally:
+		shutil.rmtree(directory)
+
+	p50, p99 = np.percentile(latencies, [50, 99]) if latencies else (0, 0)
+	return {'batch_load_seconds': batch_time,
+			'stream_events': len(lines),
+			'stream_events_per_second': len(lines)/stream_time if stream_time else 0,
+			'latency_p50_ms': 1000*p50,
+			'latency_p99_ms': 1000*p99,
+			# kilobytes on linux, bytes on mac
+			'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / \
+							(1024.0**2 if sys.platform == 'darwin' else 1024.0)}
+
+
+def run_scale(Nusers, args):
+	''' Generates the workload of a scale and measures it in a subprocess '''
+	directory = tempfile.mkdtemp()
+	try:
+		batch_file, stream_file = generate_workload(directory, Nusers,
+								int(args.batch_events_per_user*Nusers),
+								int(args.stream_events_per_user*Nusers),
+								args.D, args.T, **get_workload_options(args))
+		command = [sys.executable, '-m', 'benchmarks.scaling', '--measure', batch_file, stream_file]
+		for option in args.option:
+			command += ['--option', option]
+		output = subprocess.check_output(command)
+	finally:
+		shutil.rmtree(directory)
+
+	result = json.loads(output)
+	result['users'] = Nusers
+	return result
+
+
+def parse_options(options):
+	''' Returns the AnomalyDetection options given as KEY=VALUE '''
+	parsed = {}
+	for option in options:
+		key, value = option.split('=', 1)
+		try:
+			parsed[key] = json.loads(value)
+		except ValueError:
+			parsed[key] = value
+	return parsed
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--scales', default='1000,10000',
+						help='comma-separated numbers of users')
+	parser.add_argument('--batch-events-per-user', type=float, default=5)
+	parser.add_argument('--stream-events-per-user', type=float, default=0.5)
+	parser.add_argument('--output', default='benchmark_results.json',
+						help='file that the results are written to')
+	parser.add_argument('--option', action='append', default=[], metavar='KEY=VALUE',
+						help='AnomalyDetection option, e.g. compact_network=true')
+	parser.add_argument('--measure', nargs=2, metavar=('BATCH', 'STREAM'),
+						help=argparse.SUPPRESS)
+	add_workload_arguments(parser)
+	args = parser.parse_args()
+
+	# measure a single workload in this process
+	if args.measure:
+		print json.dumps(measure(args.measure[0], args.measure[1], parse_options(args.option)))
+		return
+
+	results = {'parameters': vars(args), 'python': platform.python_version(),
+				'platform': platform.platform(), 'results': []}
+	print '%8s %12s %14s %10s %10s %10s' %('users', 'batch (s)', 'events/second', 'p50 (ms)',
+												'p99 (ms)', 'RSS (MB)')
+	for Nusers in [int(scale) for scale in args.scales.split(',')]:
+		result = run_scale(Nusers, args)
+		results['results'].append(result)
+		print '%8d %12.3f %14.1f %10.3f %10.3f %10.1f' %(Nusers, result['batch_load_seconds'],
+						result['stream_events_per_second'], result['latency_p50_ms'],
+						result['latency_p99_ms'], result['peak_rss_mb'])
+
+	f = open(args.output, 'w')
+	json.dump(results, f, indent=2, sort_keys=True)
+	f.close()
+	print 'Wrote %s' % args.output
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,83 @@
+# python 
+import copy
+import random
+import sys
+import time
+
+# project 
+from src.social_network import SocialNetwork
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+# Compares the decremental update of the Dth degree network for unfriend
+# events with recomputing the network of every user within D-1 of the 
+# two users. The relationships removed are between high degree users.
+#
+# Usage (from the top directory):
+#   python -m benchmarks.unfriend [users] [relationships] [D]
+
+def build_network(Nusers, Nrelationships, D, seed=0):
+	''' Builds a network where a few hub users have most relationships '''
+	generator = random.Random(seed)
+	Nhubs = max(1, Nusers/100)
+	network = SocialNetwork(D)
+	for i in range(Nrelationships):
+		# half of the relationships involve a hub 
+		if generator.random() < 0.5:
+			id1 = generator.randrange(Nhubs)
+		else:
+			id1 = generator.randrange(Nusers)
+		id2 = generator.randrange(Nusers)
+		if id1 != id2:
+			network.add_friend({'id1': str(id1), 'id2': str(id2)})
+	network.update_network()
+	return network
+
+
+def recompute_unfriend(network, event):
+	''' The original update: recompute the network of every user 
+		within D-1 of the two users '''
+	id1 = event['id1']
+	id2 = event['id2']
+	users = network.get_user_list(id1, network.D-1)
+	users.update(network.get_user_list(id2, network.D-1))
+	users.update([id1, id2])
+	network.remove_friend(event)
+	network.update_network(users)
+
+
+def main(Nusers=5000, Nrelationships=20000, D=2):
+	network = build_network(Nusers, Nrelationships, D)
+
+	# the relationships removed with the largest combined degree 
+	pairs = set()
+	for id1 in network.friends:
+		for id2 in network.friends[id1]:
+			pairs.add((min(id1, id2), max(id1, id2)))
+	degree = lambda pair: len(network.friends[pair[0]]) + len(network.friends[pair[1]])
+	events = [{'id1': id1, 'id2': id2} for id1, id2 in sorted(pairs, key=degree)[-20:]]
+
+	print 'Network of %d users (D=%d); removing %d relationships between high degree users' \
+			%(network.get_number_users(), D, len(events))
+
+	recomputed = copy.deepcopy(network)
+	t0 = time.time()
+	for event in events:
+		recompute_unfriend(recomputed, event)
+	t_recompute = time.time() - t0
+
+	t0 = time.time()
+	for event in events:
+		network.remove_friend(event, update_needed=True)
+	t_decremental = time.time() - t0
+
+	assert network.network == recomputed.network
+
+	print 'Recompute neighborhoods: %.4f seconds/event' %(t_recompute/len(events))
+	print 'Decremental update:      %.4f seconds/event' %(t_decremental/len(events))
+	print 'Speedup: %.1fx' %(t_recompute/t_decremental)
+
+
+if __name__ == '__main__':
+	main(*[int(arg) for arg in sys.argv[1:]])
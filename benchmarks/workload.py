@@ -0,0 +1,186 @@
+# python
+import argparse
+import bisect
+import json
+import os
+import random
+import time
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+# Deterministic generator of synthetic batch and stream logs. The same
+# parameters and seed always give the same logs.
+#
+# Usage (from the top directory):
+#   python -m benchmarks.workload DIRECTORY [--users N] [--degree powerlaw] ...
+# See --help for the parameters.
+
+# timestamp of the first event (2017-06-13 11:33:01 UTC)
+START_TIME = 1497353581
+
+
+class WorkloadGenerator:
+	''' Generates the events of a synthetic workload.
+
+		Users are picked uniformly, or with a power-law distribution of
+		exponent alpha over the user ids, so that a few hub users have most
+		of the relationships and purchases. Each event is a purchase with
+		probability purchase_rate; the other events are unfriend events
+		(of an existing relationship) with probability unfriend_rate, and
+		befriend events otherwise. Purchase amounts are normal, with a
+		fraction of outliers. '''
+
+	def __init__(self, Nusers, degree='uniform', alpha=1.0, purchase_rate=0.6,
+					unfriend_rate=0.1, outlier_rate=0.01, events_per_second=10, seed=0):
+		if degree not in ('uniform', 'powerlaw'):
+			raise ValueError('Unknown degree distribution: %s' % degree)
+
+		self.Nusers = Nusers
+		self.degree = degree
+		self.purchase_rate = purchase_rate
+		self.unfriend_rate = unfriend_rate
+		self.outlier_rate = outlier_rate
+		self.events_per_second = events_per_second
+		self.generator = random.Random(seed)
+
+		# cumulative weights of the users for the power-law distribution
+		if degree == 'powerlaw':
+			self.weights = []
+			total = 0.0
+			for rank in range(Nusers):
+				total += (rank + 1)**-alpha
+				self.weights.append(total)
+
+		# the existing relationships, for unfriend events
+		# data structure of relationships: [(id1, id2), ...] with positions { (id1, id2): i, ...}
+		self.relationships = []
+		self.positions = {}
+
+		# number of events generated
+		self.Nevents = 0
+
+
+	def pick_user(self):
+		''' Returns a random user id '''
+		if self.degree == 'powerlaw':
+			x = self.generator.random()*self.weights[-1]
+			return bisect.bisect_left(self.weights, x)
+		return self.generator.randrange(self.Nusers)
+
+
+	def get_timestamp(self):
+		''' Returns the timestamp of the next event '''
+		return time.strftime('%Y-%m-%d %H:%M:%S',
+							time.gmtime(START_TIME + self.Nevents/self.events_per_second))
+
+
+	def next_event(self):
+		''' Returns the next event '''
+		generator = self.generator
+		timestamp = self.get_timestamp()
+		self.Nevents += 1
+
+		if generator.random() < self.purchase_rate:
+			amount = generator.gauss(50, 15)
+			if generator.random() < self.outlier_rate:
+				amount = generator.uniform(200, 2000)
+			return {'event_type': 'purchase', 'timestamp': timestamp,
+					'id': str(self.pick_user()), 'amount': '%.2f' % abs(amount)}
+
+		if self.relationships and generator.random() < self.unfriend_rate:
+			id1, id2 = self.remove_relationship(generator.randrange(len(self.relationships)))
+			return {'event_type': 'unfriend', 'timestamp': timestamp,
+					'id1': str(id1), 'id2': str(id2)}
+
+		# relationships are between a user of the degree distribution
+		# and a uniformly picked user
+		id1 = self.pick_user()
+		id2 = generator.randrange(self.Nusers)
+		if id1 == id2:
+			id2 = (id2 + 1) % self.Nusers
+		self.add_relationship(id1, id2)
+		return {'event_type': 'befriend', 'timestamp': timestamp,
+				'id1': str(id1), 'id2': str(id2)}
+
+
+	def add_relationship(self, id1, id2):
+		''' Records a relationship so that it can be removed later '''
+		pair = (min(id1, id2), max(id1, id2))
+		if pair not in self.positions:
+			self.positions[pair] = len(self.relationships)
+			self.relationships.append(pair)
+
+
+	def remove_relationship(self, i):
+		''' Removes the i-th relationship in O(1) and returns it '''
+		pair = self.relationships[i]
+		last = self.relationships.pop()
+		if last != pair:
+			self.relationships[i] = last
+			self.positions[last] = i
+		del self.positions[pair]
+		return pair
+
+
+def generate_workload(directory, Nusers, Nbatch, Nstream, D=2, T=50, **options):
+	''' Writes batch_log.json and stream_log.json of a synthetic workload
+		to a directory and returns their filenames; the options are those
+		of WorkloadGenerator '''
+	workload = WorkloadGenerator(Nusers, **options)
+	batch_file = os.path.join(directory, 'batch_log.json')
+	stream_file = os.path.join(directory, 'stream_log.json')
+
+	f = open(batch_file, 'w')
+	f.write(json.dumps({'D': str(D), 'T': str(T)}) + '\n')
+	for i in xrange(Nbatch):
+		f.write(json.dumps(workload.next_event()) + '\n')
+	f.close()
+
+	f = open(stream_file, 'w')
+	for i in xrange(Nstream):
+		f.write(json.dumps(workload.next_event()) + '\n')
+	f.close()
+	return batch_file, stream_file
+
+
+def add_workload_arguments(parser):
+	''' Adds the parameters of a workload to an argument parser '''
+	parser.add_argument('--degree', choices=['uniform', 'powerlaw'], default='powerlaw',
+						help='distribution of the users of the events')
+	parser.add_argument('--alpha', type=float, default=1.0,
+						help='exponent of the power-law distribution')
+	parser.add_argument('--purchase-rate', type=float, default=0.6,
+						help='fraction of the events that are purchases')
+	parser.add_argument('--unfriend-rate', type=float, default=0.1,
+						help='fraction of the relationship events that are unfriend events')
+	parser.add_argument('--D', type=int, default=2, help='degree of the social networks')
+	parser.add_argument('--T', type=int, default=50, help='number of tracked purchases')
+	parser.add_argument('--seed', type=int, default=0)
+
+
+def get_workload_options(args):
+	''' Returns the WorkloadGenerator options of parsed arguments '''
+	return {'degree': args.degree, 'alpha': args.alpha, 'purchase_rate': args.purchase_rate,
+			'unfriend_rate': args.unfriend_rate, 'seed': args.seed}
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('directory')
+	parser.add_argument('--users', type=int, default=10000)
+	parser.add_argument('--batch-events', type=int, default=50000)
+	parser.add_argument('--stream-events', type=int, default=10000)
+	add_workload_arguments(parser)
+	args = parser.parse_args()
+
+	if not os.path.isdir(args.directory):
+		os.makedirs(args.directory)
+	for filename in generate_workload(args.directory, args.users, args.batch_events,
+										args.stream_events, args.D, args.T,
+										**get_workload_options(args)):
+		print 'Wrote %s' % filename
+
+
+if __name__ == '__main__':
+	main()
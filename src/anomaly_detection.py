@@ -1,10 +1,25 @@
 # python 
 import json
+import numpy as np
 import time
+from collections import deque
 
 # project 
+from batch_loader import load_batch
+from columnar_history import ColumnarPurchaseHistory
+from compact_network import CompactSocialNetwork
+from component_index import ComponentIndex
+from compressed_io import get_compression, open_log
+from event_reader import BLOCK_SIZE, get_decoder, read_lines
+from flagged_writer import FlaggedWriter
+from instrumentation import Instrumentation
+from pipeline import Pipeline
 from purchase_history import PurchaseHistory
+from sharding import ShardedDetection
+from slow_log import SlowEventLog
+from snapshot import is_snapshot, load_snapshot, save_snapshot
 from social_network import SocialNetwork
+from stream_follower import StreamFollower
 
 #-----------------------------------------------------------------------------------#
 #-----------------------------------------------------------------------------------#
@@ -14,12 +29,97 @@ class AnomalyDetection:
 		compares incoming stream data to determine if a user's 
 		purchase is anomalous within their Dth degree social network '''
 
-	def __init__(self, batch_file, stream_file, flagged_file):
+	def __init__(self, batch_file, stream_file, flagged_file, retention=None,
+					purchase_backend='dict', lazy_network=False, cache_size=100000,
+					compact_network=False, network_workers=1, network_builder='auto', verbose=True,
+					flush_interval=1.0, flush_size=65536, fsync='never', snapshot_file=None,
+					decoder='auto', block_size=BLOCK_SIZE, batch_workers=1, threaded_io=False,
+					pipeline=False, queue_depth=16, output_queue_depth=1024, shards=1,
+					component_index=True, instrument=False, slow_log_file=None, 
+					slow_threshold=0.01):
 		# set the filenames as data attributes 
 		self.batch_file = batch_file
 		self.stream_file = stream_file
 		self.flagged_file = flagged_file
 
+		# retention of the purchase history (see PurchaseHistory)
+		self.retention = retention
+
+		# the purchase history is either stored in a dict ('dict') 
+		# or in compact columns ('columnar')
+		if purchase_backend not in ('dict', 'columnar'):
+			raise ValueError('Unknown purchase backend: %s' % purchase_backend)
+		self.purchase_backend = purchase_backend
+
+		# compute the Dth degree networks on demand and keep 
+		# at most cache_size of them (see SocialNetwork)
+		self.lazy_network = lazy_network
+		self.cache_size = cache_size
+
+		# store the relationships with integer ids in compact 
+		# arrays (see CompactSocialNetwork)
+		self.compact_network = compact_network
+
+		# number of processes used to compute the network after
+		# the batch data is loaded
+		self.network_workers = network_workers
+
+		# strategy used to compute the network after the batch
+		# data is loaded (see SocialNetwork)
+		self.network_builder = network_builder
+
+		# print each anomalous purchase 
+		self.verbose = verbose
+
+		# the flagged purchases are buffered and written by a 
+		# FlaggedWriter, which is opened on the first anomaly
+		self.writer = None
+		self.flush_interval = flush_interval
+		self.flush_size = flush_size
+		self.fsync = fsync
+
+		# the state after the batch data is loaded is saved to the 
+		# snapshot file if one is given
+		self.snapshot_file = snapshot_file
+
+		# the events are read in blocks of block_size bytes and 
+		# decoded with the given decoder (see event_reader)
+		self.decode = get_decoder(decoder)
+		self.block_size = block_size
+
+		# number of processes used to parse the batch data 
+		self.batch_workers = batch_workers
+
+		# the batch/stream files can be compressed (gzip, bz2, xz); if 
+		# threaded_io, they are read and decompressed in a background thread
+		self.threaded_io = threaded_io
+
+		# if pipeline, the events are read and decoded, processed, and
+		# the flagged purchases written in separate stages (see Pipeline),
+		# with at most queue_depth chunks of decoded events and
+		# output_queue_depth flagged purchases queued between them
+		self.pipeline = pipeline
+		self.queue_depth = queue_depth
+		self.output_queue_depth = output_queue_depth
+		self.current_pipeline = None
+
+		# if shards > 1, the users are partitioned by connected component
+		# across that many worker processes (see ShardedDetection), which 
+		# keep the social network and purchase history in dicts
+		if shards > 1 and (purchase_backend != 'dict' or compact_network):
+			raise ValueError('Sharded detection requires the dict purchase history and social network')
+		# the shards load the events of the batch log, not a snapshot
+		if shards > 1 and is_snapshot(batch_file):
+			raise ValueError('Sharded detection requires a batch log, not a snapshot')
+		self.shards = shards
+		self.sharded = None
+
+		# if component_index, the connected components of the network and
+		# their number of purchases are indexed, so that purchases in 
+		# components with too few purchases are not checked (see ComponentIndex)
+		self.component_index = component_index
+		self.components = None
+
 		# the social network and purchase history are 
 		# also data attributes 
 		self.network = {}
@@ -28,22 +128,72 @@ class AnomalyDetection:
 		# keep track of the number of stream events processed 
 		self.Nstream = 0
 
-
-	def process(self):
-		''' method to load and process the data '''
+		# detection latency (seconds) of the most recent events in 
+		# follow mode, from when an event arrives until it is processed
+		self.latencies = deque(maxlen=10000)
+		self.follower = None
+
+		# functions called with each flagged purchase line, 
+		# in addition to writing it to the flagged file 
+		self.flagged_listeners = []
+
+		# functions called once the batch data is loaded, e.g. to 
+		# report the memory of the loaded social network
+		self.loaded_listeners = []
+
+		# handlers of the events for batch and stream data 
+		# data structure of handlers: { data_type: { event_type: handler, ...}, ...}
+		# Each event only pays for one lookup in the table of its data type.
+		self.handlers = {'batch': {}, 'stream': {}}
+		self.register_handler('purchase', self.add_batch_purchase, self.add_stream_purchase)
+		self.register_handler('befriend', self.add_batch_friend, self.add_stream_friend)
+		self.register_handler('unfriend', self.remove_batch_friend, self.remove_stream_friend)
+
+		# batch handlers bound to the current social network and purchase
+		# history in place of the defaults: { event_type: method, ...}
+		self.specialized_handlers = {}
+
+		# if instrument, the time spent in each stage, the work of the 
+		# queries and the latency of each event type are recorded (see 
+		# Instrumentation). The methods are only wrapped when instrumented.
+		self.instrumentation = None
+		if instrument or slow_log_file:
+			self.instrumentation = Instrumentation()
+			self.instrumentation.instrument_session(self)
+			self.instrumentation.instrument_handlers(self)
+
+		# stream events that take more than slow_threshold seconds are 
+		# written to the slow log file with the work they caused (see 
+		# SlowEventLog); the slow log needs the instrumentation
+		self.slow_log = None
+		if slow_log_file:
+			self.slow_log = SlowEventLog(self, slow_log_file, slow_threshold)
+			self.slow_log.instrument_handlers()
+
+
+	def process(self, follow=False, poll_interval=0.1, report_interval=10.0):
+		''' method to load and process the data. In follow mode, the
+			stream data is followed as it grows until interrupted. '''
 		# load the batch data
 		print 'Loading batch data...'
 		t0 = time.time()
 		self.analyze_batch_data()
 		print 'Batch data loaded (%s users and %d purchases) in %.4f seconds.'\
-				% (self.network.get_number_users(),
-					self.purchases.get_number_purchases(),
+				% (self.get_number_users(),
+					self.get_number_purchases(),
 					time.time()-t0)
 
 		# analyze the stream data
 		print '\nAnalyzing stream data...'
 		t0 = time.time()
-		self.analyze_stream_data()
+		if follow:
+			try:
+				self.follow_stream(poll_interval, report_interval)
+			except KeyboardInterrupt:
+				pass
+		else:
+			self.analyze_stream_data()
+		self.close()
 		t = time.time() - t0
 		print '\nAnalyzed %d stream events in %.4f seconds.' \
 				%(self.Nstream, t)
@@ -53,20 +203,52 @@ class AnomalyDetection:
 	def analyze_batch_data(self):
 		''' loads the batch data and creates network and 
 			purchases objects '''
-		f = open(self.batch_file)
-
-		# the first line contains the degree (D) and number of 
-		# tracked purchases (T). Initialize objects. 
-		params = json.loads(f.readline().strip())
-		self.initialize_objects(params)
-	
-		# process each subsequent event in the batch data
-		f = self.process_events(f, 'batch')
-		f.close()
+		# the users are loaded into the shards' processes 
+		if self.shards > 1:
+			self.sharded = ShardedDetection(self, self.shards)
+			self.sharded.load_batch()
+			return
+
+		# the batch file can also be a snapshot of the batch data
+		if is_snapshot(self.batch_file):
+			load_snapshot(self.batch_file, self)
+
+		# parse the batch data in parallel if needed; compressed 
+		# batch data cannot be split and is read serially 
+		elif self.batch_workers > 1 and not get_compression(self.batch_file):
+			load_batch(self, self.batch_workers)
+
+		else:
+			f = open_log(self.batch_file, self.threaded_io, self.block_size)
 
-		# once all the users are loaded to the social 
-		# network, generate the Dth degree network		
-		self.network.update_network()
+			# the first line contains the degree (D) and number of 
+			# tracked purchases (T). Initialize objects. 
+			params = json.loads(f.readline().strip())
+			self.initialize_objects(params)
+		
+			# process each subsequent event in the batch data
+			f = self.process_events(f, 'batch')
+			f.close()
+
+			# once all the users are loaded to the social 
+			# network, generate the Dth degree network		
+			self.network.update_network()
+
+		self.build_component_index()
+
+		if self.snapshot_file:
+			self.save_snapshot(self.snapshot_file)
+
+		for listener in self.loaded_listeners:
+			listener()
+
+
+	def build_component_index(self):
+		''' Builds the component index from the loaded social network
+			and purchase history; the stream events keep it up to date '''
+		if self.component_index:
+			self.components = ComponentIndex(self.network)
+			self.components.rebuild(self.purchases)
 
 
 	def process_events(self, f, data_type):
@@ -74,42 +256,100 @@ class AnomalyDetection:
 			comes from batch data, then update_needed should
 			be False, while it's True for stream data. '''
 
+		if self.sharded:
+			self.sharded.process_events(f, data_type)
+			return f
+
+		if self.pipeline:
+			self.current_pipeline = Pipeline(self, self.queue_depth, self.output_queue_depth)
+			try:
+				self.current_pipeline.run(f, data_type)
+			finally:
+				self.current_pipeline = None
+			return f
+
 		# process each event in the data stream 
-		while True:
-			line = f.readline().strip()
+		decode = self.decode
+		handlers = self.handlers[data_type]
+		for line in read_lines(f, self.block_size):
+			line = line.strip()
 			if line:
-				event = json.loads(line)
-
-				if event['event_type'] == 'purchase':
-					if data_type == 'stream':
-						self.Nstream += 1
-						self.check_for_anomaly(event)
-					# both stream and batch data add purchases 
-					# to the user's history 
-					self.purchases.add_purchase(event)
-
-				elif event['event_type'] == 'befriend':
-					if data_type == 'stream':
-						self.Nstream += 1
-						# stream data immediately updates the network
-						self.network.add_friend(event, update_needed=True)
-					else:
-						# batch data does not immediately
-						# update the network 
-						self.network.add_friend(event)
-
-				elif event['event_type'] == 'unfriend':
-					if data_type == 'stream':
-						self.Nstream += 1
-						self.network.remove_friend(event, update_needed=True)
-					else:
-						# batch data 
-						self.network.remove_friend(event)
-			else:
-				break
+				event = decode(line)
+				handler = handlers.get(event['event_type'])
+				if handler:
+					handler(event)
 		return f
 
 
+	def process_event(self, event, data_type):
+		''' Process a single event from the batch or stream data '''
+		if self.sharded:
+			self.sharded.process_event(event, data_type)
+			return
+
+		handler = self.handlers[data_type].get(event['event_type'])
+		if handler:
+			handler(event)
+
+
+	def register_handler(self, event_type, batch_handler=None, stream_handler=None):
+		''' Registers the functions that handle an event type in the batch
+			and stream data; each is called with the event. A handler of 
+			None removes the event type from the data type. '''
+		for data_type, handler in (('batch', batch_handler), ('stream', stream_handler)):
+			if handler:
+				self.handlers[data_type][event_type] = handler
+			else:
+				self.handlers[data_type].pop(event_type, None)
+
+
+	def add_batch_purchase(self, event):
+		''' batch data adds purchases to the user's history '''
+		self.purchases.add_purchase(event)
+
+
+	def add_stream_purchase(self, event):
+		''' stream data checks purchases for anomalies before adding 
+			them to the user's history '''
+		self.Nstream += 1
+		self.check_for_anomaly(event)
+		self.purchases.add_purchase(event)
+		if self.components and event.get('id'):
+			self.components.add_purchase(event['id'])
+
+
+	def add_batch_friend(self, event):
+		''' batch data does not immediately update the network '''
+		self.network.add_friend(event)
+
+
+	def add_stream_friend(self, event):
+		''' stream data immediately updates the network '''
+		self.Nstream += 1
+		self.network.add_friend(event, update_needed=True)
+		if self.components and event.get('id1') and event.get('id2'):
+			self.components.add_relationship(event['id1'], event['id2'])
+
+
+	def remove_batch_friend(self, event):
+		''' batch data does not immediately update the network '''
+		self.network.remove_friend(event)
+
+
+	def remove_stream_friend(self, event):
+		''' stream data immediately updates the network '''
+		self.Nstream += 1
+		self.network.remove_friend(event, update_needed=True)
+		if self.components:
+			self.components.remove_relationship(event.get('id1'), event.get('id2'))
+
+
+	def save_snapshot(self, filename):
+		''' Saves the social network and purchase history to a
+			snapshot, which can be given instead of the batch file '''
+		save_snapshot(filename, self.network, self.purchases)
+
+
 	def initialize_objects(self, params):
 		''' Ensures that the social network and purchase 
 			history are initialized correctly '''
@@ -123,16 +363,140 @@ class AnomalyDetection:
 			D = input('Give the degree of the network (D): ')
 			T = input('Give the tracked purchases (T): ')
 
-		self.network = SocialNetwork(D)
-		self.purchases = PurchaseHistory(T)
+		if self.compact_network:
+			self.network = CompactSocialNetwork(D, self.lazy_network, self.cache_size,
+													self.network_workers, self.network_builder)
+		else:
+			self.network = SocialNetwork(D, self.lazy_network, self.cache_size,
+											self.network_workers, self.network_builder)
+		if self.purchase_backend == 'columnar':
+			self.purchases = ColumnarPurchaseHistory(T, self.retention)
+		else:
+			self.purchases = PurchaseHistory(T, self.retention)
+		if self.instrumentation:
+			self.instrumentation.instrument_objects(self)
+		self.specialize_handlers()
+
+
+	def specialize_handlers(self):
+		''' Binds the default batch handlers directly to the social network
+			and purchase history, saving a call per batch event. Handlers
+			registered in their place (or instrumented) are kept. The 
+			handlers bound to previous objects are bound to the new ones. '''
+		batch = self.handlers['batch']
+		for event_type, default, method in (
+					('purchase', self.add_batch_purchase, self.purchases.add_purchase),
+					('befriend', self.add_batch_friend, self.network.add_friend),
+					('unfriend', self.remove_batch_friend, self.network.remove_friend)):
+			handler = batch.get(event_type)
+			if handler == default or (handler is not None and 
+										handler == self.specialized_handlers.get(event_type)):
+				batch[event_type] = method
+				self.specialized_handlers[event_type] = method
 
 
 	def analyze_stream_data(self):
 		''' Analyzed each event in the stream data '''
-		f = open(self.stream_file)
+		f = open_log(self.stream_file, self.threaded_io, self.block_size)
 		f = self.process_events(f, 'stream')
 		f.close()
 
+		# write out the flagged purchases that are still buffered 
+		if self.writer:
+			self.writer.flush()
+
+
+	def follow_stream(self, poll_interval=0.1, report_interval=10.0, max_idle=None):
+		''' Analyzes the stream data as it is appended to the stream file,
+			keeping the network and purchase history loaded. The latency 
+			of the events is reported every report_interval seconds. 
+			Stops when there is no new data for max_idle seconds, if given. '''
+		self.follower = StreamFollower(self.stream_file, poll_interval)
+		last_report = time.time()
+		last_event = time.time()
+
+		for line, arrival in self.follower.read_lines():
+			if line is None:
+				# no new data: write out the flagged purchases
+				if self.writer:
+					self.writer.flush()
+				if max_idle is not None and time.time() - last_event > max_idle:
+					break
+			else:
+				line = line.strip()
+				if line:
+					self.process_event(self.decode(line), 'stream')
+					self.latencies.append(time.time() - arrival)
+				last_event = time.time()
+
+			if report_interval and time.time() - last_report >= report_interval:
+				self.report_latency()
+				last_report = time.time()
+
+		self.follower.close()
+		if self.writer:
+			self.writer.flush()
+
+
+	def get_latency_stats(self):
+		''' Returns the 50th, 99th percentile and maximum detection latency 
+			(seconds) of the recent events in follow mode '''
+		if not self.latencies:
+			return (0, 0, 0)
+		p50, p99 = np.percentile(self.latencies, [50, 99])
+		return (p50, p99, max(self.latencies))
+
+
+	def report_latency(self):
+		''' Prints the detection latency of the recent events '''
+		p50, p99, latency_max = self.get_latency_stats()
+		print '%d stream events; detection latency p50 %.2f ms, p99 %.2f ms, max %.2f ms' \
+				%(self.Nstream, 1000*p50, 1000*p99, 1000*latency_max)
+
+
+	def get_writer(self):
+		''' Returns the writer of the flagged purchases; the writer 
+			is opened the first time and flushed at exit '''
+		if self.writer is None:
+			self.writer = self.open_writer()
+		return self.writer
+
+
+	def open_writer(self):
+		''' Opens a writer of the flagged purchases file, which is 
+			closed at exit '''
+		writer = FlaggedWriter(self.flagged_file, self.flush_interval,
+								self.flush_size, self.fsync)
+		writer.register_exit_handlers()
+		return writer
+
+
+	def get_number_users(self):
+		''' Returns the number of users in the social network '''
+		if self.sharded:
+			return self.sharded.get_number_users()
+		return self.network.get_number_users()
+
+
+	def get_number_purchases(self):
+		''' Returns the number of purchases in the purchase history '''
+		if self.sharded:
+			return self.sharded.get_number_purchases()
+		return self.purchases.get_number_purchases()
+
+
+	def close(self):
+		''' Flushes and closes the flagged purchases file and the
+			slow log, and stops the shards '''
+		if self.sharded:
+			self.sharded.stop()
+			self.sharded = None
+		if self.slow_log:
+			self.slow_log.close()
+		if self.writer:
+			self.writer.close()
+			self.writer = None
+
 
 	def check_for_anomaly(self, purchase):
 		''' Determines if a purchase is an anomaly '''
@@ -141,6 +505,11 @@ class AnomalyDetection:
 		amount = purchase.get('amount')
 
 		if uid and amount:
+			# the user's network cannot have enough purchases for 
+			# the purchase stats if its component does not
+			if self.components and self.components.has_few_purchases(uid):
+				return False
+
 			# get the last T purchases in the uid's network
 			users = self.network.get_user_list(uid)
 			mean, sd, Npurchases = self.purchases.get_purchase_stats(users)
@@ -150,14 +519,21 @@ class AnomalyDetection:
 				# purchase is an anomaly if it's more than 3 sd's from the mean
 				if amount > mean + (3*sd):
 
-					print 'Anomalous purchase in network of %d user(s) and %d purchase(s): $%.2f' \
-							%(len(users), Npurchases, amount)
+					if self.verbose:
+						print 'Anomalous purchase in network of %d user(s) and %d purchase(s): $%.2f' \
+								%(len(users), Npurchases, amount)
 
 					# write anomaly to the flagged purchases
-					f = open(self.flagged_file, 'a')
-					f.write('{"event_type": "%s", "timestamp": "%s", "id": "%s", "amount": "%.2f", "mean": "%.2f", "sd": "%.2f"}\n' \
-								%(purchase['event_type'], purchase['timestamp'], purchase['id'], amount, mean, sd))
-					f.close()
+					line = '{"event_type": "%s", "timestamp": "%s", "id": "%s", "amount": "%.2f", "mean": "%.2f", "sd": "%.2f"}\n' \
+								%(purchase['event_type'], purchase['timestamp'], purchase['id'], amount, mean, sd)
+					# the decoded values are unicode; the file takes utf-8
+					if isinstance(line, unicode):
+						line = line.encode('utf-8')
+					self.get_writer().write(line)
+
+					# publish the anomaly
+					for listener in self.flagged_listeners:
+						listener(line)
 					return True
 
 		else:
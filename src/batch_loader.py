@@ -0,0 +1,140 @@
+# python
+import json
+import mmap
+import multiprocessing
+from array import array
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+# kinds of the events parsed from the batch data
+PURCHASE = 0
+BEFRIEND = 1
+UNFRIEND = 2
+# events of other types are passed as they are
+OTHER = 3
+EVENT_KINDS = {'purchase': PURCHASE, 'befriend': BEFRIEND, 'unfriend': UNFRIEND}
+
+
+def load_batch(session, workers):
+	''' Loads the batch data of an AnomalyDetection session with a pool
+		of worker processes. The file is memory-mapped and split into
+		chunks at line boundaries; the workers parse the chunks into
+		compact event arrays, which are then applied in their original
+		order. The result is the same as session.analyze_batch_data(). '''
+	f = open(session.batch_file, 'rb')
+	try:
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	except ValueError:
+		# empty file
+		data = ''
+
+	# the first line contains the degree (D) and number of
+	# tracked purchases (T). Initialize objects.
+	start = data.find('\n') + 1 or len(data)
+	session.initialize_objects(json.loads(data[:start].strip()))
+
+	chunks = split_chunks(data, start, 4*workers)
+	if isinstance(data, mmap.mmap):
+		data.close()
+	f.close()
+
+	pool = multiprocessing.Pool(workers)
+	try:
+		tasks = [(session.batch_file, lo, hi, session.decode) for lo, hi in chunks]
+		for events in pool.imap(parse_chunk, tasks):
+			apply_events(session, events)
+	finally:
+		pool.close()
+		pool.join()
+
+	# once all the users are loaded to the social
+	# network, generate the Dth degree network
+	session.network.update_network()
+
+
+def split_chunks(data, start, Nchunks):
+	''' Splits data[start:] into about Nchunks (lo, hi) ranges
+		that end at the end of a line '''
+	size = len(data) - start
+	chunks = []
+	lo = start
+	for i in range(1, Nchunks+1):
+		if lo >= len(data):
+			break
+		hi = start + size*i/Nchunks
+		if hi < len(data):
+			# move the end of the chunk to the end of the line
+			newline = data.find('\n', max(hi, lo))
+			hi = len(data) if newline < 0 else newline + 1
+		hi = max(hi, lo)
+		if hi > lo:
+			chunks.append((lo, hi))
+		lo = hi
+	return chunks
+
+
+def parse_chunk(task):
+	''' Parses the events in a chunk of the batch file in a worker
+		process. Returns compact event arrays: the kind of each event
+		and its fields (id and timestamp for purchases, id1 and id2 for
+		relationships, the event itself for other event types) and the 
+		amount of purchases. '''
+	filename, lo, hi, decode = task
+	f = open(filename, 'rb')
+	data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	lines = data[lo:hi].split('\n')
+	data.close()
+	f.close()
+
+	kinds = array('b')
+	fields1 = []
+	fields2 = []
+	amounts = []
+	for line in lines:
+		line = line.strip()
+		if not line:
+			continue
+		event = decode(line)
+		kind = EVENT_KINDS.get(event['event_type'], OTHER)
+		kinds.append(kind)
+		if kind == OTHER:
+			fields1.append(event)
+			fields2.append(None)
+			amounts.append(None)
+		elif kind == PURCHASE:
+			fields1.append(event.get('id'))
+			fields2.append(event.get('timestamp'))
+			amounts.append(event.get('amount'))
+		else:
+			fields1.append(event.get('id1'))
+			fields2.append(event.get('id2'))
+			amounts.append(None)
+
+	return (kinds, fields1, fields2, amounts)
+
+
+def apply_events(session, events):
+	''' Applies the parsed events of a chunk with the session's
+		batch handlers, in order '''
+	kinds, fields1, fields2, amounts = events
+	handlers = session.handlers['batch']
+	add_purchase = handlers.get('purchase')
+	add_friend = handlers.get('befriend')
+	remove_friend = handlers.get('unfriend')
+
+	for kind, field1, field2, amount in zip(kinds, fields1, fields2, amounts):
+		if kind == PURCHASE:
+			if add_purchase:
+				add_purchase({'id': field1, 'timestamp': field2, 'amount': amount})
+		elif kind == BEFRIEND:
+			if add_friend:
+				add_friend({'id1': field1, 'id2': field2})
+		elif kind == UNFRIEND:
+			if remove_friend:
+				remove_friend({'id1': field1, 'id2': field2})
+		else:
+			handler = handlers.get(field1['event_type'])
+			if handler:
+				handler(field1)
+
@@ -0,0 +1,232 @@
+# python
+import calendar
+import numpy as np
+import time
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class ColumnarPurchaseHistory:
+	''' Alternative purchase history that stores the purchases in
+		compact parallel columns instead of a dict of tuples. It has
+		the same interface as PurchaseHistory. '''
+
+	# format of the timestamps in the batch/stream data
+	TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+	def __init__(self, T, retention=None, capacity=1024):
+		# the columns only support dropping purchases with a low-water mark
+		if retention is not None:
+			raise ValueError('Columnar purchase history does not support '+\
+								'%s retention' % retention)
+		self.retention = retention
+
+		# user ids are interned to dense integers
+		# data structure of ids: { id: int, ...} and names: [id, ...]
+		self.ids = {}
+		self.names = []
+
+		# purchases history
+		# data structure for purchases: three columns where row i is the
+		# purchase Nfirst+i: uids (int32), timestamps (int64 epoch seconds)
+		# and amounts (float64). The columns are over-allocated and grow
+		# geometrically; only the first Nrows rows are in use.
+		self.uids = np.zeros(capacity, dtype=np.int32)
+		self.timestamps = np.zeros(capacity, dtype=np.int64)
+		self.amounts = np.zeros(capacity, dtype=np.float64)
+		self.Nrows = 0
+
+		# lookup table of the users selected by a query; indexed by
+		# interned id and reset after each query
+		self.selected = np.zeros(capacity, dtype=np.bool_)
+
+		# number of consecutive purchases to be considered
+		self.T = int(T)
+
+		# track the number of purchases to keep them in order
+		self.Npurchase = 0
+
+		# Npurchase of the first row in the columns
+		self.Nfirst = 0
+
+		# keep track of the purchases dropped from the history and
+		# the memory that was reclaimed (bytes)
+		self.Nevicted = 0
+		self.bytes_reclaimed = 0
+
+		# the last timestamp that was parsed; many purchases share it
+		self.last_timestamp = (None, 0)
+
+		# rows masked by the last query of the last purchases
+		self.Nscanned = 0
+
+
+	def add_purchase(self, purchase):
+		''' Adds a purchase to the end of the columns. Purchases come in
+			order of their timestamp. Many have the same timestamp
+			so treat the first call as an earlier timestamp. '''
+		timestamp = purchase.get('timestamp')
+		uid = purchase.get('id')
+		amount = purchase.get('amount')
+
+		# ensure all the data exists
+		if timestamp and uid and amount:
+			if self.Nrows == len(self.amounts):
+				self.grow(2*len(self.amounts))
+
+			self.uids[self.Nrows] = self.intern(uid)
+			self.timestamps[self.Nrows] = self.parse_timestamp(timestamp)
+			self.amounts[self.Nrows] = float(amount)
+			self.Nrows += 1
+
+			# increment the number of purchases
+			self.Npurchase += 1
+
+		else:
+			print 'Purchase event has incomplete data.'
+
+
+	def grow(self, capacity):
+		''' Resizes the columns to the given capacity '''
+		for column in ('uids', 'timestamps', 'amounts'):
+			old = getattr(self, column)
+			new = np.zeros(capacity, dtype=old.dtype)
+			new[:self.Nrows] = old[:self.Nrows]
+			setattr(self, column, new)
+
+
+	def intern(self, uid):
+		''' Returns the integer id of a user, creating it if needed '''
+		if uid not in self.ids:
+			self.ids[uid] = len(self.names)
+			self.names.append(uid)
+			if len(self.names) > len(self.selected):
+				selected = np.zeros(2*len(self.selected), dtype=np.bool_)
+				selected[:len(self.selected)] = self.selected
+				self.selected = selected
+		return self.ids[uid]
+
+
+	def parse_timestamp(self, timestamp):
+		''' Converts a timestamp to epoch seconds '''
+		if timestamp != self.last_timestamp[0]:
+			try:
+				seconds = calendar.timegm(time.strptime(timestamp, self.TIMESTAMP_FORMAT))
+			except ValueError:
+				seconds = -1
+			self.last_timestamp = (timestamp, seconds)
+		return self.last_timestamp[1]
+
+
+	def get_purchase(self, Npurchase):
+		''' Returns a purchase as an (id, timestamp, amount) tuple '''
+		i = Npurchase - self.Nfirst
+		if i < 0 or i >= self.Nrows:
+			raise KeyError(Npurchase)
+		return (self.names[self.uids[i]],
+				time.strftime(self.TIMESTAMP_FORMAT, time.gmtime(self.timestamps[i])),
+				float(self.amounts[i]))
+
+
+	def get_purchase_stats(self, users):
+		''' Returns the mean and std for a list of purchases for
+			a given list of users ordered by the timestamp '''
+
+		# the network must have at least 2 purchases
+		if self.T < 2:
+			return (0, 0, 0)
+
+		purchases = self.get_last_purchases(users)
+
+		# ensure that the number of purchases are >2 and <T
+		if not len(purchases)>2 and len(purchases)<=self.T:
+			return (0,0,0)
+
+		mean = np.mean(purchases)
+		sd = np.std(purchases)
+
+		return (mean, sd, len(purchases))
+
+
+	def get_last_purchases(self, users):
+		''' Returns the amounts of the last T purchases made by
+			the given users, newest first '''
+		ids = [self.ids[uid] for uid in users if uid in self.ids]
+		if not ids or self.T < 1:
+			self.Nscanned = 0
+			return np.zeros(0)
+
+		# The rows are pre-sorted by the order in which the purchases
+		# come in from the batch/stream, so select the users' rows with a
+		# vectorized mask over windows starting at the most recent purchase.
+		# The window doubles until T purchases are found.
+		self.selected[ids] = True
+		found = []
+		Nfound = 0
+		hi = self.Nrows
+		window = 4*self.T
+		while hi > 0 and Nfound < self.T:
+			lo = max(0, hi-window)
+			mask = self.selected[self.uids[lo:hi]]
+			amounts = self.amounts[lo:hi][mask][::-1]
+			found.append(amounts)
+			Nfound += len(amounts)
+			hi = lo
+			window *= 2
+		self.selected[ids] = False
+		self.Nscanned = self.Nrows - hi
+
+		return np.concatenate(found)[:self.T]
+
+
+	def drop_purchases_before(self, Nlow):
+		''' Drops every purchase older than the low-water mark Nlow.
+			Returns the memory reclaimed (bytes) by the call. '''
+		Ndrop = min(Nlow, self.Npurchase) - self.Nfirst
+		if Ndrop <= 0:
+			return 0
+
+		# shift the remaining rows to the start of the columns
+		Nrows = self.Nrows - Ndrop
+		for column in ('uids', 'timestamps', 'amounts'):
+			values = getattr(self, column)
+			values[:Nrows] = values[Ndrop:self.Nrows].copy()
+		self.Nrows = Nrows
+		self.Nfirst += Ndrop
+
+		# release the memory when the columns are mostly unused
+		if 4*self.Nrows < len(self.amounts):
+			self.grow(max(2*self.Nrows, 1024))
+
+		reclaimed = Ndrop*self.get_row_size()
+		self.Nevicted += Ndrop
+		self.bytes_reclaimed += reclaimed
+		return reclaimed
+
+
+	def get_row_size(self):
+		''' Returns the memory (bytes) used by a purchase in the columns '''
+		return self.uids.itemsize + self.timestamps.itemsize + self.amounts.itemsize
+
+
+	def get_memory_reclaimed(self):
+		''' Returns the number of purchases dropped from the history
+			and the memory (bytes) that was reclaimed '''
+		return (self.Nevicted, self.bytes_reclaimed)
+
+
+	def get_number_retained(self):
+		''' Returns the number of purchases kept in the history '''
+		return self.Nrows
+
+
+	def get_number_purchases(self):
+		''' Returns the number of purchases in the history '''
+		return self.Npurchase
+
+
+	def set_purchase_cutoff(self, T):
+		''' Allows the set of number of consecutive
+			purchases to be considered '''
+		self.T = T
+
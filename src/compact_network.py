@@ -0,0 +1,263 @@
+# python
+import bisect
+from array import array
+
+# project
+from social_network import SocialNetwork
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class CompactGraph:
+	''' Stores the relationships between users, identified by dense
+		integer ids, in compressed sparse row (CSR) arrays. Changes are
+		kept in a small overlay until the arrays are compacted. The graph
+		can be used like the friends dict of the social network:
+		graph[id1] gives the friends of id1. '''
+
+	def __init__(self, compact_fraction=0.1):
+		# CSR adjacency: the friends of user i are
+		# indices[indptr[i]:indptr[i+1]], sorted
+		self.indptr = array('i', [0])
+		self.indices = array('i')
+
+		# overlay of relationships added and removed since the last
+		# compaction: { id1: set(id2, ...), ...}
+		self.added = {}
+		self.removed = {}
+		self.Npending = 0
+
+		# number of users in the graph
+		self.Nusers = 0
+
+		# compact once the overlay holds more than this fraction
+		# of the relationships in the arrays
+		self.compact_fraction = compact_fraction
+
+
+	def __len__(self):
+		return self.Nusers
+
+
+	def __iter__(self):
+		return iter(xrange(self.Nusers))
+
+
+	def __contains__(self, uid):
+		return 0 <= uid < self.Nusers
+
+
+	def __getitem__(self, uid):
+		''' Returns the friends of a user '''
+		if uid < len(self.indptr)-1:
+			friends = self.indices[self.indptr[uid]:self.indptr[uid+1]]
+		else:
+			friends = ()
+
+		# apply the overlay
+		if uid in self.added or uid in self.removed:
+			friends = set(friends)
+			friends.difference_update(self.removed.get(uid, ()))
+			friends.update(self.added.get(uid, ()))
+
+		return friends
+
+
+	def add_user(self):
+		''' Adds a user without relationships and returns its id '''
+		self.Nusers += 1
+		return self.Nusers - 1
+
+
+	def has_edge(self, id1, id2):
+		''' Checks if id2 is id1's friend '''
+		if id2 in self.added.get(id1, ()):
+			return True
+		if id2 in self.removed.get(id1, ()):
+			return False
+		if id1 < len(self.indptr)-1:
+			lo = self.indptr[id1]
+			hi = self.indptr[id1+1]
+			i = bisect.bisect_left(self.indices, id2, lo, hi)
+			return i < hi and self.indices[i] == id2
+		return False
+
+
+	def add_edge(self, id1, id2):
+		''' Adds a relationship between id1 and id2. Returns
+			False if the relationship already exists. '''
+		if self.has_edge(id1, id2):
+			return False
+
+		# relationships are bi-directional
+		for uid, friend in ((id1, id2), (id2, id1)):
+			if friend in self.removed.get(uid, ()):
+				self.removed[uid].discard(friend)
+			else:
+				self.added.setdefault(uid, set()).add(friend)
+			self.Npending += 1
+
+		self.compact_if_needed()
+		return True
+
+
+	def remove_edge(self, id1, id2):
+		''' Removes the relationship between id1 and id2. Returns
+			False if the relationship does not exist. '''
+		if not self.has_edge(id1, id2):
+			return False
+
+		for uid, friend in ((id1, id2), (id2, id1)):
+			if friend in self.added.get(uid, ()):
+				self.added[uid].discard(friend)
+			else:
+				self.removed.setdefault(uid, set()).add(friend)
+			self.Npending += 1
+
+		self.compact_if_needed()
+		return True
+
+
+	def compact_if_needed(self):
+		''' Compacts the graph when the overlay gets too large '''
+		if self.Npending > max(1024, self.compact_fraction*len(self.indices)):
+			self.compact()
+
+
+	def compact(self):
+		''' Merges the overlay into the CSR arrays '''
+		indptr = array('i', [0])
+		indices = array('i')
+		for uid in xrange(self.Nusers):
+			friends = self[uid]
+			if uid in self.added or uid in self.removed:
+				friends = sorted(friends)
+			indices.extend(friends)
+			indptr.append(len(indices))
+
+		self.indptr = indptr
+		self.indices = indices
+		self.added = {}
+		self.removed = {}
+		self.Npending = 0
+
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class CompactSocialNetwork(SocialNetwork):
+	''' Social network that maps the user ids to dense integers once
+		and stores the relationships in a CompactGraph. The Dth degree
+		networks are computed over the integer ids. The interface is the
+		same as SocialNetwork's and takes the original user ids. '''
+
+	def __init__(self, D, lazy=False, cache_size=100000, workers=1, builder='auto'):
+		SocialNetwork.__init__(self, D, lazy, cache_size, workers, builder)
+
+		# user ids are interned to dense integers
+		# data structure of ids: { id: int, ...} and names: [id, ...]
+		self.ids = {}
+		self.names = []
+
+		# the friends network is a CompactGraph over the integer ids and
+		# the Dth degree network is { int1 : { int2 : level, ...}, ...}
+		self.friends = CompactGraph()
+
+
+	def intern(self, uid):
+		''' Returns the integer id of a user, creating it if needed '''
+		if uid not in self.ids:
+			self.ids[uid] = self.friends.add_user()
+			self.names.append(uid)
+		return self.ids[uid]
+
+
+	def add_friend(self, befriend, update_needed=False):
+		''' adds a relationship between 2 users in the network '''
+		id1 = befriend.get('id1')
+		id2 = befriend.get('id2')
+
+		# ensure all the data exists
+		if id1 and id2:
+			id1 = self.intern(id1)
+			id2 = self.intern(id2)
+			is_new = self.friends.add_edge(id1, id2)
+
+			if update_needed and is_new:
+				if self.lazy:
+					self.invalidate_cache(id1, id2)
+				else:
+					self.add_network_relationship(id1, id2)
+		else:
+			print 'Befriend event has incomplete data.'
+
+
+	def remove_friend(self, unfriend, update_needed=False):
+		''' removes the relationship between 2 users
+			in the network'''
+		id1 = unfriend.get('id1')
+		id2 = unfriend.get('id2')
+
+		# ensure all the data exists
+		if id1 and id2:
+			if id1 in self.ids and id2 in self.ids:
+				id1 = self.ids[id1]
+				id2 = self.ids[id2]
+				friend_removed = self.friends.remove_edge(id1, id2)
+
+				if friend_removed and update_needed:
+					if self.lazy:
+						self.invalidate_cache(id1, id2)
+					else:
+						self.remove_network_relationship(id1, id2)
+		else:
+			print 'Unfriend event has incomplete data.'
+
+
+	def are_friends(self, id1, id2):
+		''' checks if id2 is id1's friend '''
+		if id1 in self.ids and id2 in self.ids:
+			return self.friends.has_edge(self.ids[id1], self.ids[id2])
+		return False
+
+
+	def update_network(self, specific_users=set([])):
+		''' Updates a Dth degree network for every user
+			in the network. If specific users are given,
+			then it only updates the network for those users. '''
+		if len(specific_users):
+			users = set(self.ids[uid] for uid in specific_users if uid in self.ids)
+			# no known users -> nothing to update
+			if not users:
+				return self.D >= 1
+			return SocialNetwork.update_network(self, users)
+
+		# the whole network is computed from the compacted arrays
+		self.friends.compact()
+		return SocialNetwork.update_network(self)
+
+
+	def compute_neighborhood(self, source, cutoff):
+		''' Computes all the neighbors within some cutoff distance
+			of a given source node (integer id). '''
+		levels = self.search_neighborhood(source, cutoff)
+		self.network[source] = levels
+
+		# relationships are bi-directional
+		for node, level in levels.iteritems():
+			if node not in self.network:
+				self.network[node] = {source: level}
+			else:
+				self.network[node][source] = level
+
+
+	def get_user_list(self, uid, cutoff=None):
+		''' Returns the list of users in the given user's
+			Dth degree network. If a cutoff is given, then
+			only users within a certain degree are returned.'''
+		if uid not in self.ids:
+			return set([])
+		names = self.names
+		users = SocialNetwork.get_user_list(self, self.ids[uid], cutoff)
+		return set(names[id2] for id2 in users)
+
@@ -0,0 +1,201 @@
+# python
+from collections import deque
+
+# project
+from snapshot import network_items, purchase_items
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class ComponentIndex:
+	''' Index of the connected components of the social network and
+		the number of purchases made in each of them.
+
+		A user's Dth degree network is part of its component, so a purchase
+		cannot be an anomaly when its component has fewer purchases than
+		the purchase stats need; check_for_anomaly uses the index to skip
+		those purchases in O(1), before the network and purchase history
+		are searched.
+
+		The components are joined with a union-find on befriend events; the
+		smaller component is relabeled, so finding a user's component is a
+		single lookup. Unfriend events only mark their component as possibly
+		split: the split is checked the next time the component is used for
+		a decision that the split could change. Without a network, the
+		components are never split, which keeps users that were ever
+		connected together (e.g. to partition work). '''
+
+	def __init__(self, network=None, Nmin=3):
+		# the social network whose components are indexed
+		self.network = network
+
+		# purchases needed for the purchase stats
+		self.Nmin = Nmin
+
+		# component of each user and the users of each component
+		# data structure of components: { id: component, ...}
+		# data structure of members: { component: set(id, ...), ...}
+		self.components = {}
+		self.members = {}
+		self.Ncomponents = 0
+
+		# number of purchases of each user and component
+		# data structure of user_purchases: { id: Npurchases, ...}
+		# data structure of purchase_counts: { component: Npurchases, ...}
+		self.user_purchases = {}
+		self.purchase_counts = {}
+
+		# components that may have split after unfriend events
+		self.maybe_split = set()
+
+		# number of purchases skipped and components split
+		self.Nskipped = 0
+		self.Nsplits = 0
+
+
+	def rebuild(self, purchases):
+		''' Rebuilds the index from the network's relationships and
+			the purchases kept in the purchase history '''
+		self.__init__(self.network, self.Nmin)
+		for uid, friends in network_items(self.network, self.network.friends):
+			for friend in friends:
+				self.add_relationship(uid, friend)
+			self.add_user(uid)
+		for Npurchase, uid, timestamp, amount in purchase_items(purchases):
+			self.add_purchase(uid)
+
+
+	def add_user(self, uid):
+		''' Adds a user as its own component; returns its component '''
+		if uid not in self.components:
+			component = self.Ncomponents
+			self.Ncomponents += 1
+			self.components[uid] = component
+			self.members[component] = set([uid])
+			self.purchase_counts[component] = 0
+			return component
+		return self.components[uid]
+
+
+	def remove_users(self, users):
+		''' Removes users from the index '''
+		for uid in users:
+			component = self.components.pop(uid, None)
+			if component is None:
+				continue
+			self.purchase_counts[component] -= self.user_purchases.pop(uid, 0)
+			members = self.members[component]
+			members.discard(uid)
+			if not members:
+				self.remove_component(component)
+
+
+	def remove_component(self, component):
+		''' Removes an empty component '''
+		del self.members[component]
+		del self.purchase_counts[component]
+		self.maybe_split.discard(component)
+
+
+	def add_relationship(self, id1, id2):
+		''' Joins the components of two users; returns the component '''
+		component1 = self.add_user(id1)
+		component2 = self.add_user(id2)
+		if component1 == component2:
+			return component1
+
+		# the users of the smaller component are relabeled
+		if len(self.members[component1]) < len(self.members[component2]):
+			component1, component2 = component2, component1
+		for uid in self.members[component2]:
+			self.components[uid] = component1
+		self.members[component1].update(self.members[component2])
+		self.purchase_counts[component1] += self.purchase_counts[component2]
+		if component2 in self.maybe_split:
+			self.maybe_split.add(component1)
+		self.remove_component(component2)
+		return component1
+
+
+	def remove_relationship(self, id1, id2):
+		''' Marks the component of a removed relationship as possibly split '''
+		if self.network is not None and id1 in self.components:
+			self.maybe_split.add(self.components[id1])
+
+
+	def add_purchase(self, uid, Npurchases=1):
+		''' Counts the purchases of a user '''
+		component = self.add_user(uid)
+		self.user_purchases[uid] = self.user_purchases.get(uid, 0) + Npurchases
+		self.purchase_counts[component] += Npurchases
+
+
+	def has_few_purchases(self, uid):
+		''' Returns True if the user's component has fewer purchases than
+			the purchase stats need '''
+		component = self.components.get(uid)
+		if component is None or self.purchase_counts[component] < self.Nmin:
+			self.Nskipped += 1
+			return True
+
+		# a split could leave the user's part with too few purchases
+		if component in self.maybe_split and self.split(uid, component):
+			self.Nskipped += 1
+			return True
+		return False
+
+
+	def split(self, uid, component):
+		''' Searches the part of a possibly split component that the user
+			is connected to, until it has enough purchases. If it does not,
+			the part is split off as its own component and True is returned. '''
+		user_purchases = self.user_purchases
+		Npurchases = user_purchases.get(uid, 0)
+		visited = set([uid])
+		queue = deque([uid])
+		while queue and Npurchases < self.Nmin:
+			for friend in self.get_friends(queue.popleft()):
+				if friend not in visited:
+					visited.add(friend)
+					Npurchases += user_purchases.get(friend, 0)
+					queue.append(friend)
+		if Npurchases >= self.Nmin:
+			return False
+
+		# the search went through the whole part
+		if len(visited) == len(self.members[component]):
+			self.maybe_split.discard(component)
+			return True
+
+		part = self.Ncomponents
+		self.Ncomponents += 1
+		for member in visited:
+			self.components[member] = part
+		self.members[component] -= visited
+		self.members[part] = visited
+		self.purchase_counts[component] -= Npurchases
+		self.purchase_counts[part] = Npurchases
+		self.Nsplits += 1
+		return True
+
+
+	def get_friends(self, uid):
+		''' Returns the friends of a user in the network; compact
+			networks use integer keys '''
+		network = self.network
+		if hasattr(network, 'ids'):
+			if uid not in network.ids:
+				return []
+			return [network.names[i] for i in network.friends[network.ids[uid]]]
+		return network.friends.get(uid, ())
+
+
+	def get_component(self, uid):
+		''' Returns the component of a user, or None '''
+		return self.components.get(uid)
+
+
+	def get_number_components(self):
+		''' Returns the number of components '''
+		return len(self.members)
+
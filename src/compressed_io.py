@@ -0,0 +1,160 @@
+# python
+import bz2
+import gzip
+import Queue
+import threading
+
+# xz is only available with the lzma module (or its backport)
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+# magic bytes and extensions of the supported compression formats
+COMPRESSION_MAGIC = [('gzip', '\x1f\x8b'), ('bz2', 'BZh'), ('xz', '\xfd7zXZ\x00')]
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}
+
+# size of the blocks read from the compressed files
+BLOCK_SIZE = 1 << 20
+
+
+def get_compression(filename):
+	''' Returns the compression format of a file ('gzip', 'bz2', 'xz') from
+		its magic bytes, or its extension if it cannot be read; None if the
+		file is not compressed '''
+	try:
+		f = open(filename, 'rb')
+		magic = f.read(6)
+		f.close()
+	except IOError:
+		for extension, compression in COMPRESSION_EXTENSIONS.items():
+			if filename.endswith(extension):
+				return compression
+		return None
+
+	for compression, prefix in COMPRESSION_MAGIC:
+		if magic.startswith(prefix):
+			return compression
+	return None
+
+
+def open_log(filename, threaded=False, block_size=BLOCK_SIZE, queue_depth=4):
+	''' Opens a batch/stream log for reading; compressed logs are
+		decompressed as they are read. If threaded, the file is read
+		and decompressed in a background thread. '''
+	compression = get_compression(filename)
+	if compression == 'gzip':
+		f = gzip.GzipFile(filename, 'rb')
+	elif compression == 'bz2':
+		f = bz2.BZ2File(filename, 'rb', buffering=block_size)
+	elif compression == 'xz':
+		if lzma is None:
+			raise IOError('Reading %s requires the lzma module' % filename)
+		f = lzma.LZMAFile(filename, 'rb')
+	else:
+		f = open(filename, 'rb', block_size)
+
+	if threaded:
+		return ThreadedReader(f, block_size, queue_depth)
+	return f
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class ThreadedReader:
+	''' Reads a file in blocks in a background thread, so that reading
+		and decompressing overlaps with processing the data. At most
+		queue_depth blocks are read ahead. '''
+
+	def __init__(self, f, block_size=BLOCK_SIZE, queue_depth=4):
+		self.f = f
+		self.block_size = block_size
+		self.blocks = Queue.Queue(queue_depth)
+		self.stopped = False
+
+		# the current block and the position in it
+		self.block = ''
+		self.position = 0
+		self.done = False
+
+		self.thread = threading.Thread(target=self.read_blocks)
+		self.thread.daemon = True
+		self.thread.start()
+
+
+	def read_blocks(self):
+		''' Reads the blocks of the file into the queue; an empty
+			block is the end of the file '''
+		try:
+			while not self.stopped:
+				block = self.f.read(self.block_size)
+				self.blocks.put(block)
+				if not block:
+					break
+		except Exception as error:
+			self.blocks.put(error)
+
+
+	def next_block(self):
+		''' Moves to the next block; returns False at the end of the file '''
+		if self.done:
+			return False
+		block = self.blocks.get()
+		if isinstance(block, Exception):
+			self.done = True
+			raise block
+		if not block:
+			self.done = True
+			return False
+		self.block = block
+		self.position = 0
+		return True
+
+
+	def read(self, size=-1):
+		''' Reads up to size bytes; all the remaining bytes if size < 0 '''
+		parts = []
+		while size < 0 or size > 0:
+			if self.position >= len(self.block) and not self.next_block():
+				break
+			end = len(self.block) if size < 0 else min(len(self.block), self.position+size)
+			parts.append(self.block[self.position:end])
+			if size > 0:
+				size -= end - self.position
+			self.position = end
+		return ''.join(parts)
+
+
+	def readline(self):
+		''' Reads a line, including the newline '''
+		parts = []
+		while True:
+			if self.position >= len(self.block) and not self.next_block():
+				break
+			newline = self.block.find('\n', self.position)
+			end = len(self.block) if newline < 0 else newline + 1
+			parts.append(self.block[self.position:end])
+			self.position = end
+			if newline >= 0:
+				break
+		return ''.join(parts)
+
+
+	def close(self):
+		''' Stops the background thread and closes the file '''
+		self.stopped = True
+		# unblock the thread if the queue is full
+		while self.thread.is_alive():
+			try:
+				self.blocks.get_nowait()
+			except Queue.Empty:
+				pass
+			self.thread.join(0.01)
+		self.f.close()
+
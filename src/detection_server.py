@@ -0,0 +1,237 @@
+# python
+import json
+import os
+import Queue
+import socket
+import SocketServer
+import threading
+import traceback
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class DetectionServer:
+	''' Long-running server around an AnomalyDetection session. Producers
+		connect over TCP or a Unix socket and send newline-delimited JSON
+		events; the flagged purchases of a connection's events are sent
+		back on the connection, and written to the flagged file.
+
+		The events of all connections go through a bounded queue to a
+		single detector thread, so they are processed in the order they
+		are received. When the queue is full, the connections stop
+		reading from their sockets, which pushes back on the producers. '''
+
+	def __init__(self, session, address, queue_size=1000, reply_queue_size=1000,
+					reply_timeout=1.0):
+		# the session must have its batch data loaded
+		self.session = session
+		self.session.flagged_listeners.append(self.publish)
+
+		# (host, port) for TCP, or a filename for a Unix socket
+		self.address = address
+
+		# events waiting for the detector: (connection, line)
+		self.events = Queue.Queue(queue_size)
+		self.reply_queue_size = reply_queue_size
+
+		# flagged purchases are dropped for connections that do not
+		# read them within reply_timeout seconds
+		self.reply_timeout = reply_timeout
+
+		# the connection of the event being processed
+		self.connection = None
+
+		self.server = None
+		self.threads = []
+
+		# number of events processed and flagged purchases dropped
+		# for slow connections
+		self.Nevents = 0
+		self.Ndropped = 0
+
+
+	def start(self):
+		''' Starts the server and the detector in background threads '''
+		if isinstance(self.address, basestring):
+			self.server = ThreadingUnixServer(self.address, ConnectionHandler)
+		else:
+			self.server = ThreadingTCPServer(self.address, ConnectionHandler)
+			# the port is chosen by the system if it's 0
+			self.address = self.server.server_address
+		self.server.detection_server = self
+
+		for target in (self.server.serve_forever, self.detect):
+			thread = threading.Thread(target=target)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+
+	def stop(self):
+		''' Stops the server once the queued events are processed '''
+		self.server.shutdown()
+		self.server.server_close()
+		if isinstance(self.address, basestring):
+			os.remove(self.address)
+		self.events.put((None, None))
+		for thread in self.threads:
+			thread.join()
+		self.session.flagged_listeners.remove(self.publish)
+		if self.session.writer:
+			self.session.writer.flush()
+
+
+	def serve_forever(self):
+		''' Runs the server until interrupted, starting it if needed '''
+		if self.server is None:
+			self.start()
+		try:
+			while True:
+				self.threads[0].join(1.0)
+		except KeyboardInterrupt:
+			pass
+		self.stop()
+
+
+	def detect(self):
+		''' Processes the queued events in order '''
+		while True:
+			connection, line = self.events.get()
+			if connection is None:
+				break
+
+			if line is None:
+				# all the events of the connection are processed
+				connection.end_replies()
+				continue
+
+			self.connection = connection
+			try:
+				event = json.loads(line)
+				if not isinstance(event, dict):
+					raise ValueError('The event is not an object')
+				self.session.process_event(event, 'stream')
+				self.Nevents += 1
+			except (ValueError, KeyError):
+				connection.put_reply('{"error": "invalid event"}\n')
+			except Exception:
+				# the detector thread must survive any event, otherwise 
+				# the producers block on the full queue
+				traceback.print_exc()
+				connection.put_reply('{"error": "invalid event"}\n')
+			self.connection = None
+
+			# write out the flagged purchases when the queue is empty
+			if self.events.empty() and self.session.writer:
+				self.session.writer.flush()
+
+
+	def publish(self, line):
+		''' Sends a flagged purchase to the connection of the event '''
+		if self.connection:
+			self.connection.put_reply(line)
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+	allow_reuse_address = True
+	daemon_threads = True
+
+
+class ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+
+class ConnectionHandler(SocketServer.StreamRequestHandler):
+	''' Reads the events of a connection into the server's queue, and
+		writes the flagged purchases back from a bounded reply queue '''
+
+	def handle(self):
+		server = self.server.detection_server
+		self.replies = Queue.Queue(server.reply_queue_size)
+		self.reply_timeout = server.reply_timeout
+		self.dropped = False
+
+		writer = threading.Thread(target=self.write_replies)
+		writer.daemon = True
+		writer.start()
+
+		for line in self.rfile:
+			line = line.strip()
+			if line:
+				# blocks while the queue is full
+				server.events.put((self, line))
+		server.events.put((self, None))
+
+		writer.join()
+
+
+	def put_reply(self, line):
+		''' Queues a reply for the connection; the replies are dropped
+			if the producer does not read them '''
+		if not self.dropped:
+			try:
+				self.replies.put(line, timeout=self.reply_timeout)
+				return
+			except Queue.Full:
+				self.dropped = True
+		self.server.detection_server.Ndropped += 1
+
+
+	def end_replies(self):
+		''' Ends the replies of the connection '''
+		if self.dropped:
+			# the remaining replies are not sent
+			try:
+				while True:
+					self.replies.get_nowait()
+					self.server.detection_server.Ndropped += 1
+			except Queue.Empty:
+				pass
+		try:
+			self.replies.put(None, timeout=self.reply_timeout)
+		except Queue.Full:
+			self.dropped = True
+			self.end_replies()
+
+
+	def write_replies(self):
+		''' Writes the queued replies until the connection is done '''
+		while True:
+			line = self.replies.get()
+			if line is None:
+				break
+			try:
+				self.wfile.write(line)
+				self.wfile.flush()
+			except socket.error:
+				self.dropped = True
+				break
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+def send_events(address, events):
+	''' Client: sends events (dicts or JSON lines) to a detection server
+		and returns the flagged purchases of the events '''
+	if isinstance(address, basestring):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	else:
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.connect(address)
+
+	# send the events, then read the replies until the server is done
+	f = sock.makefile('rw')
+	for event in events:
+		if isinstance(event, dict):
+			event = json.dumps(event)
+		f.write(event.strip() + '\n')
+	f.flush()
+	sock.shutdown(socket.SHUT_WR)
+
+	flagged = [json.loads(line) for line in f]
+	f.close()
+	sock.close()
+	return flagged
+
@@ -0,0 +1,84 @@
+# python
+import json
+
+# faster JSON decoders are used when they are installed
+try:
+	import ujson
+except ImportError:
+	ujson = None
+
+try:
+	import simplejson
+except ImportError:
+	simplejson = None
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+# size of the blocks read from the batch/stream files
+BLOCK_SIZE = 1 << 20
+
+
+def read_lines(f, block_size=BLOCK_SIZE):
+	''' Yields the lines of a file, without the newline. The file is
+		read in large blocks that are split into lines in bulk. '''
+	partial = ''
+	while True:
+		block = f.read(block_size)
+		if not block:
+			break
+		lines = (partial + block).split('\n')
+		# the last line may continue in the next block
+		partial = lines.pop()
+		for line in lines:
+			yield line
+	if partial:
+		yield partial
+
+
+def decode_event(line):
+	''' Schema-specific decoder for the events of the batch/stream data,
+		which are flat objects with string values, e.g.
+		{"event_type":"purchase", "timestamp":"...", "id": "1", "amount": "16.83"}
+		The line is split on the quotes instead of being parsed; anything
+		that doesn't match the schema is decoded with json. The keys and
+		values are unicode, as with json, so an id is the same user
+		whichever way its line is decoded. '''
+	if '\\' not in line:
+		if isinstance(line, str):
+			line = line.decode('utf-8')
+		parts = line.split('"')
+		# { key : value , key : value ... }
+		if len(parts) % 4 == 1 and parts[0].strip() == '{' and parts[-1].strip() == '}':
+			colons = parts[2::4]
+			commas = parts[4:-1:4]
+			# every key is followed by a colon and every value by a comma
+			if ''.join(colons).replace(' ', '') == ':'*len(colons) and \
+					''.join(commas).replace(' ', '') == ','*len(commas):
+				return dict(zip(parts[1::4], parts[3::4]))
+	return json.loads(line)
+
+
+# available decoders: { name: function(line) -> event, ...}
+DECODERS = {'json': json.loads, 'fast': decode_event}
+if simplejson:
+	DECODERS['simplejson'] = simplejson.loads
+if ujson:
+	DECODERS['ujson'] = ujson.loads
+
+# decoders tried by 'auto', fastest first; the schema-specific decoder is
+# not one of them, since json's C scanner is as fast or faster once it
+# returns unicode like json (see benchmarks.decode)
+AUTO_DECODERS = ('ujson', 'simplejson', 'json')
+
+
+def get_decoder(name='auto'):
+	''' Returns a decoder by name. The 'auto' decoder is the fastest
+		installed JSON library, falling back to json. '''
+	if name == 'auto':
+		name = [decoder for decoder in AUTO_DECODERS if decoder in DECODERS][0]
+	if name not in DECODERS:
+		raise ValueError('Unknown or unavailable decoder: %s (available: %s)' \
+							%(name, ', '.join(sorted(DECODERS))))
+	return DECODERS[name]
+
@@ -0,0 +1,132 @@
+# python
+import atexit
+import os
+import signal
+import sys
+import threading
+import time
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class FlaggedWriter:
+	''' Output sink for the flagged purchases. The file is kept open
+		and the lines are buffered, then written when the buffer gets
+		large, when its first line is flush_interval seconds old (from a
+		background thread), and when the writer is closed. '''
+
+	# fsync policies: never fsync, fsync when the writer is closed,
+	# or fsync after every flush of the buffer
+	FSYNC_POLICIES = ('never', 'close', 'flush')
+
+	def __init__(self, filename, flush_interval=1.0, flush_size=65536, fsync='never'):
+		if fsync not in self.FSYNC_POLICIES:
+			raise ValueError('Unknown fsync policy: %s' % fsync)
+
+		self.filename = filename
+		self.flush_interval = flush_interval
+		self.flush_size = flush_size
+		self.fsync = fsync
+
+		# the flagged purchases are appended to the file
+		self.f = open(filename, 'a')
+
+		# lines waiting to be written and their total size
+		self.buffer = []
+		self.buffer_size = 0
+		self.first_buffered = None
+
+		# the buffer and the file are shared with the thread that 
+		# flushes the old lines
+		self.lock = threading.Condition(threading.RLock())
+		self.thread = None
+
+		# number of lines written to the file
+		self.Nwritten = 0
+
+
+	def write(self, line):
+		''' Adds a line to the buffer; the buffer is flushed if it
+			is larger than flush_size, or once it is older than 
+			flush_interval '''
+		with self.lock:
+			self.buffer.append(line)
+			self.buffer_size += len(line)
+
+			if self.buffer_size >= self.flush_size or self.flush_interval <= 0:
+				self.flush()
+			elif self.first_buffered is None:
+				self.first_buffered = time.time()
+				if self.thread is None:
+					self.thread = threading.Thread(target=self.run)
+					self.thread.daemon = True
+					self.thread.start()
+				self.lock.notify()
+
+
+	def run(self):
+		''' Flushes the buffer once its first line is flush_interval 
+			seconds old, until the writer is closed '''
+		with self.lock:
+			while self.f is not None:
+				if self.first_buffered is None:
+					self.lock.wait()
+					continue
+				remaining = self.first_buffered + self.flush_interval - time.time()
+				if remaining > 0:
+					self.lock.wait(remaining)
+				else:
+					self.flush()
+
+
+	def flush(self):
+		''' Writes the buffered lines to the file '''
+		with self.lock:
+			if self.f is None:
+				return
+
+			if self.buffer:
+				self.f.write(''.join(self.buffer))
+				self.Nwritten += len(self.buffer)
+				self.buffer = []
+				self.buffer_size = 0
+			self.first_buffered = None
+			self.f.flush()
+
+			if self.fsync == 'flush':
+				os.fsync(self.f.fileno())
+
+
+	def close(self):
+		''' Flushes the buffer, closes the file and stops the thread '''
+		with self.lock:
+			if self.f is None:
+				return
+
+			self.flush()
+			if self.fsync == 'close':
+				os.fsync(self.f.fileno())
+			self.f.close()
+			self.f = None
+			self.lock.notify()
+
+		if self.thread is not None and self.thread is not threading.current_thread():
+			self.thread.join()
+
+
+	def register_exit_handlers(self, signals=(signal.SIGTERM,)):
+		''' Closes the writer when the program exits, including
+			when it is stopped by one of the given signals '''
+		atexit.register(self.close)
+
+		def handle_signal(signum, frame):
+			# exit normally so that the atexit handlers run
+			sys.exit(128 + signum)
+
+		for signum in signals:
+			try:
+				signal.signal(signum, handle_signal)
+			except ValueError:
+				# signals can only be handled in the main thread
+				pass
+
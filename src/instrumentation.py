@@ -0,0 +1,235 @@
+# python
+import atexit
+import bisect
+import json
+import os
+import signal
+import time
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class LatencyHistogram:
+	''' Histogram of latencies (seconds) in logarithmic buckets, from
+		1 microsecond to 100 seconds with 10 buckets per decade. The
+		percentiles are the upper bound of their bucket. '''
+
+	BOUNDS = [1e-6 * 10**(i/10.0) for i in range(81)]
+
+	def __init__(self):
+		# the last bucket is for latencies above the largest bound
+		self.counts = [0]*(len(self.BOUNDS)+1)
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+
+	def add(self, latency):
+		''' Records a latency '''
+		self.counts[bisect.bisect_left(self.BOUNDS, latency)] += 1
+		self.count += 1
+		self.total += latency
+		if latency > self.max:
+			self.max = latency
+
+
+	def get_percentile(self, percentile):
+		''' Returns the latency under which the given percentage
+			of the latencies are '''
+		if not self.count:
+			return 0.0
+		rank = percentile/100.0 * self.count
+		cumulative = 0
+		for i, count in enumerate(self.counts):
+			cumulative += count
+			if cumulative >= rank and count:
+				return min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max
+		return self.max
+
+
+	def to_dict(self):
+		''' Returns the summary of the histogram (milliseconds) '''
+		return {'count': self.count,
+				'mean_ms': 1000*self.total/self.count if self.count else 0.0,
+				'p50_ms': 1000*self.get_percentile(50),
+				'p95_ms': 1000*self.get_percentile(95),
+				'p99_ms': 1000*self.get_percentile(99),
+				'max_ms': 1000*self.max}
+
+
+class Timed:
+	''' Wraps a function to add its call count and time to a timer
+		([calls, seconds]) and, optionally, the size of each call's work
+		to a counter ([calls, total, max]). The size is computed from the
+		result and the arguments of the call. '''
+
+	def __init__(self, function, timer, counter=None, size=None):
+		self.function = function
+		self.timer = timer
+		self.counter = counter
+		self.size = size
+
+
+	def __call__(self, *args, **kwargs):
+		t0 = time.time()
+		result = self.function(*args, **kwargs)
+		self.timer[0] += 1
+		self.timer[1] += time.time() - t0
+
+		if self.counter is not None:
+			size = self.size(result, args)
+			counter = self.counter
+			counter[0] += 1
+			counter[1] += size
+			if size > counter[2]:
+				counter[2] = size
+		return result
+
+
+class TimedHandler:
+	''' Wraps an event handler to record its latency in a histogram '''
+
+	def __init__(self, handler, histogram):
+		self.handler = handler
+		self.histogram = histogram
+
+
+	def __call__(self, event):
+		t0 = time.time()
+		result = self.handler(event)
+		self.histogram.add(time.time() - t0)
+		return result
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class Instrumentation:
+	''' Timers, counters and latency histograms of an AnomalyDetection
+		session. The methods of the session, its social network and its
+		purchase history are wrapped when the session is instrumented, so
+		a session without instrumentation does not pay for it.
+
+		Timers: calls and time of parsing (decoding) the events, network
+		updates (add_friend/remove_friend and their incremental updates of
+		the Dth degree networks, network_update), builds of the entire
+		network (build_network), get_user_list, get_purchase_stats and
+		writing the flagged purchases (output).
+		Counters: work per query, i.e. the users of each network searched
+		(bfs_nodes) or returned (network_users), the pairs of users checked
+		by the incremental updates (pairs_checked), and the purchase history
+		entries visited for the purchase stats (purchases_scanned): the
+		users' buffers and merged purchases, or the rows masked in the
+		columnar history.
+		Latency histograms: the latency of each event type, in batch and
+		stream data. '''
+
+	def __init__(self):
+		# data structure of timers: { name: [calls, seconds], ...}
+		# data structure of counters: { name: [calls, total, max], ...}
+		# data structure of latencies: { 'data_type.event_type': LatencyHistogram, ...}
+		self.timers = {}
+		self.counters = {}
+		self.latencies = {}
+		self.started = time.time()
+
+
+	def wrap(self, obj, name, timer, counter=None, size=None):
+		''' Replaces a method of an object with a timed wrapper '''
+		timer = self.timers.setdefault(timer, [0, 0.0])
+		if counter is not None:
+			counter = self.counters.setdefault(counter, [0, 0, 0])
+		setattr(obj, name, Timed(getattr(obj, name), timer, counter, size))
+
+
+	def instrument_session(self, session):
+		''' Times the decoding of the events and the output of the
+			flagged purchases of a session '''
+		self.wrap(session, 'decode', 'parse')
+
+		open_writer = session.open_writer
+		def open_timed_writer():
+			writer = open_writer()
+			self.wrap(writer, 'write', 'output')
+			self.wrap(writer, 'flush', 'output')
+			return writer
+		session.open_writer = open_timed_writer
+
+
+	def instrument_objects(self, session):
+		''' Times the social network and purchase history of a session,
+			and counts the work of their queries '''
+		network = session.network
+		self.wrap(network, 'add_friend', 'add_friend')
+		self.wrap(network, 'remove_friend', 'remove_friend')
+		self.wrap(network, 'get_user_list', 'get_user_list', 'network_users',
+					lambda result, args: len(result))
+
+		# the breadth first searches of the network updates
+		self.wrap(network, 'compute_neighborhood', 'bfs', 'bfs_nodes',
+					lambda result, args: len(network.network.get(args[0], ())))
+		self.wrap(network, 'search_neighborhood', 'bfs', 'bfs_nodes',
+					lambda result, args: len(result))
+		self.wrap(network, 'search_levels', 'bfs', 'bfs_nodes',
+					lambda result, args: len(args[1]))
+		self.wrap(network, 'build_network', 'build_network')
+
+		# the incremental updates for new and removed relationships
+		self.wrap(network, 'add_network_relationship', 'network_update', 'pairs_checked',
+					lambda result, args: network.Npairs)
+		self.wrap(network, 'remove_network_relationship', 'network_update', 'pairs_checked',
+					lambda result, args: network.Npairs)
+
+		purchases = session.purchases
+		self.wrap(purchases, 'get_purchase_stats', 'get_purchase_stats')
+		self.wrap(purchases, 'get_last_purchases', 'get_last_purchases', 'purchases_scanned',
+					lambda result, args: purchases.Nscanned)
+
+
+	def instrument_handlers(self, session):
+		''' Records the latency of the events of each type '''
+		for data_type, handlers in session.handlers.iteritems():
+			for event_type, handler in handlers.items():
+				if not isinstance(handler, TimedHandler):
+					histogram = self.latencies.setdefault('%s.%s' %(data_type, event_type),
+															LatencyHistogram())
+					handlers[event_type] = TimedHandler(handler, histogram)
+
+
+	def to_dict(self):
+		''' Returns the timers, counters and latencies '''
+		return {'seconds': time.time() - self.started,
+				'timers': dict((name, {'calls': calls, 'seconds': seconds,
+										'mean_us': 1e6*seconds/calls if calls else 0.0})
+								for name, (calls, seconds) in self.timers.iteritems()),
+				'counters': dict((name, {'calls': calls, 'total': total, 'max': maximum,
+										'mean': float(total)/calls if calls else 0.0})
+								for name, (calls, total, maximum) in self.counters.iteritems()),
+				'latencies': dict((name, histogram.to_dict())
+									for name, histogram in self.latencies.iteritems())}
+
+
+	def dump(self, filename):
+		''' Writes the instrumentation to a JSON file; the file is
+			replaced atomically '''
+		temporary = filename + '.tmp'
+		f = open(temporary, 'w')
+		json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+		f.close()
+		os.rename(temporary, filename)
+
+
+	def register_dump(self, filename, signals=(signal.SIGUSR1,)):
+		''' Dumps the instrumentation when the program exits and when
+			it receives one of the given signals '''
+		atexit.register(self.dump, filename)
+
+		def handle_signal(signum, frame):
+			self.dump(filename)
+
+		for signum in signals:
+			try:
+				signal.signal(signum, handle_signal)
+			except ValueError:
+				# signals can only be handled in the main thread
+				pass
+
@@ -1,24 +1,164 @@
-# python 
-import sys
+# python
+import argparse
 import time
 
-# project 
+# project
 from anomaly_detection import AnomalyDetection
+from detection_server import DetectionServer
+from memory_report import MemoryReporter, format_report
+from metrics import MetricsExporter
+from snapshot import is_snapshot
 
 #-----------------------------------------------------------------------------------#
 #-----------------------------------------------------------------------------------#
 
-if len(sys.argv) < 4:
-	print 'Usage:'
-	print '  python %s <batch log file> <stream log file> <flagged purchases file>' %sys.argv[0]
-	exit()
+parser = argparse.ArgumentParser()
+parser.add_argument('batch_file', help='batch log file (may be gzip/bz2/xz compressed), '+\
+											'or a snapshot saved with --save-snapshot')
+parser.add_argument('stream_file', help='stream log file (may be gzip/bz2/xz compressed)')
+parser.add_argument('flagged_file', help='flagged purchases file')
+parser.add_argument('--save-snapshot', metavar='FILE',
+					help='save the state after the batch data is loaded')
+parser.add_argument('--retention', choices=['per_user'],
+					help='only keep the purchases that can affect the purchase stats')
+parser.add_argument('--columnar', action='store_true',
+					help='store the purchase history in compact columns')
+parser.add_argument('--lazy-network', action='store_true',
+					help='compute the Dth degree networks on demand')
+parser.add_argument('--cache-size', type=int, default=100000,
+					help='number of networks cached in lazy mode')
+parser.add_argument('--compact-network', action='store_true',
+					help='store the relationships in compact arrays')
+parser.add_argument('--network-workers', type=int, default=1,
+					help='processes used to compute the network after the batch data')
+parser.add_argument('--network-builder', choices=['auto', 'bfs', 'bitset', 'matrix'], default='auto',
+					help='strategy used to compute the network after the batch data')
+parser.add_argument('--quiet', action='store_true',
+					help='do not print each anomalous purchase')
+parser.add_argument('--follow', action='store_true',
+					help='keep following the stream log as it grows (stop with Ctrl-C)')
+parser.add_argument('--poll-interval', type=float, default=0.1,
+					help='seconds between polls of the stream log in follow mode')
+parser.add_argument('--report-interval', type=float, default=10.0,
+					help='seconds between latency reports in follow mode')
+parser.add_argument('--serve', metavar='ADDRESS',
+					help='after the batch data, serve events on HOST:PORT or a Unix socket path '+\
+							'instead of reading the stream log')
+parser.add_argument('--queue-size', type=int, default=1000,
+					help='events queued by the server before producers are pushed back')
+parser.add_argument('--decoder', default='auto',
+					help='JSON decoder of the events: auto, fast, json, or simplejson/ujson if installed')
+parser.add_argument('--batch-workers', type=int, default=1,
+					help='processes used to parse the batch log')
+parser.add_argument('--threaded-io', action='store_true',
+					help='read and decompress the logs in a background thread')
+parser.add_argument('--pipeline', action='store_true',
+					help='read and decode, detect, and write the flagged purchases in separate threads')
+parser.add_argument('--queue-depth', type=int, default=16,
+					help='chunks of decoded events queued for the detector in pipeline mode')
+parser.add_argument('--output-queue-depth', type=int, default=1024,
+					help='flagged purchases queued for the writer in pipeline mode')
+parser.add_argument('--shards', type=int, default=1,
+					help='worker processes that the users are partitioned across by connected component')
+parser.add_argument('--no-component-index', action='store_true',
+					help='check every purchase, including those in components with too few purchases')
+parser.add_argument('--instrument', metavar='FILE',
+					help='record stage timings, query counters and event latencies, '+\
+							'written as JSON to FILE at exit and on SIGUSR1')
+parser.add_argument('--slow-log', metavar='FILE',
+					help='write the stream events slower than --slow-threshold to FILE as JSON lines')
+parser.add_argument('--slow-threshold', type=float, default=10.0,
+					help='latency (milliseconds) of the events written to the slow log')
+parser.add_argument('--metrics-file', metavar='FILE',
+					help='write Prometheus metrics to FILE (e.g. for the textfile collector)')
+parser.add_argument('--metrics-address', metavar='HOST:PORT',
+					help='serve Prometheus metrics over HTTP on HOST:PORT')
+parser.add_argument('--metrics-interval', type=float, default=10.0,
+					help='seconds between updates of the metrics')
+parser.add_argument('--memory-report', metavar='FILE',
+					help='append estimates of the memory of the network and purchase history '+\
+							'to FILE as JSON lines, after the batch data and during the stream')
+parser.add_argument('--memory-report-interval', type=float, default=60.0,
+					help='seconds between memory reports during the stream (0 for none)')
+args = parser.parse_args()
+if args.columnar and args.retention:
+	parser.error('--columnar cannot be used with --retention')
+if args.shards > 1 and (args.follow or args.serve or args.pipeline or args.save_snapshot or \
+						args.memory_report or args.instrument or args.metrics_file or \
+						args.metrics_address):
+	parser.error('--shards cannot be used with --follow, --serve, --pipeline, --save-snapshot, '+\
+					'--memory-report, --instrument or --metrics-file/--metrics-address')
+if args.shards > 1 and is_snapshot(args.batch_file):
+	parser.error('--shards requires a batch log, not a snapshot')
 
 t0 = time.time()
 
-batch_file = sys.argv[1]
-stream_file = sys.argv[2]
-flagged_file = sys.argv[3]
+session = AnomalyDetection(args.batch_file, args.stream_file, args.flagged_file,
+					retention=args.retention,
+					purchase_backend='columnar' if args.columnar else 'dict',
+					lazy_network=args.lazy_network,
+					cache_size=args.cache_size,
+					compact_network=args.compact_network,
+					network_workers=args.network_workers,
+					network_builder=args.network_builder,
+					verbose=not args.quiet,
+					snapshot_file=args.save_snapshot,
+					decoder=args.decoder,
+					batch_workers=args.batch_workers,
+					threaded_io=args.threaded_io,
+					pipeline=args.pipeline,
+					queue_depth=args.queue_depth,
+					output_queue_depth=args.output_queue_depth,
+					shards=args.shards,
+					component_index=not args.no_component_index,
+					instrument=bool(args.instrument or args.metrics_file or args.metrics_address),
+					slow_log_file=args.slow_log,
+					slow_threshold=args.slow_threshold/1000.0)
+if args.instrument:
+	session.instrumentation.register_dump(args.instrument)
 
-AnomalyDetection(batch_file, stream_file, flagged_file).process()
+exporter = None
+if args.metrics_file or args.metrics_address:
+	metrics_address = None
+	if args.metrics_address:
+		host, port = args.metrics_address.rsplit(':', 1)
+		metrics_address = (host, int(port))
+	exporter = MetricsExporter(session, args.metrics_file, metrics_address, args.metrics_interval)
+	exporter.start()
+
+reporter = None
+if args.memory_report:
+	reporter = MemoryReporter(session, args.memory_report, args.memory_report_interval)
+	reporter.start()
+
+if args.serve:
+	session.analyze_batch_data()
+	if ':' in args.serve:
+		host, port = args.serve.rsplit(':', 1)
+		address = (host, int(port))
+	else:
+		address = args.serve
+	server = DetectionServer(session, address, args.queue_size)
+	server.start()
+	# the port is chosen by the system if it's 0
+	if isinstance(server.address, tuple):
+		print 'Serving events on %s:%d...' % server.address
+	else:
+		print 'Serving events on %s...' % server.address
+	if exporter:
+		exporter.add_gauge('anomaly_server_queue_depth', 'Events queued for the detector.',
+							server.events.qsize)
+	server.serve_forever()
+	session.close()
+else:
+	session.process(args.follow, args.poll_interval, args.report_interval)
+
+if exporter:
+	exporter.stop()
+
+if reporter:
+	report = reporter.stop()
+	if report and not args.quiet:
+		print '\n' + format_report(report)
 
 print '\nProcessed batch and stream in %.4f seconds.' %(time.time()-t0)
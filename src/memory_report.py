@@ -0,0 +1,246 @@
+# python
+import heapq
+import json
+import random
+import sys
+import threading
+import time
+import traceback
+
+import numpy as np
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+# The sizes are estimated with sys.getsizeof() from a random sample of
+# the entries of each structure, scaled to the number of entries. The
+# size of an entry includes its key, its container and the items in the
+# container; id strings that are shared between structures are counted
+# in each of them.
+
+
+def sample_entries(container, Nsamples, generator):
+	''' Returns the keys of a dict-like container and a sample of them '''
+	# the keys are copied at once, so the container can change meanwhile
+	keys = container.keys() if hasattr(container, 'keys') else list(container)
+	return keys, generator.sample(keys, min(Nsamples, len(keys)))
+
+
+def get_entry_size(key, value):
+	''' Returns the size (bytes) of a dict entry whose value is a
+		container of ids (e.g. a set of friends or a dict of levels) '''
+	size = sys.getsizeof(key) + sys.getsizeof(value)
+	# the items are copied at once, since the reports can run in
+	# another thread while the stream changes the containers
+	for item in list(value):
+		size += sys.getsizeof(item)
+	return size
+
+
+def estimate_dict_size(container, Nsamples=1000, generator=random, size=get_entry_size):
+	''' Returns the number of entries of a dict of containers, an estimate
+		of its size (bytes) and the sizes of the sampled containers '''
+	keys, sample = sample_entries(container, Nsamples, generator)
+	lengths = []
+	total = 0
+	for key in sample:
+		value = container.get(key)
+		if value is not None:
+			lengths.append(len(value))
+			total += size(key, value)
+	estimate = sys.getsizeof(container)
+	if sample:
+		estimate += len(keys)*total/len(sample)
+	return (len(keys), estimate, lengths)
+
+
+def estimate_interning_size(ids, names, Nsamples=1000, generator=random):
+	''' Returns an estimate of the size (bytes) of interned ids, i.e. a
+		dict of { id: int, ...} and the list of ids by int '''
+	keys, sample = sample_entries(ids, Nsamples, generator)
+	size = sys.getsizeof(ids) + sys.getsizeof(names)
+	if sample:
+		size += len(keys)*sum(sys.getsizeof(key) + sys.getsizeof(ids.get(key)) for key in sample)/len(sample)
+	return size
+
+
+def get_distribution(lengths):
+	''' Returns the distribution of sampled sizes '''
+	if not lengths:
+		return {'mean': 0, 'p50': 0, 'p90': 0, 'p99': 0, 'max': 0}
+	p50, p90, p99 = np.percentile(lengths, [50, 90, 99])
+	return {'mean': float(np.mean(lengths)), 'p50': p50, 'p90': p90, 'p99': p99,
+			'max': max(lengths)}
+
+
+def get_array_size(column):
+	''' Returns the size (bytes) of an array or numpy column '''
+	if hasattr(column, 'nbytes'):
+		return int(column.nbytes)
+	return column.buffer_info()[1]*column.itemsize
+
+
+def estimate_friends(network, Nsamples, generator):
+	''' Estimates the memory of the relationships of the network '''
+	friends = network.friends
+	if hasattr(friends, 'indptr'):
+		# compact network: CSR arrays with an overlay, and interned ids
+		overlay = 0
+		for changes in (friends.added, friends.removed):
+			overlay += estimate_dict_size(changes, Nsamples, generator)[1]
+		size = get_array_size(friends.indptr) + get_array_size(friends.indices) + overlay + \
+				estimate_interning_size(network.ids, network.names, Nsamples, generator)
+		return {'users': len(friends), 'bytes': size}
+
+	Nusers, size, lengths = estimate_dict_size(friends, Nsamples, generator)
+	return {'users': Nusers, 'bytes': size, 'friends': get_distribution(lengths)}
+
+
+def estimate_networks(network, Nsamples, Ntop, generator):
+	''' Estimates the memory of the Dth degree networks, the distribution
+		of their sizes and the users with the largest networks '''
+	networks = network.network
+	Nnetworks, size, lengths = estimate_dict_size(networks, Nsamples, generator)
+
+	# the size of each network is a single lookup, so all the users
+	# are ranked; only the largest networks are measured
+	top = []
+	for uid in heapq.nlargest(Ntop, networks.keys(), key=lambda uid: len(networks.get(uid, ()))):
+		levels = networks.get(uid)
+		if levels is not None:
+			name = network.names[uid] if hasattr(network, 'names') else uid
+			top.append({'id': name, 'network_size': len(levels),
+						'bytes': get_entry_size(uid, levels)})
+
+	return {'networks': Nnetworks, 'bytes': size, 'network_size': get_distribution(lengths),
+			'top_users': top}
+
+
+def estimate_purchases(purchases, Nsamples, generator):
+	''' Estimates the memory of the purchase history '''
+	report = {'purchases': purchases.get_number_purchases(),
+				'retained': purchases.get_number_retained()}
+	if hasattr(purchases, 'amounts'):
+		# columnar history: numpy columns and interned ids
+		report['bytes'] = sum(get_array_size(column) for column in
+								(purchases.uids, purchases.timestamps, purchases.amounts, purchases.selected)) + \
+							estimate_interning_size(purchases.ids, purchases.names, Nsamples, generator)
+	else:
+		history = estimate_dict_size(purchases.purchases, Nsamples, generator,
+										lambda key, value: purchases.get_purchase_size(value))[1]
+		# the users' buffers of (Npurchase, amount), copied at once as 
+		# in get_entry_size
+		buffers = estimate_dict_size(purchases.user_purchases, Nsamples, generator,
+										lambda key, value: sys.getsizeof(key) + sys.getsizeof(value) + \
+												sum(sys.getsizeof(entry) + sys.getsizeof(entry[0]) + \
+													sys.getsizeof(entry[1]) for entry in list(value)))[1]
+		report['bytes'] = history + buffers
+		report['history_bytes'] = history
+		report['user_buffers_bytes'] = buffers
+
+	Nevicted, reclaimed = purchases.get_memory_reclaimed()
+	report['evicted'] = Nevicted
+	report['bytes_reclaimed'] = reclaimed
+	return report
+
+
+def memory_report(session, Nsamples=1000, Ntop=10, seed=None):
+	''' Returns a report of the memory used by the social network and
+		purchase history of a session: the estimated bytes of each
+		structure, the distribution of the sizes of the Dth degree
+		networks, the Ntop users with the largest networks and the
+		purchases retained. Each structure is estimated from a sample
+		of Nsamples entries. '''
+	generator = random.Random(seed)
+	network = session.network
+	purchases = session.purchases
+	report = {'friends': estimate_friends(network, Nsamples, generator),
+				'network': estimate_networks(network, Nsamples, Ntop, generator),
+				'purchases': estimate_purchases(purchases, Nsamples, generator)}
+	report['total_bytes'] = sum(part['bytes'] for part in report.values())
+	return report
+
+
+def format_report(report):
+	''' Returns a report as text '''
+	megabytes = lambda size: size/1024.0/1024.0
+	lines = ['Memory: %.1f MB' % megabytes(report['total_bytes']),
+			'  friends:   %8.1f MB for %d users' %(megabytes(report['friends']['bytes']),
+													report['friends']['users']),
+			'  network:   %8.1f MB for %d networks, size p50 %d, p99 %d, max %d' \
+							%(megabytes(report['network']['bytes']), report['network']['networks'],
+								report['network']['network_size']['p50'],
+								report['network']['network_size']['p99'],
+								report['network']['network_size']['max']),
+			'  purchases: %8.1f MB for %d retained of %d purchases' \
+							%(megabytes(report['purchases']['bytes']), report['purchases']['retained'],
+								report['purchases']['purchases'])]
+	for user in report['network']['top_users']:
+		lines.append('    user %s: network of %d users, %.1f KB' \
+						%(user['id'], user['network_size'], user['bytes']/1024.0))
+	return '\n'.join(lines)
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class MemoryReporter:
+	''' Writes memory reports of a session as JSON lines: once the batch
+		data is loaded, then every interval seconds from a background
+		thread while the stream is processed, and when stopped. '''
+
+	def __init__(self, session, filename, interval=60.0, Nsamples=1000, Ntop=10):
+		self.session = session
+		self.filename = filename
+		self.interval = interval
+		self.Nsamples = Nsamples
+		self.Ntop = Ntop
+
+		self.stopped = threading.Event()
+		self.thread = None
+
+
+	def start(self):
+		''' Starts reporting once the batch data is loaded '''
+		self.session.loaded_listeners.append(self.batch_loaded)
+
+
+	def batch_loaded(self):
+		''' Reports the memory after the batch data, then periodically '''
+		self.report('batch')
+		if self.interval and not self.stopped.is_set():
+			self.thread = threading.Thread(target=self.run)
+			self.thread.daemon = True
+			self.thread.start()
+
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			# a failed report does not stop the later ones
+			try:
+				self.report('stream')
+			except Exception:
+				traceback.print_exc()
+
+
+	def stop(self):
+		''' Stops the reports; returns the final report, if the batch
+			data was loaded '''
+		self.stopped.set()
+		if self.batch_loaded in self.session.loaded_listeners:
+			self.session.loaded_listeners.remove(self.batch_loaded)
+		if self.thread:
+			self.thread.join()
+		if self.session.network:
+			return self.report('end')
+
+
+	def report(self, label):
+		''' Appends a report to the file and returns it '''
+		report = memory_report(self.session, self.Nsamples, self.Ntop)
+		report['time'] = time.time()
+		report['label'] = label
+		f = open(self.filename, 'a')
+		f.write(json.dumps(report, sort_keys=True) + '\n')
+		f.close()
+		return report
+
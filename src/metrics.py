@@ -0,0 +1,220 @@
+# python
+import BaseHTTPServer
+import os
+import random
+import sys
+import threading
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class MetricsExporter:
+	''' Exports the operating metrics of an AnomalyDetection session in
+		the Prometheus text format. The metrics are rendered in a
+		background thread every interval seconds, and written atomically
+		to a textfile (for the node exporter's textfile collector) and/or
+		served on a local HTTP endpoint. The HTTP server only returns the
+		last rendered text, so scrapes do not touch the session.
+
+		The metrics are:
+			- the events processed by data and event type, and their
+			  latency histograms (from the session's instrumentation),
+			- the flagged purchases,
+			- the users of the network and the purchases of the history,
+			- the cached networks and an estimate of their memory,
+			- the depth of the queues of the pipeline and of any gauges
+			  added with add_gauge() (e.g. the detection server's queue).
+		In sharded mode, the network and purchase history are in the
+		shards' processes and are not exported. '''
+
+	def __init__(self, session, textfile=None, address=None, interval=10.0):
+		self.session = session
+		self.textfile = textfile
+		self.address = address
+		self.interval = interval
+
+		# flagged purchases, counted by a listener of the session
+		self.Nflagged = 0
+		session.flagged_listeners.append(self.count_flagged)
+
+		# other gauges: [(name, help, function), ...]
+		self.gauges = []
+
+		# the last rendered metrics
+		self.text = ''
+
+		self.stopped = threading.Event()
+		self.thread = None
+		self.server = None
+
+
+	def count_flagged(self, line):
+		self.Nflagged += 1
+
+
+	def add_gauge(self, name, help, function):
+		''' Adds a gauge whose value is returned by a function '''
+		self.gauges.append((name, help, function))
+
+
+	def start(self):
+		''' Starts rendering the metrics, and serving them if an
+			address is given; port 0 picks a free port '''
+		self.update()
+		if self.address:
+			self.server = BaseHTTPServer.HTTPServer(self.address, MetricsHandler)
+			self.server.exporter = self
+			self.address = self.server.server_address
+			thread = threading.Thread(target=self.server.serve_forever)
+			thread.daemon = True
+			thread.start()
+
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+
+	def stop(self):
+		''' Stops the exporter after writing the final metrics '''
+		self.stopped.set()
+		if self.thread:
+			self.thread.join()
+		if self.server:
+			self.server.shutdown()
+			self.server.server_close()
+		self.update()
+		self.session.flagged_listeners.remove(self.count_flagged)
+
+
+	def run(self):
+		''' Renders the metrics every interval seconds '''
+		while not self.stopped.wait(self.interval):
+			self.update()
+
+
+	def update(self):
+		''' Renders the metrics and writes them to the textfile '''
+		self.text = self.render()
+		if self.textfile:
+			temporary = self.textfile + '.tmp'
+			f = open(temporary, 'w')
+			f.write(self.text)
+			f.close()
+			os.rename(temporary, self.textfile)
+
+
+	def render(self):
+		''' Returns the metrics in the Prometheus text format '''
+		session = self.session
+		lines = []
+
+		def metric(name, kind, help, samples):
+			lines.append('# HELP %s %s' %(name, help))
+			lines.append('# TYPE %s %s' %(name, kind))
+			for labels, value in samples:
+				lines.append('%s%s %s' %(name, labels, format_value(value)))
+
+		latencies = {}
+		if session.instrumentation:
+			latencies = dict(session.instrumentation.latencies)
+
+		events = []
+		for key in sorted(latencies):
+			data_type, event_type = key.split('.', 1)
+			events.append(('{data_type="%s",event_type="%s"}' %(data_type, event_type),
+							latencies[key].count))
+		metric('anomaly_events_total', 'counter', 'Events processed.', events)
+		metric('anomaly_stream_events_total', 'counter', 'Stream events processed.',
+				[('', session.Nstream)])
+		metric('anomaly_flagged_purchases_total', 'counter', 'Anomalous purchases flagged.',
+				[('', self.Nflagged)])
+
+		network = session.network
+		purchases = session.purchases
+		if not session.sharded and hasattr(network, 'friends'):
+			metric('anomaly_network_users', 'gauge', 'Users in the social network.',
+					[('', network.get_number_users())])
+			metric('anomaly_purchases', 'gauge', 'Purchases added to the purchase history.',
+					[('', purchases.get_number_purchases())])
+			metric('anomaly_purchases_retained', 'gauge', 'Purchases kept in the purchase history.',
+					[('', purchases.get_number_retained())])
+			Nnetworks, size = estimate_networks_size(network.network)
+			metric('anomaly_cached_networks', 'gauge', 'Dth degree networks kept in memory.',
+					[('', Nnetworks)])
+			metric('anomaly_cached_networks_bytes', 'gauge',
+					'Estimated memory of the Dth degree networks (sampled).', [('', size)])
+
+		pipeline = session.current_pipeline
+		if pipeline:
+			metric('anomaly_pipeline_queue_depth', 'gauge', 'Items queued between the pipeline stages.',
+					[('{queue="events"}', pipeline.events.qsize()),
+					('{queue="output"}', pipeline.lines.qsize())])
+		if session.writer and hasattr(session.writer, 'buffer'):
+			metric('anomaly_writer_buffered_lines', 'gauge', 'Flagged purchases waiting to be written.',
+					[('', len(session.writer.buffer))])
+		for name, help, function in self.gauges:
+			metric(name, 'gauge', help, [('', function())])
+
+		if latencies:
+			name = 'anomaly_event_latency_seconds'
+			lines.append('# HELP %s Latency of the events.' % name)
+			lines.append('# TYPE %s histogram' % name)
+			for key in sorted(latencies):
+				data_type, event_type = key.split('.', 1)
+				labels = 'data_type="%s",event_type="%s"' %(data_type, event_type)
+				histogram = latencies[key]
+				counts = list(histogram.counts)
+				# two buckets per decade
+				cumulative = 0
+				for i, bound in enumerate(histogram.BOUNDS):
+					cumulative += counts[i]
+					if i % 5 == 0:
+						lines.append('%s_bucket{%s,le="%s"} %d' %(name, labels, format_value(bound), cumulative))
+				lines.append('%s_bucket{%s,le="+Inf"} %d' %(name, labels, sum(counts)))
+				lines.append('%s_sum{%s} %s' %(name, labels, format_value(histogram.total)))
+				lines.append('%s_count{%s} %d' %(name, labels, sum(counts)))
+
+		return '\n'.join(lines) + '\n'
+
+
+def format_value(value):
+	''' Formats a sample value '''
+	if isinstance(value, float):
+		return '%.9g' % value
+	return str(value)
+
+
+def estimate_networks_size(networks, Nsamples=100):
+	''' Returns the number of networks in a dict of networks and an
+		estimate of their memory (bytes) from a sample of them '''
+	# the keys are copied at once, so the dict can change meanwhile
+	users = networks.keys()
+	if not users:
+		return (0, 0)
+	size = 0
+	sample = random.sample(users, min(Nsamples, len(users)))
+	for uid in sample:
+		levels = networks.get(uid)
+		if levels is not None:
+			size += sys.getsizeof(levels)
+	return (len(users), len(users)*size/len(sample))
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	''' Serves the last rendered metrics '''
+
+	def do_GET(self):
+		text = self.server.exporter.text
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4')
+		self.send_header('Content-Length', str(len(text)))
+		self.end_headers()
+		self.wfile.write(text)
+
+
+	def log_message(self, format, *args):
+		# the scrapes are not logged
+		pass
+
@@ -0,0 +1,173 @@
+# python
+import random
+from binascii import unhexlify
+
+import numpy as np
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+# Builders of the Dth degree network of every user at once. A breadth
+# first search from every user recomputes the same paths over and over:
+# the networks of two friends mostly overlap. Instead, the users within k
+# of a user are the user and the users within k-1 of its friends, so the
+# networks are built level by level from the previous level's sets:
+#   - bitset: the sets are Python ints over interned ids, and each level
+#     is one OR of big ints per relationship,
+#   - matrix: the sets are the rows of a dense boolean matrix, and each
+#     level is a matrix product with the adjacency matrix (small graphs).
+# The level of a user in a network is the first level that reaches it, as
+# in SocialNetwork.compute_neighborhood.
+
+STRATEGIES = ('auto', 'bfs', 'bitset', 'matrix')
+
+# the dense matrices take Nusers^2 bytes (x4 for the products)
+MATRIX_MAX_USERS = 4096
+
+# the bitsets of two levels take Nusers^2/4 bytes
+BITSET_MAX_USERS = 32768
+
+# estimated costs (seconds) of the operations of each strategy, measured
+# with benchmarks.builder
+BFS_NODE_COST = 2.5e-6			# visiting a user in a search
+BFS_FRIEND_COST = 3e-8			# adding a friend to the next level
+BITSET_OR_COST = 2e-7			# OR of two bitsets, per relationship
+BITSET_BYTE_COST = 1e-9			# per byte of the ORs
+EXTRACT_COST = 5e-6				# converting a bitset or row to ids
+EXTRACT_BYTE_COST = 3e-8		# per byte of the bitsets or rows
+OUTPUT_COST = 1.5e-7			# adding a user to a network
+MATRIX_FLOP_COST = 1e-10		# per multiply-add of the matrix products
+
+
+def intern_friends(friends):
+	''' Returns the users of a friends network and their friends as
+		lists of dense integer ids (the positions in users) '''
+	users = list(friends)
+	index = dict((uid, i) for i, uid in enumerate(users))
+	adjacency = [[index[node] for node in friends[uid]] for uid in users]
+	return users, adjacency
+
+
+def sample_searches(adjacency, D, Nsamples=32, generator=random):
+	''' Searches the Dth degree networks of a sample of the users and
+		returns the mean number of users they reach and the mean
+		number of friends they add to the next levels '''
+	sample = generator.sample(xrange(len(adjacency)), min(Nsamples, len(adjacency)))
+	Nreached = 0
+	Nfriends = 0
+	for source in sample:
+		seen = set([source])
+		thislevel = [source]
+		for level in xrange(D):
+			nextlevel = []
+			for node in thislevel:
+				Nfriends += len(adjacency[node])
+				for friend in adjacency[node]:
+					if friend not in seen:
+						seen.add(friend)
+						nextlevel.append(friend)
+			thislevel = nextlevel
+		Nreached += len(seen) - 1
+	Nsamples = max(1, len(sample))
+	return (float(Nreached)/Nsamples, float(Nfriends)/Nsamples)
+
+
+def estimate_costs(adjacency, D, workers=1, Nsamples=32, generator=random):
+	''' Returns the estimated time (seconds) of building the networks
+		with each strategy: { strategy: seconds, ...}. The searches
+		are shared by the given number of processes. '''
+	Nusers = len(adjacency)
+	Nedges = sum(len(friends) for friends in adjacency)
+	Nreached, Nfriends = sample_searches(adjacency, D, Nsamples, generator)
+	Nbytes = Nusers/8 + 1
+
+	output = Nusers*Nreached*OUTPUT_COST
+	extract = D*Nusers*(EXTRACT_COST + Nbytes*EXTRACT_BYTE_COST)
+	costs = {'bfs': Nusers*(Nreached*BFS_NODE_COST + Nfriends*BFS_FRIEND_COST)/workers}
+	if Nusers <= BITSET_MAX_USERS:
+		costs['bitset'] = D*Nedges*(BITSET_OR_COST + Nbytes*BITSET_BYTE_COST) + extract + output
+	if Nusers <= MATRIX_MAX_USERS:
+		costs['matrix'] = D*Nusers**3*MATRIX_FLOP_COST + extract + output
+	return costs
+
+
+def choose_strategy(friends, D, workers=1, Nsamples=32, generator=random):
+	''' Returns the cheapest strategy to build the Dth degree networks
+		of a friends network '''
+	if D < 2 or len(friends) < 2:
+		# the networks are the friends
+		return 'bfs'
+	costs = estimate_costs(intern_friends(friends)[1], D, workers, Nsamples, generator)
+	return min(sorted(costs), key=costs.get)
+
+
+def get_bits(bitset, Nbytes):
+	''' Returns the positions of the bits set in a Python int '''
+	# the hex digits are big endian, the first bit is the highest
+	bits = np.unpackbits(np.frombuffer(unhexlify('%0*x' %(2*Nbytes, bitset)), dtype=np.uint8))
+	return 8*Nbytes - 1 - np.flatnonzero(bits)
+
+
+def build_bitset(friends, D):
+	''' Builds the Dth degree networks with bitsets of the users within
+		each level: { id1: { id2: level, ...}, ...} '''
+	users, adjacency = intern_friends(friends)
+	names = np.empty(len(users), dtype=object)
+	names[:] = users
+	Nbytes = len(users)/8 + 1
+
+	network = dict((uid, {}) for uid in users)
+	reached = [1 << i for i in xrange(len(users))]
+	for level in xrange(1, D+1):
+		nextreached = []
+		for i, previous in enumerate(reached):
+			bitset = previous
+			for friend in adjacency[i]:
+				bitset |= reached[friend]
+			nextreached.append(bitset)
+
+			# the users first reached at this level
+			new = bitset & ~previous
+			if new:
+				network[users[i]].update(dict.fromkeys(names[get_bits(new, Nbytes)].tolist(), level))
+		reached = nextreached
+
+	return network
+
+
+def build_matrix(friends, D):
+	''' Builds the Dth degree networks with products of dense boolean
+		matrices: { id1: { id2: level, ...}, ...} '''
+	users, adjacency = intern_friends(friends)
+	names = np.empty(len(users), dtype=object)
+	names[:] = users
+	Nusers = len(users)
+
+	rows = np.repeat(np.arange(Nusers), [len(nodes) for nodes in adjacency])
+	columns = np.array([node for nodes in adjacency for node in nodes], dtype=np.intp)
+	A = np.zeros((Nusers, Nusers), dtype=np.float32)
+	A[rows, columns] = 1
+
+	network = dict((uid, {}) for uid in users)
+	reached = np.eye(Nusers, dtype=np.bool_)
+	for level in xrange(1, D+1):
+		nextreached = np.dot(reached.astype(np.float32), A) > 0
+		nextreached |= reached
+		new = nextreached & ~reached
+		for i in np.flatnonzero(new.any(axis=1)):
+			network[users[i]].update(dict.fromkeys(names[np.flatnonzero(new[i])].tolist(), level))
+		reached = nextreached
+
+	return network
+
+
+BUILDERS = {'bitset': build_bitset, 'matrix': build_matrix}
+
+
+def build_neighborhoods(friends, D, strategy):
+	''' Builds the Dth degree network of every user of a friends network
+		with the given strategy (bitset or matrix) '''
+	if strategy not in BUILDERS:
+		raise ValueError('Unknown network builder: %s' % strategy)
+	return BUILDERS[strategy](friends, D)
+
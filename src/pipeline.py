@@ -0,0 +1,159 @@
+# python
+import Queue
+import threading
+
+# project
+from event_reader import read_lines
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+# marker in the output queue to flush the flagged purchases file
+FLUSH = object()
+
+
+class Pipeline:
+	''' Processes the events of a batch/stream file in three stages,
+		joined by bounded queues:
+			1. reading (and decompressing) the file and decoding the events,
+			2. updating the network and purchase history, and checking
+				for anomalies,
+			3. writing the flagged purchases.
+		The first and last stages run in background threads, so reading,
+		decompressing and writing overlap with the detection. Each queue
+		has a single producer and a single consumer, so the events are
+		processed and the flagged purchases written in the order of the
+		file. A stage blocks while the queue after it is full. '''
+
+	def __init__(self, session, queue_depth=16, output_queue_depth=1024, chunk_size=512):
+		self.session = session
+
+		# the decoded events are passed in chunks of up to chunk_size
+		# events; at most queue_depth chunks wait for the detector
+		self.events = Queue.Queue(queue_depth)
+		self.chunk_size = chunk_size
+
+		# flagged purchase lines waiting to be written
+		self.lines = Queue.Queue(output_queue_depth)
+
+		# the writer of the flagged purchases, opened on the first anomaly
+		self.writer = None
+
+		self.stopped = False
+		self.error = None
+
+
+	def run(self, f, data_type):
+		''' Processes the events of a file as batch or stream data '''
+		session = self.session
+		self.writer = session.writer
+		reader = self.start(self.read_events, f)
+		writer = self.start(self.write_lines)
+
+		# the pipeline stands in for the session's writer
+		session.writer = self
+		try:
+			self.detect(data_type)
+		finally:
+			self.stop(reader)
+			self.lines.put(None)
+			writer.join()
+			session.writer = self.writer
+
+		if self.error:
+			raise self.error
+
+
+	def start(self, target, *args):
+		''' Starts a stage in a background thread '''
+		thread = threading.Thread(target=target, args=args)
+		thread.daemon = True
+		thread.start()
+		return thread
+
+
+	def stop(self, reader):
+		''' Stops the reader stage '''
+		self.stopped = True
+		# unblock the reader if the queue is full
+		while reader.is_alive():
+			try:
+				self.events.get_nowait()
+			except Queue.Empty:
+				pass
+			reader.join(0.01)
+
+
+	def read_events(self, f):
+		''' Stage 1: reads and decodes the events of the file in chunks;
+			None ends the events '''
+		decode = self.session.decode
+		chunk = []
+		try:
+			for line in read_lines(f, self.session.block_size):
+				if self.stopped:
+					return
+				line = line.strip()
+				if line:
+					chunk.append(decode(line))
+					if len(chunk) >= self.chunk_size:
+						self.events.put(chunk)
+						chunk = []
+			if chunk:
+				self.events.put(chunk)
+			self.events.put(None)
+		except Exception as error:
+			# the events before the error are processed first
+			if chunk:
+				self.events.put(chunk)
+			self.events.put(error)
+
+
+	def detect(self, data_type):
+		''' Stage 2: processes the decoded events in order '''
+		handlers = self.session.handlers[data_type]
+		while True:
+			chunk = self.events.get()
+			if chunk is None:
+				break
+			if isinstance(chunk, Exception):
+				raise chunk
+
+			for event in chunk:
+				handler = handlers.get(event['event_type'])
+				if handler:
+					handler(event)
+
+
+	def write_lines(self):
+		''' Stage 3: writes the flagged purchases in order; None ends
+			the lines '''
+		while True:
+			line = self.lines.get()
+			if line is None:
+				break
+			if self.error:
+				# the remaining lines are dropped after an error
+				continue
+
+			try:
+				if line is FLUSH:
+					self.writer.flush()
+				else:
+					self.writer.write(line)
+			except Exception as error:
+				self.error = error
+
+
+	def write(self, line):
+		''' Queues a flagged purchase for the writer stage '''
+		if self.writer is None:
+			self.writer = self.session.open_writer()
+		self.lines.put(line)
+
+
+	def flush(self):
+		''' Queues a flush of the flagged purchases file '''
+		if self.writer:
+			self.lines.put(FLUSH)
+
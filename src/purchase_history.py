@@ -1,5 +1,8 @@
 # python
+import heapq
 import numpy as np
+import sys
+from collections import deque
 
 #-----------------------------------------------------------------------------------#
 #-----------------------------------------------------------------------------------#
@@ -8,7 +11,7 @@ class PurchaseHistory:
 	''' The purchase history stores the purchases for 
 		individual users in the self.purchases attribtute '''
 
-	def __init__(self, T):
+	def __init__(self, T, retention=None):
 		# purchases history 
 		# data structure for purchases: { Npurchase: (id, timestamp, amount), ...}
 		# This data structure is optimized for returning the last T purchases 
@@ -19,11 +22,38 @@ class PurchaseHistory:
 		# number of consecutive purchases to be considered 
 		self.T = int(T)
 
+		# the last T purchases of each user
+		# data structure for user purchases: { id: deque([(Npurchase, amount), ...]), ...}
+		# Each deque is bounded to T entries, so finding the last T purchases 
+		# for a group of users only depends on the size of the group and T,
+		# not on the length of the purchase history.
+		self.user_purchases = {}
+
 		# track the number of purchases to keep them in order;
 		# many purchases have the same timestamp; this also allows 
 		# for no sort when accessing the last T purchases 
 		self.Npurchase = 0
 
+		# retention of the purchases history; by default every purchase is
+		# kept. With 'per_user' retention a purchase is dropped from the 
+		# history once it is no longer one of the last T purchases of its 
+		# user, since it can no longer affect any purchase stats.
+		if retention not in (None, 'per_user'):
+			raise ValueError('Unknown purchase retention: %s' % retention)
+		self.retention = retention
+
+		# lowest Npurchase that may still be in the history 
+		self.Nfirst = 0
+
+		# keep track of the purchases dropped from the history and an 
+		# estimate of the memory that was reclaimed (bytes)
+		self.Nevicted = 0
+		self.bytes_reclaimed = 0
+
+		# entries visited by the last query of the last purchases: the 
+		# users' buffers looked up and the purchases merged from them 
+		self.Nscanned = 0
+
 
 	def add_purchase(self, purchase):
 		''' Adds a purcahse to a users history. Purchases come in 
@@ -35,7 +65,18 @@ class PurchaseHistory:
 
 		# ensure all the data exists 
 		if timestamp and uid and amount:
-			self.purchases[self.Npurchase] = (uid, timestamp, float(amount))
+			amount = float(amount)
+			self.purchases[self.Npurchase] = (uid, timestamp, amount)
+
+			# keep the last T purchases of the user 
+			if uid not in self.user_purchases:
+				self.user_purchases[uid] = deque(maxlen=self.T)
+			history = self.user_purchases[uid]
+
+			# the oldest purchase of the user is pushed out of a full buffer
+			if self.retention == 'per_user' and len(history) == history.maxlen and history:
+				self.evict_purchase(history[0][0])
+			history.append((self.Npurchase, amount))
 
 			# increment the number of purchases 
 			self.Npurchase += 1
@@ -52,28 +93,7 @@ class PurchaseHistory:
 		if self.T < 2: 
 			return (0, 0, 0)
 		
-		purchases = []
-		n = 0
-
-		# The purchases are pre-sorted by the order in which they 
-		# come in from the batch/stream. This can be verified by looking 
-		# at the timestamps. Using this, all we need to do to get the last 
-		# T purchases for the given group of users is start with the most
-		# recent purchases and check if it's by one of the users. Getting 
-		# the purchase stats is at best O(T) and at worst O(n), where n is 
-		# the number of purchases and T is the cutoff.
-		for i in range(self.Npurchase):
-			# only T purchases are needed 
-			if n > self.T-1:
-				break 
-
-			# newer purchases have larger Npurchase ids -> use (Npurchase-1)-i
-			uid, timestamp, amount = self.purchases[self.Npurchase-1-i]
-
-			# we only interested in purchases from the users given
-			if uid in users:
-				purchases.append(amount)
-				n += 1
+		purchases = self.get_last_purchases(users)
 
 		# ensure that the number of purchases are >2 and <T
 		if not len(purchases)>2 and len(purchases)<=self.T:
@@ -85,6 +105,88 @@ class PurchaseHistory:
 		return (mean, sd, len(purchases))
 
 
+	def get_last_purchases(self, users):
+		''' Returns the amounts of the last T purchases made by 
+			the given users, newest first '''
+
+		# Each user's purchases are pre-sorted by the order in which they
+		# come in from the batch/stream, so the last T purchases of the group
+		# is a k-way merge of the users' buffers, starting with the most recent
+		# purchase of each user. Getting the purchases is O(n + T*log(n)),
+		# where n is the number of users and T is the cutoff.
+		heap = []
+		for uid in users:
+			if uid in self.user_purchases:
+				history = self.user_purchases[uid]
+				if history:
+					Npurchase, amount = history[-1]
+					# heapq is a min-heap -> use -Npurchase so newer purchases pop first
+					heap.append((-Npurchase, amount, history, len(history)-1))
+		heapq.heapify(heap)
+
+		purchases = []
+		while heap and len(purchases) < self.T:
+			Npurchase, amount, history, i = heapq.heappop(heap)
+			purchases.append(amount)
+
+			# move on to the user's next most recent purchase
+			if i > 0:
+				Npurchase, amount = history[i-1]
+				heapq.heappush(heap, (-Npurchase, amount, history, i-1))
+
+		self.Nscanned = len(users) + len(purchases)
+		return purchases
+
+
+	def evict_purchase(self, Npurchase):
+		''' Drops a purchase from the history and records 
+			the memory that was reclaimed '''
+		purchase = self.purchases.pop(Npurchase, None)
+		if purchase:
+			self.Nevicted += 1
+			self.bytes_reclaimed += self.get_purchase_size(purchase)
+
+
+	def drop_purchases_before(self, Nlow):
+		''' Drops every purchase older than the low-water mark Nlow
+			from the history and the users' buffers. Returns the 
+			memory reclaimed (bytes) by the call. '''
+		reclaimed = self.bytes_reclaimed
+
+		# purchases are keyed by their consecutive Npurchase
+		for Npurchase in xrange(self.Nfirst, min(Nlow, self.Npurchase)):
+			self.evict_purchase(Npurchase)
+		self.Nfirst = max(self.Nfirst, Nlow)
+
+		# the users' buffers are ordered, so drop from the oldest end 
+		for uid in self.user_purchases.keys():
+			history = self.user_purchases[uid]
+			while history and history[0][0] < Nlow:
+				history.popleft()
+			if not history:
+				del self.user_purchases[uid]
+
+		return self.bytes_reclaimed - reclaimed
+
+
+	def get_purchase_size(self, purchase):
+		''' Estimates the memory (bytes) used by a purchase in the history;
+			includes the tuple, its items and the Npurchase key '''
+		return sys.getsizeof(purchase) + sys.getsizeof(0) + \
+				sum(sys.getsizeof(item) for item in purchase)
+
+
+	def get_memory_reclaimed(self):
+		''' Returns the number of purchases dropped from the history
+			and the estimated memory (bytes) that was reclaimed '''
+		return (self.Nevicted, self.bytes_reclaimed)
+
+
+	def get_number_retained(self):
+		''' Returns the number of purchases kept in the history '''
+		return len(self.purchases)
+
+
 	def get_number_purchases(self):
 		''' Returns the number of purchases in the history '''
 		return self.Npurchase
@@ -94,5 +196,17 @@ class PurchaseHistory:
 			purchases to be considered '''
 		self.T = T
 
+		# rebuild the per-user buffers with the new bound; purchases that 
+		# were already dropped by the retention cannot be recovered
+		self.user_purchases = {}
+		for Npurchase in sorted(self.purchases):
+			uid, timestamp, amount = self.purchases[Npurchase]
+			if uid not in self.user_purchases:
+				self.user_purchases[uid] = deque(maxlen=self.T)
+			history = self.user_purchases[uid]
+			if self.retention == 'per_user' and len(history) == history.maxlen and history:
+				self.evict_purchase(history[0][0])
+			history.append((Npurchase, amount))
+
 
 
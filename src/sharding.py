@@ -0,0 +1,372 @@
+# python
+import heapq
+import json
+import multiprocessing
+from collections import deque
+
+# project
+from component_index import ComponentIndex
+from compressed_io import open_log
+from event_reader import read_lines
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class ShardedDetection:
+	''' Runs the detection of an AnomalyDetection session in worker
+		processes (shards) that each own a part of the users.
+
+		The users are partitioned by connected component: a user's Dth
+		degree network never leaves its component, so the purchase stats
+		of every purchase are computed by the shard that owns its user.
+		The coordinator (this object) keeps the components in a ComponentIndex
+		without a network, which joins the components of befriend events
+		and never splits them, so a component stays together in a shard. 
+		It routes each event to the shard of its
+		users and numbers the purchases, so that every shard orders its
+		purchases as a single process would.
+
+		A befriend event between components of different shards moves the
+		smaller component, with its relationships, networks and recent
+		purchases, to the shard of the larger one before the event is
+		routed. The events are sent to the shards in rounds of up to
+		round_size events, and the flagged purchases of a round are merged
+		in the order of their purchases before they are written. '''
+
+	def __init__(self, session, Nshards, round_size=4096):
+		self.session = session
+		self.Nshards = Nshards
+		self.round_size = round_size
+
+		# connections to the shard processes
+		self.connections = []
+		self.processes = []
+
+		# the users' components and the shard that owns each of them
+		# data structure of owners: { component: shard, ...}
+		self.components = ComponentIndex()
+		self.owners = {}
+
+		# number of users owned by each shard
+		self.loads = [0]*Nshards
+
+		# events waiting to be sent to each shard: [(Npurchase, event), ...]
+		self.pending = [[] for shard in range(Nshards)]
+		self.Npending = 0
+
+		# the purchases are numbered by the coordinator
+		self.Npurchase = 0
+
+		# number of components moved between shards
+		self.Nmoved = 0
+
+
+	def start(self):
+		''' Starts the shard processes; each inherits a copy of the 
+			session, with its empty social network and purchase history '''
+		for shard in range(self.Nshards):
+			connection, shard_connection = multiprocessing.Pipe()
+			process = multiprocessing.Process(target=run_shard,
+								args=(self.session, shard_connection))
+			process.daemon = True
+			process.start()
+			self.connections.append(connection)
+			self.processes.append(process)
+
+
+	def stop(self):
+		''' Stops the shard processes '''
+		for connection in self.connections:
+			connection.send(('stop', None))
+		for process in self.processes:
+			process.join()
+		self.connections = []
+		self.processes = []
+
+
+	def load_batch(self):
+		''' Loads the batch data into the shards. The components of the
+			batch data are found first and spread over the shards, largest
+			first, so that no component is moved while loading. '''
+		session = self.session
+		f = open_log(session.batch_file, session.threaded_io, session.block_size)
+
+		# the first line contains the degree (D) and number of
+		# tracked purchases (T)
+		params = json.loads(f.readline().strip())
+		session.initialize_objects(params)
+		self.start()
+
+		decode = session.decode
+		events = [decode(line) for line in read_lines(f, session.block_size) if line.strip()]
+		f.close()
+
+		components = self.components
+		for event in events:
+			if event['event_type'] == 'befriend' and event.get('id1') and event.get('id2'):
+				components.add_relationship(event['id1'], event['id2'])
+			else:
+				for key in ('id', 'id1', 'id2'):
+					if event.get(key):
+						components.add_user(event[key])
+
+		# each component goes to the least loaded shard
+		members = components.members
+		loads = [(0, shard) for shard in range(self.Nshards)]
+		for component in sorted(members, key=lambda component: len(members[component]), reverse=True):
+			load, shard = heapq.heappop(loads)
+			self.set_owner(component, shard)
+			heapq.heappush(loads, (load + len(members[component]), shard))
+
+		for event in events:
+			self.route_event(event, 'batch')
+		self.flush('batch')
+
+		# generate the Dth degree networks in every shard
+		self.call_shards('update', None)
+
+
+	def process_events(self, f, data_type):
+		''' Routes the events of a file to the shards '''
+		decode = self.session.decode
+		for line in read_lines(f, self.session.block_size):
+			line = line.strip()
+			if line:
+				self.route_event(decode(line), data_type)
+		self.flush(data_type)
+
+
+	def process_event(self, event, data_type):
+		''' Processes a single event in its shard '''
+		self.route_event(event, data_type)
+		self.flush(data_type)
+
+
+	def route_event(self, event, data_type):
+		''' Queues an event for the shard that owns its users '''
+		event_type = event['event_type']
+		Npurchase = None
+		if event_type == 'purchase':
+			shard = self.get_shard(event.get('id'))
+			Npurchase = self.Npurchase
+			self.Npurchase += 1
+		elif event_type == 'befriend':
+			shard = self.join(event.get('id1'), event.get('id2'), data_type)
+		elif event_type == 'unfriend':
+			shard = self.get_shard(event.get('id1') or event.get('id2'))
+		else:
+			# other event types are handled by the coordinator's
+			# handlers, after the events before them
+			handler = self.session.handlers[data_type].get(event_type)
+			if handler:
+				self.flush(data_type)
+				handler(event)
+			return
+
+		if data_type == 'stream':
+			self.session.Nstream += 1
+		self.pending[shard].append((Npurchase, event))
+		self.Npending += 1
+		if self.Npending >= self.round_size:
+			self.flush(data_type)
+
+
+	def flush(self, data_type):
+		''' Sends the pending events to the shards, and writes the flagged
+			purchases of the shards in the order of their purchases '''
+		shards = [shard for shard in range(self.Nshards) if self.pending[shard]]
+		for shard in shards:
+			self.connections[shard].send(('events', (data_type, self.pending[shard])))
+			self.pending[shard] = []
+		self.Npending = 0
+
+		# each shard returns its flagged purchases in order
+		flagged = [self.connections[shard].recv() for shard in shards]
+		session = self.session
+		for Npurchase, line in heapq.merge(*flagged):
+			session.get_writer().write(line)
+			for listener in session.flagged_listeners:
+				listener(line)
+
+
+	def call_shards(self, command, args):
+		''' Sends a command to every shard and returns their replies '''
+		for connection in self.connections:
+			connection.send((command, args))
+		return [connection.recv() for connection in self.connections]
+
+
+	def set_owner(self, component, shard):
+		''' Assigns a component to a shard '''
+		self.owners[component] = shard
+		self.loads[shard] += len(self.components.members[component])
+
+
+	def get_shard(self, uid):
+		''' Returns the shard that owns a user; new users go to the least
+			loaded shard. Events with incomplete data go to the first shard. '''
+		if not uid:
+			return 0
+		component = self.components.add_user(uid)
+		if component not in self.owners:
+			self.set_owner(component, self.loads.index(min(self.loads)))
+		return self.owners[component]
+
+
+	def join(self, id1, id2, data_type):
+		''' Joins the components of a befriend event in one shard and
+			returns the shard '''
+		if not (id1 and id2):
+			return 0
+		shard1 = self.get_shard(id1)
+		shard2 = self.get_shard(id2)
+		components = self.components
+		component1 = components.get_component(id1)
+		component2 = components.get_component(id2)
+		if component1 == component2:
+			return shard1
+
+		if shard1 != shard2:
+			# move the smaller component to the shard of the larger one
+			if len(components.members[component1]) < len(components.members[component2]):
+				component1, component2, shard1, shard2 = component2, component1, shard2, shard1
+			self.move(component2, shard2, shard1, data_type)
+
+		component = components.add_relationship(id1, id2)
+		self.owners.pop(component1)
+		self.owners.pop(component2)
+		self.owners[component] = shard1
+		return shard1
+
+
+	def move(self, component, source, target, data_type):
+		''' Moves a component between shards, after the pending events '''
+		self.flush(data_type)
+		users = list(self.components.members[component])
+		self.connections[source].send(('export', users))
+		state = self.connections[source].recv()
+		self.connections[target].send(('import', state))
+		self.connections[target].recv()
+
+		self.owners[component] = target
+		self.loads[source] -= len(users)
+		self.loads[target] += len(users)
+		self.Nmoved += 1
+
+
+	def get_number_users(self):
+		''' Returns the number of users in the shards' networks '''
+		return sum(users for users, purchases in self.call_shards('stats', None))
+
+
+	def get_number_purchases(self):
+		''' Returns the number of purchases in the shards' histories '''
+		return sum(purchases for users, purchases in self.call_shards('stats', None))
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class ShardOutput:
+	''' Stands in for the writer of a shard's session: keeps the flagged
+		purchases with the number of their purchase '''
+
+	def __init__(self):
+		self.Npurchase = None
+		self.lines = []
+
+	def write(self, line):
+		self.lines.append((self.Npurchase, line))
+
+	def flush(self):
+		pass
+
+
+def run_shard(session, connection):
+	''' Runs a shard in a worker process with its copy of the session,
+		until the coordinator stops it '''
+	session.flagged_listeners = []
+	session.verbose = False
+	output = ShardOutput()
+	session.writer = output
+
+	while True:
+		command, args = connection.recv()
+		if command == 'events':
+			data_type, events = args
+			handlers = session.handlers[data_type]
+			for Npurchase, event in events:
+				if Npurchase is not None:
+					# the purchases are numbered by the coordinator
+					session.purchases.Npurchase = Npurchase
+					output.Npurchase = Npurchase
+				handler = handlers.get(event['event_type'])
+				if handler:
+					handler(event)
+			connection.send(output.lines)
+			output.lines = []
+
+		elif command == 'update':
+			session.network.update_network()
+			session.build_component_index()
+			connection.send(None)
+
+		elif command == 'export':
+			connection.send(export_users(session, args))
+
+		elif command == 'import':
+			import_users(session, args)
+			connection.send(None)
+
+		elif command == 'stats':
+			purchases = session.purchases
+			connection.send((session.network.get_number_users(),
+								len(purchases.purchases) + purchases.Nevicted))
+
+		else:
+			break
+	connection.close()
+
+
+def export_users(session, users):
+	''' Removes the relationships, networks and recent purchases of
+		a component from a shard and returns them '''
+	network = session.network
+	purchases = session.purchases
+	if session.components:
+		session.components.remove_users(users)
+	state = {'friends': {}, 'network': {}, 'purchases': {}}
+	for uid in users:
+		if uid in network.friends:
+			state['friends'][uid] = network.friends.pop(uid)
+		if uid in network.network:
+			state['network'][uid] = network.network.pop(uid)
+		if uid in purchases.user_purchases:
+			# older purchases stay behind, since only the last T
+			# purchases of a user can affect the purchase stats
+			state['purchases'][uid] = [(Npurchase, amount, purchases.purchases.pop(Npurchase, None)) \
+											for Npurchase, amount in purchases.user_purchases.pop(uid)]
+	return state
+
+
+def import_users(session, state):
+	''' Adds the relationships, networks and recent purchases of
+		a component to a shard '''
+	network = session.network
+	purchases = session.purchases
+	network.friends.update(state['friends'])
+	network.network.update(state['network'])
+	for uid, history in state['purchases'].iteritems():
+		purchases.user_purchases[uid] = deque([(Npurchase, amount) for Npurchase, amount, purchase in history],
+												maxlen=purchases.T)
+		for Npurchase, amount, purchase in history:
+			if purchase:
+				purchases.purchases[Npurchase] = purchase
+
+	if session.components:
+		for uid, friends in state['friends'].iteritems():
+			session.components.add_user(uid)
+			for friend in friends:
+				session.components.add_relationship(uid, friend)
+		for uid, history in state['purchases'].iteritems():
+			session.components.add_purchase(uid, len(history))
+
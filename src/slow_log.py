@@ -0,0 +1,114 @@
+# python
+import json
+import time
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class SlowEventLog:
+	''' Log of the stream events that take longer than a threshold
+		(seconds). Each slow event is written as a line of JSON with:
+			- the event and its latency,
+			- the size of the Dth degree networks of its users, after the event,
+			- the number of network searches (BFS) the event triggered
+			  and the users they visited, and the pairs of users checked
+			  by the incremental update of the networks,
+			- the purchase history entries scanned for the purchase stats.
+		The searches and scans are counted by the session's
+		instrumentation; the network sizes are only looked up for the
+		slow events, and are read without touching the statistics or
+		the cache of the networks. '''
+
+	def __init__(self, session, filename, threshold=0.01):
+		self.session = session
+		self.filename = filename
+		self.threshold = threshold
+
+		# the slow events are appended to the file
+		self.f = open(filename, 'a')
+
+		# number of events logged
+		self.Nslow = 0
+
+
+	def instrument_handlers(self):
+		''' Times the stream events of the session '''
+		handlers = self.session.handlers['stream']
+		for event_type, handler in handlers.items():
+			if not isinstance(handler, SlowEventHandler):
+				handlers[event_type] = SlowEventHandler(handler, self)
+
+
+	def get_counts(self):
+		''' Returns the current number of network searches, users visited,
+			pairs of users checked and purchases scanned '''
+		instrumentation = self.session.instrumentation
+		timers = instrumentation.timers
+		counters = instrumentation.counters
+		return (timers.get('bfs', (0, 0))[0],
+				counters.get('bfs_nodes', (0, 0))[1],
+				counters.get('pairs_checked', (0, 0))[1],
+				counters.get('purchases_scanned', (0, 0))[1])
+
+
+	def get_neighborhoods(self, event):
+		''' Returns the size of the Dth degree network of each user of an
+			event. The networks are read directly, so the query statistics
+			are not changed; in lazy mode a network that is not cached is
+			not computed, and its size is None. '''
+		network = self.session.network
+		# the compact network stores the networks by integer id
+		ids = getattr(network, 'ids', None)
+		neighborhoods = {}
+		for key in ('id', 'id1', 'id2'):
+			uid = event.get(key)
+			if uid:
+				levels = network.network.get(ids.get(uid) if ids is not None else uid)
+				if levels is not None:
+					neighborhoods[uid] = len(levels)
+				else:
+					neighborhoods[uid] = None if network.lazy else 0
+		return neighborhoods
+
+
+	def log(self, event, latency, counts):
+		''' Writes a slow event with the counts of its work '''
+		searches, nodes, pairs, scanned = [after - before for after, before in zip(self.get_counts(), counts)]
+		record = {'time': time.time(),
+					'latency_ms': 1000*latency,
+					'event': event,
+					'neighborhoods': self.get_neighborhoods(event),
+					'bfs_searches': searches,
+					'bfs_nodes': nodes,
+					'pairs_checked': pairs,
+					'purchases_scanned': scanned}
+		self.f.write(json.dumps(record, sort_keys=True) + '\n')
+		self.f.flush()
+		self.Nslow += 1
+
+
+	def close(self):
+		''' Closes the log file '''
+		if self.f:
+			self.f.close()
+			self.f = None
+
+
+class SlowEventHandler:
+	''' Wraps an event handler to log the events that are slow '''
+
+	def __init__(self, handler, log):
+		self.handler = handler
+		self.log = log
+
+
+	def __call__(self, event):
+		log = self.log
+		counts = log.get_counts()
+		t0 = time.time()
+		result = self.handler(event)
+		latency = time.time() - t0
+		if latency > log.threshold:
+			log.log(event, latency, counts)
+		return result
+
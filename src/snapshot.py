@@ -0,0 +1,302 @@
+# python
+import numpy as np
+import struct
+from array import array
+from collections import deque
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+# The snapshot of the social network and purchase history is a binary file:
+#   magic (6 bytes) + version (uint16) + number of sections (uint32) + padding
+# followed by the sections. Each section is a named array:
+#   name (8 bytes) + dtype (4 bytes) + length (uint64) + padding + data
+# The data of each section is aligned to 8 bytes so that the arrays can be
+# used directly from the memory-mapped file.
+SNAPSHOT_MAGIC = 'ADSNAP'
+SNAPSHOT_VERSION = 1
+
+HEADER = struct.Struct('<6sHI4x')
+SECTION = struct.Struct('<8s4sQ')
+
+
+def is_snapshot(filename):
+	''' Checks if a file is a snapshot '''
+	try:
+		f = open(filename, 'rb')
+	except IOError:
+		return False
+	magic = f.read(len(SNAPSHOT_MAGIC))
+	f.close()
+	return magic == SNAPSHOT_MAGIC
+
+
+def save_snapshot(filename, network, purchases):
+	''' Saves the social network and purchase history to a snapshot '''
+	names = StringTable()
+
+	# parameters: D, T, Npurchase, Nfirst, Nevicted, bytes reclaimed and
+	# whether the Dth degree networks are saved (not in lazy mode)
+	params = [network.D, purchases.T, purchases.Npurchase, purchases.Nfirst,
+				purchases.Nevicted, purchases.bytes_reclaimed, int(not network.lazy)]
+
+	# the relationships and Dth degree networks are saved as CSR
+	# arrays over the user ids
+	friends = network_items(network, network.friends)
+	friends_ptr, friends_idx = [0], []
+	for uid, friends_uid in friends:
+		friends_idx.extend(names.get(friend) for friend in friends_uid)
+		friends_ptr.append(len(friends_idx))
+
+	levels_ptr, levels_idx, levels = [0], [], []
+	if not network.lazy:
+		for uid, friends_uid in friends:
+			levels_uid = network.network.get(network_key(network, uid), {})
+			for node, level in network_items(network, levels_uid):
+				levels_idx.append(names.get(node))
+				levels.append(level)
+			levels_ptr.append(len(levels_idx))
+
+	# the purchases that are kept, with timestamps from a table
+	timestamps = StringTable()
+	columns = ([], [], [], [])
+	for Npurchase, uid, timestamp, amount in purchase_items(purchases):
+		for column, value in zip(columns, (Npurchase, names.get(uid), timestamps.get(timestamp), amount)):
+			column.append(value)
+
+	sections = [
+		('params', np.array(params, dtype='<i8')),
+		('users', np.array([names.get(uid) for uid, friends_uid in friends], dtype='<i4')),
+		('frndptr', np.array(friends_ptr, dtype='<i8')),
+		('frndidx', np.array(friends_idx, dtype='<i4')),
+		('lvlptr', np.array(levels_ptr, dtype='<i8')),
+		('lvlidx', np.array(levels_idx, dtype='<i4')),
+		('levels', np.array(levels, dtype='<u1')),
+		('seq', np.array(columns[0], dtype='<i8')),
+		('buyer', np.array(columns[1], dtype='<i4')),
+		('time', np.array(columns[2], dtype='<i4')),
+		('amount', np.array(columns[3], dtype='<f8'))]
+	sections.extend(names.get_sections('name'))
+	sections.extend(timestamps.get_sections('time'))
+
+	f = open(filename, 'wb')
+	f.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(sections)))
+	for name, values in sections:
+		f.write(SECTION.pack(name, values.dtype.str.ljust(4), len(values)))
+		f.write(padding(f.tell()))
+		f.write(values.tostring())
+		f.write(padding(f.tell()))
+	f.close()
+
+
+def load_snapshot(filename, session):
+	''' Loads a snapshot into an AnomalyDetection session; the social
+		network and purchase history are created with the session's
+		options. The arrays are read from the memory-mapped file. '''
+	sections = read_sections(filename)
+
+	D, T, Npurchase, Nfirst, Nevicted, bytes_reclaimed, has_levels = \
+			sections['params'].tolist()
+
+	# the columnar history keeps the purchases Nfirst, Nfirst+1, ... in
+	# consecutive rows; a dict history with per_user retention has gaps
+	seq = sections['seq']
+	if session.purchase_backend == 'columnar' and \
+			(len(seq) != Npurchase - Nfirst or (len(seq) and seq[0] != Nfirst)):
+		raise ValueError('%s has gaps in the purchase numbers (per_user retention) '
+							'and cannot be loaded into the columnar history' % filename)
+
+	session.initialize_objects({'D': D, 'T': T})
+	network = session.network
+	purchases = session.purchases
+
+	names = read_strings(sections, 'name')
+	load_network(network, names, sections, has_levels)
+
+	timestamps = read_strings(sections, 'time')
+	load_purchases(purchases, names, timestamps, sections)
+	purchases.Npurchase = Npurchase
+	purchases.Nfirst = Nfirst
+	purchases.Nevicted = Nevicted
+	purchases.bytes_reclaimed = bytes_reclaimed
+
+
+def load_network(network, names, sections, has_levels):
+	''' Fills the social network from the snapshot arrays '''
+	users = sections['users']
+	friends_ptr = sections['frndptr']
+	friends_idx = sections['frndidx']
+
+	if hasattr(network, 'names'):
+		# compact network: the CSR arrays are used as they are,
+		# with the user ids in the order of the snapshot
+		network.names = [names[i] for i in users.tolist()]
+		network.ids = dict((uid, i) for i, uid in enumerate(network.names))
+		network.friends.Nusers = len(network.names)
+
+		# the friends are stored with snapshot ids -> map them to graph ids
+		graph_ids = np.zeros(len(names), dtype='<i4')
+		graph_ids[users] = np.arange(len(users), dtype='<i4')
+		indices = graph_ids[friends_idx]
+
+		# the friends of each user must be sorted by graph id (see 
+		# CompactGraph.has_edge); a snapshot of a dict network keeps 
+		# them in set order
+		rows = np.repeat(np.arange(len(users)), np.diff(friends_ptr))
+		indices = indices[np.lexsort((indices, rows))]
+		network.friends.indptr = array('i', friends_ptr.astype('<i4').tostring())
+		network.friends.indices = array('i', indices.astype('<i4').tostring())
+		keys = range(len(users))
+	else:
+		friends_idx = friends_idx.tolist()
+		for i, uid in enumerate(users.tolist()):
+			network.friends[names[uid]] = set(names[j] for j in friends_idx[friends_ptr[i]:friends_ptr[i+1]])
+		keys = [names[uid] for uid in users.tolist()]
+
+	if not has_levels:
+		network.update_network()
+		return
+	if network.lazy:
+		return
+
+	levels_ptr = sections['lvlptr'].tolist()
+	levels = sections['levels'].tolist()
+	if hasattr(network, 'names'):
+		levels_idx = graph_ids[sections['lvlidx']].tolist()
+	else:
+		levels_idx = [names[j] for j in sections['lvlidx'].tolist()]
+	for i, uid in enumerate(keys):
+		lo = levels_ptr[i]
+		hi = levels_ptr[i+1]
+		network.network[uid] = dict(zip(levels_idx[lo:hi], levels[lo:hi]))
+
+
+def load_purchases(purchases, names, timestamps, sections):
+	''' Fills the purchase history from the snapshot arrays '''
+	seq = sections['seq']
+	buyers = sections['buyer']
+	times = sections['time']
+	amounts = sections['amount']
+
+	if hasattr(purchases, 'amounts'):
+		# columnar purchase history: copy the columns, mapping the
+		# user ids and timestamps through their tables
+		purchases.grow(max(len(seq), 1024))
+		uids = np.zeros(len(names), dtype=np.int32)
+		for i in np.unique(buyers).tolist():
+			uids[i] = purchases.intern(names[i])
+		epochs = np.array([purchases.parse_timestamp(timestamp) for timestamp in timestamps],
+							dtype=np.int64)
+		purchases.uids[:len(seq)] = uids[buyers]
+		purchases.timestamps[:len(seq)] = epochs[times]
+		purchases.amounts[:len(seq)] = amounts
+		purchases.Nrows = len(seq)
+		return
+
+	for Npurchase, uid, timestamp, amount in zip(seq.tolist(), buyers.tolist(),
+													times.tolist(), amounts.tolist()):
+		uid = names[uid]
+		purchases.purchases[Npurchase] = (uid, timestamps[timestamp], amount)
+		if uid not in purchases.user_purchases:
+			purchases.user_purchases[uid] = deque(maxlen=purchases.T)
+		purchases.user_purchases[uid].append((Npurchase, amount))
+
+
+def read_sections(filename):
+	''' Returns the arrays of a snapshot: { name: array, ...}. The arrays
+		are views of the memory-mapped file. '''
+	data = np.memmap(filename, dtype=np.uint8, mode='r')
+	magic, version, Nsections = HEADER.unpack(data[:HEADER.size].tostring())
+	if magic != SNAPSHOT_MAGIC:
+		raise ValueError('%s is not a snapshot' % filename)
+	if version != SNAPSHOT_VERSION:
+		raise ValueError('Unsupported snapshot version %d in %s' %(version, filename))
+
+	sections = {}
+	offset = HEADER.size
+	for i in range(Nsections):
+		name, dtype, length = SECTION.unpack(data[offset:offset+SECTION.size].tostring())
+		offset += SECTION.size
+		offset += len(padding(offset))
+		dtype = np.dtype(dtype.strip())
+		if length:
+			sections[name.rstrip('\0')] = np.frombuffer(data, dtype, length, offset)
+		else:
+			sections[name.rstrip('\0')] = np.zeros(0, dtype)
+		offset += length*dtype.itemsize
+		offset += len(padding(offset))
+	return sections
+
+
+def read_strings(sections, name):
+	''' Returns the table of strings saved in a section '''
+	ptr = sections[name+'ptr'].tolist()
+	text = sections[name+'dat'].tostring()
+	return [text[ptr[i]:ptr[i+1]].decode('utf-8') for i in range(len(ptr)-1)]
+
+
+def padding(offset):
+	''' Returns the padding that aligns an offset to 8 bytes '''
+	return '\0' * (-offset % 8)
+
+
+def network_key(network, uid):
+	''' Returns the key of a user in the network's dicts '''
+	if hasattr(network, 'ids'):
+		return network.ids[uid]
+	return uid
+
+
+def network_items(network, values):
+	''' Returns the (user id, value) pairs of a dict or graph keyed by the
+		network's keys; compact networks use integer keys '''
+	if hasattr(network, 'names'):
+		if isinstance(values, dict):
+			return [(network.names[i], value) for i, value in values.iteritems()]
+		# friends graph: the values are integer ids of the friends
+		return [(network.names[i], [network.names[j] for j in values[i]]) for i in values]
+	return list(values.items())
+
+
+def purchase_items(purchases):
+	''' Returns the (Npurchase, id, timestamp, amount) of each purchase
+		kept in the purchase history, in order '''
+	if hasattr(purchases, 'amounts'):
+		for i in range(purchases.Nrows):
+			Npurchase = purchases.Nfirst + i
+			uid, timestamp, amount = purchases.get_purchase(Npurchase)
+			yield (Npurchase, uid, timestamp, amount)
+	else:
+		for Npurchase in sorted(purchases.purchases):
+			uid, timestamp, amount = purchases.purchases[Npurchase]
+			yield (Npurchase, uid, timestamp, amount)
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class StringTable:
+	''' Table of strings that assigns an integer to each string '''
+
+	def __init__(self):
+		self.ids = {}
+		self.names = []
+
+	def get(self, name):
+		''' Returns the integer of a string, adding it if needed '''
+		if name not in self.ids:
+			self.ids[name] = len(self.names)
+			self.names.append(name)
+		return self.ids[name]
+
+	def get_sections(self, name):
+		''' Returns the sections that store the table: the offsets of
+			the strings and the utf-8 encoded text '''
+		ptr = [0]
+		text = []
+		for string in self.names:
+			string = string.encode('utf-8')
+			text.append(string)
+			ptr.append(ptr[-1] + len(string))
+		return [(name+'ptr', np.array(ptr, dtype='<i8')),
+				(name+'dat', np.array(bytearray(''.join(text)), dtype='<u1'))]
+
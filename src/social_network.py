@@ -1,4 +1,28 @@
 # python 
+import multiprocessing
+from collections import OrderedDict
+
+# project
+from neighborhood_builder import STRATEGIES, build_neighborhoods, choose_strategy
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+# the social network searched by the worker processes of a parallel update; 
+# it is set before the workers are started so that they inherit it
+worker_network = None
+
+def search_neighborhoods(sources):
+	''' Searches the Dth degree network of each source user 
+		in a worker process '''
+	return [(uid, worker_network.search_neighborhood(uid, worker_network.D)) for uid in sources]
+
+def get_cumulative_counts(groups):
+	''' Returns the number of items in the first k groups, for each k '''
+	counts = [0]
+	for group in groups:
+		counts.append(counts[-1] + len(group))
+	return counts
 
 #-----------------------------------------------------------------------------------#
 #-----------------------------------------------------------------------------------#
@@ -7,7 +31,7 @@ class SocialNetwork:
 	''' The social network stores the relationships between 
 		users as well as their Dth degree networks. '''
 
-	def __init__(self, D):
+	def __init__(self, D, lazy=False, cache_size=100000, workers=1, builder='auto'):
 		# initialize the friends network 
 		# keys are user ids and the values are set() of the users
 		# data structure of friends network: { id1 : set(id2,...), ...}
@@ -23,6 +47,30 @@ class SocialNetwork:
 		# initialize the degree of the network 
 		self.D = int(D)
 
+		# In lazy mode, a user's Dth degree network is only computed the 
+		# first time it is needed. The networks are then kept in a least 
+		# recently used cache of at most cache_size users, and changes to 
+		# the relationships only invalidate the affected users.
+		self.lazy = lazy
+		self.cache_size = cache_size
+		if self.lazy:
+			self.network = OrderedDict()
+
+		# number of processes used to compute the entire network 
+		self.workers = workers
+
+		# strategy used to compute the entire network: a search from 
+		# every user ('bfs'), or built level by level from the friends' 
+		# networks ('bitset', 'matrix'); 'auto' picks the cheapest from 
+		# the density of the network and D (see neighborhood_builder)
+		if builder not in STRATEGIES:
+			raise ValueError('Unknown network builder: %s' % builder)
+		self.builder = builder
+
+		# pairs of users checked by the last incremental update of the 
+		# network for a new or removed relationship 
+		self.Npairs = 0
+
 
 	def add_friend(self, befriend, update_needed=False):
 		''' adds a relationship between 2 users in the network '''
@@ -32,6 +80,9 @@ class SocialNetwork:
 
 		# ensure all the data exists 
 		if id1 and id2:		
+			# a relationship that already exists does not change the network 
+			is_new = not self.are_friends(id1, id2)
+
 			if id1 in self.friends:
 				# add id2 to the set() of friends for id1
 				self.friends[id1].add(id2)
@@ -51,19 +102,62 @@ class SocialNetwork:
 			# versus stream data; network dosnt need to be updated until 
 			# all batch data is added, whereas the network has to be 
 			# updated in real-time with stream data
-			if update_needed:
-				# get the list of users for id1 and id2 that
-				# are within D-1 of the them. The Dth users 
-				# will not be affected by the new relationship;
-				# use a set to eliminate repeats
-				users = self.get_user_list(id1, self.D-1)
-				users.update(self.get_user_list(id2, self.D-1))
-				users.update([id1,id2])
-				self.update_network(users)
+			if update_needed and is_new:
+				if self.lazy:
+					self.invalidate_cache(id1, id2)
+				else:
+					self.add_network_relationship(id1, id2)
 		else:
 			print 'Befriend event has incomplete data.'
 
 
+	def add_network_relationship(self, id1, id2):
+		''' Updates the Dth degree network for a new relationship 
+			between id1 and id2. Instead of recomputing the network of 
+			every affected user, only the levels that get shorter through
+			the new relationship are changed. '''
+
+		# D must be gte 1 
+		if self.D < 1:
+			return False
+
+		# A new shortest path between users x and y that uses the new 
+		# relationship goes x -> id1 -> id2 -> y (or the reverse), so its 
+		# level is level(x, id1) + 1 + level(id2, y). Only users within 
+		# D-1 of id1 and id2 can be affected. The levels to id1 and id2
+		# are copied first since they are updated in the loop. 
+		levels1 = self.get_levels(id1, self.D-1)
+		levels2 = self.get_levels(id2, self.D-1)
+
+		# group the users near id2 by their level so that only pairs 
+		# within the Dth degree are checked
+		users2 = [[] for level in range(self.D)]
+		for y, level in levels2.iteritems():
+			users2[level].append(y)
+		Nusers2 = get_cumulative_counts(users2)
+
+		Npairs = 0
+		for x, level1 in levels1.iteritems():
+			Npairs += Nusers2[self.D-level1]
+			if x not in self.network:
+				self.network[x] = {}
+			network_x = self.network[x]
+
+			for level2 in range(self.D-level1):
+				level = level1 + 1 + level2
+				for y in users2[level2]:
+					if y != x and network_x.get(y, self.D+1) > level:
+						# relationships are bi-directional
+						network_x[y] = level
+						if y not in self.network:
+							self.network[y] = {x: level}
+						else:
+							self.network[y][x] = level
+
+		self.Npairs = Npairs
+		return True
+
+
 	# def remove_friend(self, id1, id2, update_needed=False):
 	def remove_friend(self, unfriend, update_needed=False):
 		''' removes the relationship between 2 users 
@@ -95,21 +189,103 @@ class SocialNetwork:
 
 			# update the Dth degree network if needed 
 			if friend_removed and update_needed:
-				# get the list of users for id1 and id2 that
-				# are within D-1 of the them. The Dth users 
-				# will not be affected by the removed relationship
-				users = self.get_user_list(id1, self.D-1)
-				users.update(self.get_user_list(id2, self.D-1))
-				users.update([id1,id2])
-				self.update_network(users)
+				if self.lazy:
+					self.invalidate_cache(id1, id2)
+				else:
+					self.remove_network_relationship(id1, id2)
 		else:
 			print 'Unfriend event has incomplete data.'
 
 
+	def remove_network_relationship(self, id1, id2):
+		''' Updates the Dth degree network after the relationship 
+			between id1 and id2 was removed. Only the pairs of users
+			whose shortest path could have used the relationship are
+			searched again. '''
+
+		# D must be gte 1 
+		if self.D < 1:
+			return False
+
+		# The level of users x and y can only change if a shortest path 
+		# went x -> id1 -> id2 -> y (or the reverse), i.e. if their level
+		# is level(x, id1) + 1 + level(id2, y). The stored levels are from
+		# before the relationship was removed. 
+		levels1 = self.get_levels(id1, self.D-1)
+		levels2 = self.get_levels(id2, self.D-1)
+
+		users2 = [[] for level in range(self.D)]
+		for y, level in levels2.iteritems():
+			users2[level].append(y)
+		Nusers2 = get_cumulative_counts(users2)
+
+		# affected pairs for each user: { x: set(y, ...), ...}
+		affected = {}
+		Npairs = 0
+		for x, level1 in levels1.iteritems():
+			Npairs += Nusers2[self.D-level1]
+			network_x = self.network.get(x, {})
+			for level2 in range(self.D-level1):
+				level = level1 + 1 + level2
+				for y in users2[level2]:
+					if network_x.get(y) == level:
+						affected.setdefault(x, set()).add(y)
+						affected.setdefault(y, set()).add(x)
+
+		for x, targets in affected.iteritems():
+			self.search_levels(x, targets)
+
+		self.Npairs = Npairs
+		return True
+
+
+	def search_levels(self, source, targets):
+		''' Recomputes the levels between the source and a set of target
+			users, assuming the levels to all other users are correct.
+			Targets that are no longer within D of the source are removed 
+			from its network. '''
+		network_source = self.network[source]
+
+		# the first estimate of a target's level comes from its friends 
+		# that are not targets, whose level is known
+		nextlevels = [[] for level in range(self.D+2)]
+		for y in targets:
+			best = self.D + 1
+			for node in self.friends[y]:
+				if node == source:
+					best = 1
+					break
+				if node not in targets:
+					level = network_source.get(node)
+					if level is not None and level+1 < best:
+						best = level + 1
+			nextlevels[best].append(y)
+
+		# then the levels are spread between the targets in increasing 
+		# order of level, as in a breadth first search
+		levels = {}
+		for level in range(1, self.D+1):
+			for y in nextlevels[level]:
+				if y not in levels:
+					levels[y] = level
+					for node in self.friends[y]:
+						if node in targets and node not in levels:
+							nextlevels[level+1].append(node)
+
+		# relationships are bi-directional
+		for y in targets:
+			if y in levels:
+				network_source[y] = levels[y]
+				self.network[y][source] = levels[y]
+			else:
+				network_source.pop(y, None)
+				self.network[y].pop(source, None)
+
+
 	def are_friends(self, id1, id2):
 		''' checks if id2 is id1's friend '''
 		# ensure the users are in the network
-		if id1 and id2 in self.friends:
+		if id1 in self.friends:
 			if id2 in self.friends[id1]:
 				return True
 		return False
@@ -124,10 +300,29 @@ class SocialNetwork:
 		if self.D < 1:
 			return False
 
+		# in lazy mode, the networks are recomputed when they are needed 
+		if self.lazy:
+			if len(specific_users):
+				for uid in specific_users:
+					self.network.pop(uid, None)
+			else:
+				self.network.clear()
+			return True
+
 		# if specific users given, only update their network
 		if len(specific_users):
 			for uid in specific_users:
 				self.compute_neighborhood(uid, self.D)
+			return True
+
+		builder = self.builder
+		if builder == 'auto':
+			builder = choose_strategy(self.friends, self.D, self.workers)
+
+		if builder != 'bfs':
+			self.build_network(builder)
+		elif self.workers > 1:
+			self.update_network_parallel()
 		else:
 			# update the entire network 
 			for uid in self.friends:
@@ -136,6 +331,36 @@ class SocialNetwork:
 		return True
 
 
+	def build_network(self, builder):
+		''' Computes the Dth degree network of every user at once 
+			with a builder that reuses the networks of the friends '''
+		self.network = build_neighborhoods(self.friends, self.D, builder)
+
+
+	def update_network_parallel(self):
+		''' Updates the Dth degree network for every user in the network 
+			with a pool of worker processes. Each worker searches the 
+			networks of a partition of the users; the searches only read 
+			the friends network. '''
+		global worker_network
+
+		users = list(self.friends)
+		Nchunks = 4*self.workers
+		chunks = [users[i::Nchunks] for i in range(Nchunks)]
+
+		# the workers are forked after the network is set, 
+		# so the friends network is not sent to them
+		worker_network = self
+		pool = multiprocessing.Pool(self.workers)
+		try:
+			for levels in pool.imap_unordered(search_neighborhoods, chunks):
+				self.network.update(levels)
+		finally:
+			pool.close()
+			pool.join()
+			worker_network = None
+
+
 	def compute_neighborhood(self, source, cutoff):
 		''' Computes all the neighbors within some cutoff distance
 			of a given source node.  '''
@@ -179,10 +404,90 @@ class SocialNetwork:
 			level += 1
 
 
+	def search_neighborhood(self, source, cutoff):
+		''' Returns all the neighbors within some cutoff distance
+			of a given source node with their level, without 
+			changing the network: { id2: level, ...} '''
+		levels = {}
+		if source not in self.friends:
+			return levels
+
+		level = 1
+		thislevel = self.friends[source]
+		while thislevel and level <= cutoff:
+			nextlevel = set([])
+			for node in thislevel:
+				if (node != source) and (node not in levels):
+					levels[node] = level
+					# only new nodes are searched at the next level
+					nextlevel.update(self.friends[node])
+			thislevel = nextlevel
+			level += 1
+
+		return levels
+
+
+	def get_cached_network(self, uid):
+		''' Returns the Dth degree network of a user in lazy mode. 
+			The network is computed if it is not in the cache, and the 
+			least recently used network is dropped if the cache is full. '''
+		if uid in self.network:
+			# move the user to the most recently used end
+			levels = self.network.pop(uid)
+		else:
+			if self.D < 1:
+				return {}
+			levels = self.search_neighborhood(uid, self.D)
+		self.network[uid] = levels
+
+		while len(self.network) > self.cache_size:
+			self.network.popitem(last=False)
+
+		return levels
+
+
+	def invalidate_cache(self, id1, id2):
+		''' Drops the cached networks that a change of the relationship 
+			between id1 and id2 can affect. Only the networks of users 
+			within D-1 of id1 or id2 are affected; since the levels are 
+			symmetric, they are the users within D-1 in the networks of 
+			id1 and id2, so only those networks are read. '''
+		affected = set([id1, id2])
+		for uid in (id1, id2):
+			levels = self.network.get(uid)
+			if levels is None:
+				# the relationship is already changed: after a befriend the 
+				# search finds more users, and after an unfriend the users 
+				# only reached through it are within D-2 of the other user 
+				levels = self.search_neighborhood(uid, self.D-1)
+			affected.update(id3 for id3, level in levels.iteritems() if level < self.D)
+
+		for uid in affected:
+			self.network.pop(uid, None)
+
+
+	def get_levels(self, uid, cutoff):
+		''' Returns the users within a cutoff degree of the given
+			user, including the user itself, with their level:
+			{ id2: level, ...} '''
+		levels = {uid: 0}
+		if uid in self.network:
+			for id2, level in self.network[uid].iteritems():
+				if level <= cutoff:
+					levels[id2] = level
+		return levels
+
+
 	def get_user_list(self, uid, cutoff=None):
 		''' Returns the list of users in the given user's 
 			Dth degree network. If a cutoff is given, then
 			only users within a certain degree are returned.'''
+		if self.lazy:
+			levels = self.get_cached_network(uid)
+			if cutoff:
+				return set(id2 for id2 in levels if levels[id2] <= cutoff)
+			return set(levels)
+
 		if uid in self.network:
 			if cutoff:
 				# only return users with a degree <= cutoff
@@ -201,7 +506,7 @@ class SocialNetwork:
 		''' Allows to set the degree of the network and 
 			updates the Dth degree network '''
 		self.D = D 
-		self.network = {}
+		self.network = OrderedDict() if self.lazy else {}
 		self.update_network()
 
 
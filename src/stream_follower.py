@@ -0,0 +1,104 @@
+# python
+import os
+import time
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+class StreamFollower:
+	''' Follows a log file that is continuously appended to, like
+		tail -F. New lines are found by polling, and the file is
+		reopened when it is rotated (renamed or truncated). '''
+
+	def __init__(self, filename, poll_interval=0.1):
+		self.filename = filename
+		self.poll_interval = poll_interval
+
+		self.f = None
+		self.inode = None
+		self.stopped = False
+
+		# number of times the file was rotated
+		self.Nrotations = 0
+
+
+	def open(self):
+		''' Opens the file; waits for it to exist '''
+		while self.f is None and not self.stopped:
+			try:
+				self.f = open(self.filename)
+				self.inode = os.fstat(self.f.fileno()).st_ino
+			except IOError:
+				time.sleep(self.poll_interval)
+
+
+	def close(self):
+		if self.f:
+			self.f.close()
+			self.f = None
+
+
+	def stop(self):
+		''' Stops following the file after the current poll '''
+		self.stopped = True
+
+
+	def rotated(self):
+		''' Checks if the file was rotated: the filename points to a new
+			file, or the file was truncated '''
+		try:
+			stat = os.stat(self.filename)
+		except OSError:
+			# the file is being rotated
+			return False
+		if stat.st_ino != self.inode:
+			return True
+		if stat.st_size < self.f.tell():
+			return True
+		return False
+
+
+	def read_lines(self):
+		''' Yields (line, arrival time) for each complete line, and
+			(None, None) each time there is no new data to read. The
+			arrival time of lines found after waiting is estimated from
+			the modification time of the file. '''
+		self.open()
+		partial = ''
+		# time the end of the file was last reached
+		last_eof = None
+
+		while not self.stopped:
+			line = self.f.readline()
+			if line:
+				partial += line
+				# lines without a newline are still being written
+				if partial.endswith('\n'):
+					now = time.time()
+					arrival = now
+					if last_eof is not None:
+						modified = os.fstat(self.f.fileno()).st_mtime
+						arrival = max(last_eof, min(now, modified))
+					yield (partial, arrival)
+					partial = ''
+				continue
+
+			if self.rotated():
+				# finish the old file before opening the new one
+				for line in self.f.read().splitlines(True):
+					partial += line
+					if partial.endswith('\n'):
+						yield (partial, time.time())
+						partial = ''
+				self.close()
+				self.open()
+				self.Nrotations += 1
+				partial = ''
+				continue
+
+			last_eof = time.time()
+			yield (None, None)
+			time.sleep(self.poll_interval)
+
+		self.close()
+
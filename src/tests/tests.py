@@ -1,8 +1,55 @@
 # python
+import os
+import random
+import bz2
+import gzip
+import json
+import shutil
+from StringIO import StringIO
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
 
 # project 
 from ..anomaly_detection import AnomalyDetection
+from ..columnar_history import ColumnarPurchaseHistory
+from ..compact_network import CompactSocialNetwork
+from ..component_index import ComponentIndex
+from ..detection_server import DetectionServer, send_events
+from ..event_reader import AUTO_DECODERS, DECODERS, decode_event, get_decoder, read_lines
+from ..flagged_writer import FlaggedWriter
+from ..instrumentation import LatencyHistogram
+from ..memory_report import MemoryReporter, memory_report
+from ..metrics import MetricsExporter
+from ..neighborhood_builder import choose_strategy
+from ..pipeline import Pipeline
+from ..purchase_history import PurchaseHistory
+from ..snapshot import save_snapshot
+from ..social_network import SocialNetwork
+
+#-----------------------------------------------------------------------------------#
+#-----------------------------------------------------------------------------------#
+
+def random_relationships(Nusers, Nrelationships, seed):
+	''' Returns a reproducible list of random befriend events '''
+	generator = random.Random(seed)
+	events = []
+	for i in range(Nrelationships):
+		id1, id2 = generator.sample(range(Nusers), 2)
+		events.append({'id1': str(id1), 'id2': str(id2)})
+	return events
+
+
+def recomputed_network(network):
+	''' Returns the Dth degree network recomputed from scratch 
+		for the relationships of the given network '''
+	recomputed = SocialNetwork(network.D)
+	recomputed.friends = dict((uid, set(friends)) for uid, friends in network.friends.items())
+	recomputed.update_network()
+	# users without relationships have an empty network
+	return dict((uid, levels) for uid, levels in recomputed.network.items() if levels)
 
 #-----------------------------------------------------------------------------------#
 #-----------------------------------------------------------------------------------#
@@ -30,6 +77,11 @@ class TestCases(unittest.TestCase):
 		self.assertEqual(self.session.network.get_number_users(), 5)
 		self.assertEqual(self.session.purchases.get_number_purchases(), 7)
 
+		# loading the batch data again loads it into the new objects
+		self.session.analyze_batch_data()
+		self.assertEqual(self.session.network.get_number_users(), 5)
+		self.assertEqual(self.session.purchases.get_number_purchases(), 7)
+
 
 	def test_Dth_degree_network_generated(self):
 		""" Assert that the 3nd degree network was generated properly"""
@@ -64,6 +116,22 @@ class TestCases(unittest.TestCase):
 		self.assertIn('3', self.session.network.network['6'])
 
 
+	def test_add_friend_matches_recomputed_network(self):
+		''' Assert that the incremental update of the network for new 
+			friends gives the same levels as recomputing the network '''
+		events = random_relationships(60, 120, seed=1)
+		for D in (1, 2, 3, 4):
+			network = SocialNetwork(D)
+			for event in events[:60]:
+				network.add_friend(event)
+			network.update_network()
+
+			for event in events[60:]:
+				network.add_friend(event, update_needed=True)
+				self.assertDictEqual(recomputed_network(network), 
+										dict((uid, levels) for uid, levels in network.network.items() if levels))
+
+
 	def test_remove_friend(self):
 		''' Assert that a friendship is properly removed from the network '''
 		event = {'id1': '4', 'id2': '5'}
@@ -76,6 +144,137 @@ class TestCases(unittest.TestCase):
 		self.assertNotIn('2', self.session.network.network['5'])
 
 
+	def test_remove_friend_matches_recomputed_network(self):
+		''' Assert that the decremental update of the network for removed 
+			friends gives the same levels as recomputing the network '''
+		events = random_relationships(60, 150, seed=2)
+		for D in (1, 2, 3, 4):
+			network = SocialNetwork(D)
+			for event in events:
+				network.add_friend(event)
+			network.update_network()
+
+			for event in events[::3]:
+				network.remove_friend(event, update_needed=True)
+				self.assertDictEqual(recomputed_network(network), 
+										dict((uid, levels) for uid, levels in network.network.items() if levels))
+
+
+	def test_lazy_network_matches_network(self):
+		''' Assert that the lazily computed networks match the 
+			network after friends are added and removed '''
+		events = random_relationships(60, 150, seed=3)
+		# with a large cache, every network stays cached until a 
+		# change of the relationships drops it 
+		for network_class, cache_size in ((SocialNetwork, 20), (SocialNetwork, 1000), 
+											(CompactSocialNetwork, 1000)):
+			network = SocialNetwork(3)
+			lazy = network_class(3, lazy=True, cache_size=cache_size)
+			for event in events[:100]:
+				network.add_friend(event)
+				lazy.add_friend(event)
+			network.update_network()
+			lazy.update_network()
+			self.assertEqual(0, len(lazy.network))
+
+			for i, event in enumerate(events[100:]):
+				if i % 2:
+					network.remove_friend(events[i], update_needed=True)
+					lazy.remove_friend(events[i], update_needed=True)
+				else:
+					network.add_friend(event, update_needed=True)
+					lazy.add_friend(event, update_needed=True)
+
+				for uid in sorted(network.friends):
+					self.assertSetEqual(network.get_user_list(uid), lazy.get_user_list(uid))
+					self.assertSetEqual(network.get_user_list(uid, 2), lazy.get_user_list(uid, 2))
+
+				# the cache is bounded 
+				self.assertLessEqual(len(lazy.network), cache_size)
+
+
+	def test_compact_network_matches_network(self):
+		''' Assert that the compact network with integer ids and CSR 
+			arrays gives the same networks as the dict based network '''
+		events = random_relationships(60, 150, seed=4)
+		network = SocialNetwork(3)
+		compact = CompactSocialNetwork(3)
+		for event in events[:100]:
+			network.add_friend(event)
+			compact.add_friend(event)
+		network.update_network()
+		compact.update_network()
+
+		# the relationships were compacted into the arrays 
+		self.assertEqual(0, compact.friends.Npending)
+		self.assertEqual(network.get_number_users(), compact.get_number_users())
+
+		for i, event in enumerate(events[100:]):
+			if i % 2:
+				network.remove_friend(events[i], update_needed=True)
+				compact.remove_friend(events[i], update_needed=True)
+			else:
+				network.add_friend(event, update_needed=True)
+				compact.add_friend(event, update_needed=True)
+			self.assertEqual(network.are_friends(event['id1'], event['id2']), 
+								compact.are_friends(event['id1'], event['id2']))
+
+			for uid in sorted(network.friends):
+				self.assertSetEqual(network.get_user_list(uid), compact.get_user_list(uid))
+
+		# compacting the overlay does not change the relationships
+		compact.friends.compact()
+		for uid in network.friends:
+			self.assertSetEqual(network.friends[uid], 
+								set(compact.names[i] for i in compact.friends[compact.ids[uid]]))
+
+
+	def test_parallel_network_matches_network(self):
+		''' Assert that computing the network with worker processes 
+			gives the same network as the serial computation '''
+		events = random_relationships(80, 150, seed=5)
+		for network_class in (SocialNetwork, CompactSocialNetwork):
+			serial = network_class(3)
+			parallel = network_class(3, workers=2)
+			for event in events:
+				serial.add_friend(event)
+				parallel.add_friend(event)
+			serial.update_network()
+			parallel.update_network()
+			self.assertDictEqual(serial.network, parallel.network)
+
+
+	def test_network_builders_match_network(self):
+		''' Assert that the networks built from the friends' networks 
+			have the same levels as the searches from every user '''
+		events = random_relationships(80, 150, seed=7)
+		for network_class in (SocialNetwork, CompactSocialNetwork):
+			for D in (1, 2, 3, 4):
+				searched = network_class(D, builder='bfs')
+				for event in events:
+					searched.add_friend(event)
+				searched.update_network()
+				for builder in ('auto', 'bitset', 'matrix'):
+					network = network_class(D, builder=builder)
+					for event in events:
+						network.add_friend(event)
+					network.update_network()
+					self.assertDictEqual(searched.network, network.network)
+
+		# a dense network is built from the friends' networks, 
+		# a sparse one is searched from every user
+		dense = SocialNetwork(3)
+		sparse = SocialNetwork(3)
+		for i in range(2000):
+			sparse.add_friend({'id1': str(i), 'id2': str(i+1)})
+			dense.add_friend({'id1': str(i), 'id2': str(i*7 % 2000)})
+			dense.add_friend({'id1': str(i), 'id2': str(i*13 % 2000)})
+			dense.add_friend({'id1': str(i), 'id2': str(i*31 % 2000)})
+		self.assertEqual(choose_strategy(sparse.friends, 3), 'bfs')
+		self.assertNotEqual(choose_strategy(dense.friends, 3), 'bfs')
+		self.assertRaises(ValueError, SocialNetwork, 3, builder='unknown')
+
+
 	def test_add_purchase(self):
 		''' Assert that a purchase was properly added to the network '''
 		event = {'timestamp': '2017-06-13 11:33:12', 'id': '1', 'amount': '13.24'}
@@ -88,6 +287,75 @@ class TestCases(unittest.TestCase):
 		self.assertTupleEqual(('1','2017-06-13 11:33:12',13.24), self.session.purchases.purchases[7])
 
 
+	def test_last_purchases_merged_from_user_histories(self):
+		''' Assert that the last T purchases of a group of users match 
+			a scan of the full purchase history '''
+		purchases = self.session.purchases
+		users = set(['2', '3', '4'])
+
+		# scan the purchase history from the most recent purchase
+		expected = []
+		for i in range(purchases.get_number_purchases()-1, -1, -1):
+			uid, timestamp, amount = purchases.purchases[i]
+			if uid in users and len(expected) < purchases.T:
+				expected.append(amount)
+
+		self.assertListEqual(expected, purchases.get_last_purchases(users))
+
+		# each user's history is bounded by T 
+		purchases.set_purchase_cutoff(2)
+		self.assertEqual(2, len(purchases.user_purchases['3']))
+		self.assertListEqual([44.20, 14.20], purchases.get_last_purchases(users))
+		purchases.set_purchase_cutoff(5)
+
+
+	def test_purchase_retention(self):
+		''' Assert that bounded retention only keeps the last T purchases 
+			of each user and reports the memory reclaimed '''
+		purchases = PurchaseHistory(2, retention='per_user')
+		for i in range(5):
+			purchases.add_purchase({'timestamp': '2017-06-13 11:33:0%d' % i, 'id': '1', 'amount': '10.00'})
+		purchases.add_purchase({'timestamp': '2017-06-13 11:33:05', 'id': '2', 'amount': '20.00'})
+
+		# only the last 2 purchases of uid 1 are retained 
+		self.assertEqual(6, purchases.get_number_purchases())
+		self.assertEqual(3, purchases.get_number_retained())
+		self.assertListEqual([3, 4, 5], sorted(purchases.purchases))
+		Nevicted, reclaimed = purchases.get_memory_reclaimed()
+		self.assertEqual(3, Nevicted)
+		self.assertGreater(reclaimed, 0)
+
+		# a low-water mark drops everything older 
+		self.assertGreater(purchases.drop_purchases_before(5), 0)
+		self.assertListEqual([5], sorted(purchases.purchases))
+		self.assertNotIn('1', purchases.user_purchases)
+		self.assertListEqual([20.0], purchases.get_last_purchases(set(['1', '2'])))
+
+
+	def test_columnar_purchase_history(self):
+		''' Assert that the columnar purchase history gives the same 
+			purchases and stats as the dict based history '''
+		columnar = ColumnarPurchaseHistory(5, capacity=2)
+		purchases = self.session.purchases
+		for i in range(purchases.get_number_purchases()):
+			uid, timestamp, amount = purchases.purchases[i]
+			columnar.add_purchase({'timestamp': timestamp, 'id': uid, 'amount': amount})
+
+		self.assertEqual(7, columnar.get_number_purchases())
+		self.assertTupleEqual(purchases.purchases[6], columnar.get_purchase(6))
+		for users in (set(['1', '2']), set(['2', '3', '4']), set(['1', '2', '3', '4', '5'])):
+			self.assertListEqual(purchases.get_last_purchases(users),
+									list(columnar.get_last_purchases(users)))
+			self.assertTupleEqual(purchases.get_purchase_stats(users),
+									columnar.get_purchase_stats(users))
+
+		# dropping purchases shifts the columns 
+		self.assertGreater(columnar.drop_purchases_before(5), 0)
+		self.assertEqual(2, columnar.get_number_retained())
+		self.assertTupleEqual(purchases.purchases[5], columnar.get_purchase(5))
+		self.assertListEqual([44.20, 14.20], list(columnar.get_last_purchases(set(['3', '4']))))
+
+
 	def test_transaction_history_ordered_by_timestamp(self):
 		''' Assert that the purchases are ordered by the timestamp '''
 		purchases = self.session.purchases.purchases
@@ -164,7 +432,678 @@ class TestCases(unittest.TestCase):
 		purchase = {'event_type': 'purchase', 'timestamp': '2017-06-13 11:33:13', 'id': '2', 'amount': 2000}
 		is_anomalous = self.session.check_for_anomaly(purchase)
 		self.assertTrue(is_anomalous)
+
+
+	def test_flagged_writer_buffers_lines(self):
+		''' Assert that the flagged purchases are buffered until the 
+			buffer is full or the writer is closed '''
+		fd, filename = tempfile.mkstemp()
+		os.close(fd)
+		try:
+			writer = FlaggedWriter(filename, flush_interval=3600, flush_size=30, fsync='flush')
+			writer.write('{"id": "1"}\n')
+			self.assertEqual('', open(filename).read())
+
+			# the buffer is flushed once it holds flush_size bytes 
+			writer.write('{"id": "2"}\n')
+			writer.write('{"id": "3"}\n')
+			self.assertEqual(3, len(open(filename).readlines()))
+
+			writer.write('{"id": "4"}\n')
+			writer.close()
+			self.assertEqual(4, writer.Nwritten)
+			self.assertEqual(4, len(open(filename).readlines()))
+
+			# a buffered line is written after flush_interval, without
+			# waiting for another line
+			writer = FlaggedWriter(filename, flush_interval=0.05, flush_size=65536)
+			writer.write('{"id": "5"}\n')
+			self.assertEqual(4, len(open(filename).readlines()))
+			time.sleep(0.5)
+			self.assertEqual(5, len(open(filename).readlines()))
+			self.assertEqual(1, writer.Nwritten)
+			writer.close()
+		finally:
+			os.remove(filename)
+
+
+	def test_snapshot_restores_state(self):
+		''' Assert that a snapshot of the batch data restores the 
+			same network and purchase history '''
+		fd, filename = tempfile.mkstemp()
+		os.close(fd)
+		try:
+			# the snapshot is saved once the batch data is loaded
+			session = AnomalyDetection(self.session.batch_file, self.session.stream_file,
+										self.session.flagged_file, snapshot_file=filename)
+			session.analyze_batch_data()
+			restored = AnomalyDetection(filename, self.session.stream_file, self.session.flagged_file)
+			restored.analyze_batch_data()
+
+			self.assertEqual(3, restored.network.D)
+			self.assertEqual(5, restored.purchases.T)
+			self.assertDictEqual(self.session.network.friends, restored.network.friends)
+			self.assertDictEqual(self.session.network.network, restored.network.network)
+			self.assertDictEqual(self.session.purchases.purchases, restored.purchases.purchases)
+			self.assertEqual(7, restored.purchases.get_number_purchases())
+
+			users = restored.network.get_user_list('1')
+			self.assertTupleEqual(self.session.purchases.get_purchase_stats(users),
+									restored.purchases.get_purchase_stats(users))
+
+			# purchases evicted by per_user retention leave gaps, which 
+			# the columnar history cannot store 
+			purchases = PurchaseHistory(2, retention='per_user')
+			for i in range(5):
+				purchases.add_purchase({'timestamp': '2017-06-13 11:33:0%d' % i, 'id': '1', 'amount': '10.00'})
+			purchases.add_purchase({'timestamp': '2017-06-13 11:33:05', 'id': '2', 'amount': '20.00'})
+			save_snapshot(filename, self.session.network, purchases)
+
+			restored = AnomalyDetection(filename, self.session.stream_file, self.session.flagged_file)
+			restored.analyze_batch_data()
+			self.assertListEqual([3, 4, 5], sorted(restored.purchases.purchases))
+			restored = AnomalyDetection(filename, self.session.stream_file, self.session.flagged_file,
+										purchase_backend='columnar')
+			self.assertRaises(ValueError, restored.analyze_batch_data)
+		finally:
+			os.remove(filename)
+
+
+	def test_snapshot_restores_compact_network(self):
+		''' Assert that a snapshot of a dict network restores the same 
+			relationships in a compact network '''
+		events = random_relationships(50, 300, seed=11)
+		session = AnomalyDetection(self.session.batch_file, self.session.stream_file, 
+									self.session.flagged_file, verbose=False)
+		session.initialize_objects({'D': 2, 'T': 5})
+		for event in events:
+			session.network.add_friend(event)
+		session.network.update_network()
+
+		fd, filename = tempfile.mkstemp()
+		os.close(fd)
+		try:
+			session.save_snapshot(filename)
+			restored = AnomalyDetection(filename, self.session.stream_file, self.session.flagged_file, 
+										verbose=False, compact_network=True)
+			restored.analyze_batch_data()
+
+			graph = restored.network.friends
+			for uid in graph:
+				friends = list(graph[uid])
+				self.assertEqual(friends, sorted(friends))
+			for id1 in session.network.friends:
+				for id2 in session.network.friends:
+					self.assertEqual(session.network.are_friends(id1, id2), 
+										restored.network.are_friends(id1, id2))
+				self.assertEqual(session.network.get_user_list(id1), restored.network.get_user_list(id1))
+		finally:
+			os.remove(filename)
+
+
+	def test_follow_stream_with_rotation(self):
+		''' Assert that follow mode processes the lines appended to the 
+			stream file, including after the file is rotated '''
+		directory = tempfile.mkdtemp()
+		try:
+			self.session.stream_file = os.path.join(directory, 'stream_log.json')
+			self.session.flagged_file = os.path.join(directory, 'flagged_purchases.json')
+			open(self.session.stream_file, 'w').close()
+
+			follower = threading.Thread(target=self.session.follow_stream, 
+										kwargs={'poll_interval': 0.01, 'report_interval': 0, 'max_idle': 1.0})
+			follower.start()
+
+			purchase = '{"event_type":"purchase", "timestamp":"2017-06-13 11:33:13", "id": "2", "amount": "%s"}\n'
+			f = open(self.session.stream_file, 'a')
+			f.write(purchase % '20.00')
+			# a partial line is only processed once it is complete
+			f.write(purchase[:40])
+			f.flush()
+			time.sleep(0.1)
+			self.assertEqual(1, self.session.Nstream)
+			f.write(purchase[40:] % '21.00')
+			f.close()
+			time.sleep(0.1)
+			self.assertEqual(2, self.session.Nstream)
+
+			# rotate the file; the new file is followed 
+			os.rename(self.session.stream_file, self.session.stream_file + '.1')
+			f = open(self.session.stream_file, 'w')
+			f.write(purchase % '2000.00')
+			f.close()
+
+			follower.join()
+			self.assertEqual(3, self.session.Nstream)
+			self.assertEqual(1, self.session.follower.Nrotations)
+			self.assertEqual(3, len(self.session.latencies))
+			self.assertEqual(1, len(open(self.session.flagged_file).readlines()))
+		finally:
+			self.session.close()
+			shutil.rmtree(directory)
+
+
+	def test_detection_server(self):
+		''' Assert that events sent to the server by concurrent clients
+			are processed and the flagged purchases are sent back '''
+		directory = tempfile.mkdtemp()
+		self.session.flagged_file = os.path.join(directory, 'flagged_purchases.json')
+		server = DetectionServer(self.session, ('127.0.0.1', 0), queue_size=2)
+		server.start()
+		try:
+			purchase = {'event_type': 'purchase', 'timestamp': '2017-06-13 11:33:13', 'id': '2', 'amount': '20.00'}
+			results = {}
+			def client(n):
+				results[n] = send_events(server.address, [purchase]*20)
+			clients = [threading.Thread(target=client, args=(n,)) for n in range(4)]
+			for thread in clients:
+				thread.start()
+			for thread in clients:
+				thread.join()
+
+			# normal purchases are not flagged 
+			self.assertEqual(80, server.Nevents)
+			self.assertListEqual([[]]*4, [results[n] for n in range(4)])
+
+			anomaly = dict(purchase, amount='2000.00')
+			flagged = send_events(server.address, [purchase, anomaly])
+			self.assertEqual(1, len(flagged))
+			self.assertEqual('2000.00', flagged[0]['amount'])
+
+			# invalid events are answered with an error, and the 
+			# detector keeps processing the events after them
+			replies = send_events(server.address, ['42', '[]', '{"event_type": "purchase"', 
+													'{"event_type": "purchase", "timestamp": "2017-06-13 11:33:13", "id": ["2"], "amount": "1.00"}', 
+													anomaly])
+			self.assertListEqual([{'error': 'invalid event'}]*4, replies[:4])
+			self.assertEqual('2000.00', replies[4]['amount'])
+			self.assertTrue(server.threads[1].is_alive())
+		finally:
+			server.stop()
+			self.session.close()
+			shutil.rmtree(directory)
+		self.assertEqual(0, server.Ndropped)
+
+
+	def test_read_lines_and_decode_events(self):
+		''' Assert that lines read in blocks and decoded with the fast 
+			decoder match readline() and json '''
+		lines = open('src/tests/log_input/batch_log.json').read().splitlines()
+		self.assertListEqual(lines, list(read_lines(StringIO('\n'.join(lines)), block_size=7)))
+
+		for line in lines + ['{"D":3, "T":5}', '{"id": "a\\"b"}', '{}', 
+								'{"event_type":"purchase", "id": "jos\xc3\xa9", "amount": "1.00"}']:
+			expected = json.loads(line)
+			event = decode_event(line)
+			self.assertDictEqual(expected, event)
+			# the same types as json, so an id is the same user either way
+			self.assertEqual(sorted((type(key), type(value)) for key, value in expected.iteritems()), 
+								sorted((type(key), type(value)) for key, value in event.iteritems()))
+
+		# 'auto' is the first installed library of ujson, simplejson, json
+		installed = [name for name in AUTO_DECODERS if name in DECODERS]
+		self.assertEqual('json', installed[-1])
+		self.assertIs(DECODERS[installed[0]], get_decoder('auto'))
+
+
+	def test_parallel_batch_loader(self):
+		''' Assert that parsing the batch data with worker processes 
+			gives the same network and purchase history '''
+		session = AnomalyDetection(self.session.batch_file, self.session.stream_file,
+									self.session.flagged_file, batch_workers=3)
+		session.analyze_batch_data()
+
+		self.assertDictEqual(self.session.network.friends, session.network.friends)
+		self.assertDictEqual(self.session.network.network, session.network.network)
+		self.assertDictEqual(self.session.purchases.purchases, session.purchases.purchases)
+		self.assertEqual(self.session.purchases.T, session.purchases.T)
+
+
+	def test_compressed_logs(self):
+		''' Assert that compressed batch and stream logs give the same 
+			results as the uncompressed logs '''
+		directory = tempfile.mkdtemp()
+		try:
+			batch = open(self.session.batch_file).read()
+			stream = '{"event_type":"purchase", "timestamp":"2017-06-13 11:33:13", "id": "2", "amount": "20.00"}\n' + \
+						'{"event_type":"purchase", "timestamp":"2017-06-13 11:33:14", "id": "2", "amount": "2000.00"}\n'
+			for extension, open_compressed in (('.gz', gzip.open), ('.bz2', bz2.BZ2File)):
+				for threaded_io in (False, True):
+					batch_file = os.path.join(directory, 'batch_log.json' + extension)
+					stream_file = os.path.join(directory, 'stream_log.json' + extension)
+					flagged_file = os.path.join(directory, 'flagged_purchases%s%s.json' %(extension, threaded_io))
+					for filename, data in ((batch_file, batch), (stream_file, stream)):
+						f = open_compressed(filename, 'wb')
+						f.write(data)
+						f.close()
+
+					session = AnomalyDetection(batch_file, stream_file, flagged_file, 
+												threaded_io=threaded_io, block_size=16)
+					session.analyze_batch_data()
+					self.assertDictEqual(self.session.network.network, session.network.network)
+					self.assertDictEqual(self.session.purchases.purchases, session.purchases.purchases)
+
+					session.analyze_stream_data()
+					session.close()
+					self.assertEqual(2, session.Nstream)
+					self.assertEqual(1, len(open(flagged_file).readlines()))
+		finally:
+			shutil.rmtree(directory)
+
+
+	def test_register_handler(self):
+		''' Assert that registered handlers are called for new event types,
+			and that events without a handler are ignored '''
+		session = self.session
+		refunds = []
+		session.register_handler('refund', stream_handler=refunds.append)
+
+		refund = {'event_type': 'refund', 'timestamp': '2017-06-13 11:33:13', 'id': '2'}
+		session.process_event(refund, 'stream')
+		session.process_event(refund, 'batch')
+		self.assertEqual([refund], refunds)
+
+		# unregistered event types are ignored
+		session.register_handler('refund')
+		session.process_event(refund, 'stream')
+		session.process_event({'event_type': 'unknown'}, 'stream')
+		self.assertEqual([refund], refunds)
+		self.assertEqual(0, session.Nstream)
+
+
+	def test_pipeline(self):
+		''' Assert that the pipeline processes the events and writes the 
+			flagged purchases in order, and raises the errors of its stages '''
+		directory = tempfile.mkdtemp()
+		try:
+			stream_file = os.path.join(directory, 'stream_log.json')
+			f = open(stream_file, 'w')
+			generator = random.Random(0)
+			for i in range(500):
+				amount = generator.choice([20, 25, 30, 1000 + i])
+				f.write('{"event_type":"purchase", "timestamp":"2017-06-13 11:33:%02d", "id": "%d", "amount": "%.2f"}\n' \
+							%(i % 60, generator.randrange(1, 6), amount))
+				if i % 50 == 0:
+					f.write('{"event_type":"befriend", "timestamp":"2017-06-13 11:33:%02d", "id1": "%d", "id2": "%d"}\n' \
+								%(i % 60, generator.randrange(1, 6), generator.randrange(1, 6)))
+			f.close()
+
+			flagged = []
+			for pipeline in (False, True):
+				flagged_file = os.path.join(directory, 'flagged_purchases%s.json' % pipeline)
+				session = AnomalyDetection(self.session.batch_file, stream_file, flagged_file,
+											verbose=False, pipeline=pipeline, queue_depth=1,
+											output_queue_depth=1)
+				session.analyze_batch_data()
+				session.analyze_stream_data()
+				session.close()
+				self.assertEqual(510, session.Nstream)
+				flagged.append(open(flagged_file).readlines())
+			self.assertTrue(flagged[0])
+			self.assertListEqual(flagged[0], flagged[1])
+
+			# the events before an invalid line are processed
+			f = open(stream_file, 'a')
+			f.write('not an event\n')
+			f.close()
+			session = self.session
+			session.verbose = False
+			session.flagged_file = os.path.join(directory, 'flagged_purchases.json')
+			with self.assertRaises(ValueError):
+				Pipeline(session, 1, 1, chunk_size=7).run(open(stream_file), 'stream')
+			session.close()
+			self.assertEqual(510, session.Nstream)
+			self.assertListEqual(flagged[0], open(session.flagged_file).readlines())
+		finally:
+			shutil.rmtree(directory)
+
+
+	def test_sharded_detection(self):
+		''' Assert that the sharded detection flags the same purchases as
+			a single process, including when components are joined across
+			shards '''
+		directory = tempfile.mkdtemp()
+		try:
+			generator = random.Random(0)
+			def write_events(filename, Nevents, Nusers, header=''):
+				f = open(filename, 'w')
+				f.write(header)
+				for i in range(Nevents):
+					timestamp = '2017-06-13 11:%02d:%02d' %(i/60 % 60, i % 60)
+					x = generator.random()
+					if x < 0.7:
+						amount = generator.choice([20, 25, 30, 35, 1000])
+						f.write('{"event_type":"purchase", "timestamp":"%s", "id": "%d", "amount": "%.2f"}\n' \
+									%(timestamp, generator.randrange(Nusers), amount))
+					else:
+						event_type = 'befriend' if x < 0.95 else 'unfriend'
+						f.write('{"event_type":"%s", "timestamp":"%s", "id1": "%d", "id2": "%d"}\n' \
+									%(event_type, timestamp, generator.randrange(Nusers), generator.randrange(Nusers)))
+				f.close()
+
+			batch_file = os.path.join(directory, 'batch_log.json')
+			stream_file = os.path.join(directory, 'stream_log.json')
+			write_events(batch_file, 300, 100, '{"D":"2", "T":"10"}\n')
+			write_events(stream_file, 600, 150)
+
+			flagged = []
+			for shards in (1, 3):
+				flagged_file = os.path.join(directory, 'flagged_purchases%d.json' % shards)
+				session = AnomalyDetection(batch_file, stream_file, flagged_file, 
+											verbose=False, shards=shards)
+				session.analyze_batch_data()
+				Nusers = session.get_number_users()
+				Npurchases = session.get_number_purchases()
+				if shards > 1:
+					session.sharded.round_size = 16
+				session.analyze_stream_data()
+				for line in open(stream_file).readlines()[-100:]:
+					session.process_event(json.loads(line), 'stream')
+				if shards > 1:
+					self.assertGreater(session.sharded.Nmoved, 0)
+				session.close()
+				flagged.append((Nusers, Npurchases, session.Nstream, open(flagged_file).readlines()))
+
+			self.assertTrue(flagged[0][-1])
+			self.assertEqual(flagged[0], flagged[1])
+
+			# the shards load a batch log, not a snapshot
+			snapshot_file = os.path.join(directory, 'snapshot.bin')
+			self.session.save_snapshot(snapshot_file)
+			self.assertRaises(ValueError, AnomalyDetection, snapshot_file, stream_file, 
+								flagged_file, shards=3)
+		finally:
+			shutil.rmtree(directory)
 		
 
+
+	def test_component_index(self):
+		''' Assert that the component index joins components, splits them
+			lazily after unfriend events, and skips the purchases of 
+			components with too few purchases '''
+		network = SocialNetwork(2)
+		for id1, id2 in [('1', '2'), ('2', '3'), ('3', '4'), ('5', '6')]:
+			network.add_friend({'id1': id1, 'id2': id2})
+		index = ComponentIndex(network)
+		purchases = PurchaseHistory(5)
+		for uid in ['1', '1', '4', '5']:
+			purchases.add_purchase({'id': uid, 'timestamp': '2017-06-13 11:33:01', 'amount': '10.00'})
+		index.rebuild(purchases)
+
+		self.assertEqual(2, index.get_number_components())
+		self.assertEqual(index.get_component('1'), index.get_component('4'))
+		self.assertFalse(index.has_few_purchases('2'))
+		self.assertTrue(index.has_few_purchases('6'))
+		self.assertTrue(index.has_few_purchases('7'))
+
+		# removing 2-3 leaves 1-2 with 2 purchases and 3-4 with 1 purchase
+		network.remove_friend({'id1': '2', 'id2': '3'})
+		index.remove_relationship('2', '3')
+		self.assertTrue(index.has_few_purchases('1'))
+		self.assertEqual(1, index.Nsplits)
+		self.assertTrue(index.has_few_purchases('4'))
+		self.assertEqual(3, index.get_number_components())
+
+		# joining the components adds up their purchases
+		index.add_purchase('6')
+		self.assertTrue(index.has_few_purchases('6'))
+		network.add_friend({'id1': '4', 'id2': '5'})
+		index.add_relationship('4', '5')
+		self.assertFalse(index.has_few_purchases('6'))
+		index.remove_users(['5', '6'])
+		self.assertTrue(index.has_few_purchases('3'))
+
+
+	def test_component_index_flags_same_purchases(self):
+		''' Assert that skipping purchases with the component index 
+			flags the same purchases as without it '''
+		directory = tempfile.mkdtemp()
+		try:
+			generator = random.Random(1)
+			batch_file = os.path.join(directory, 'batch_log.json')
+			stream_file = os.path.join(directory, 'stream_log.json')
+			for filename, Nevents, header in ((batch_file, 300, '{"D":"2", "T":"10"}\n'), (stream_file, 1000, '')):
+				f = open(filename, 'w')
+				f.write(header)
+				for i in range(Nevents):
+					if generator.random() < 0.6:
+						f.write('{"event_type":"purchase", "timestamp":"2017-06-13 11:33:01", "id": "%d", "amount": "%.2f"}\n' \
+									%(generator.randrange(200), generator.choice([20, 25, 30, 1000])))
+					else:
+						event_type = generator.choice(['befriend', 'befriend', 'unfriend'])
+						id1 = generator.randrange(200)
+						f.write('{"event_type":"%s", "timestamp":"2017-06-13 11:33:01", "id1": "%d", "id2": "%d"}\n' \
+									%(event_type, id1, id1 + generator.randrange(1, 4)))
+				f.close()
+
+			flagged = []
+			for component_index in (False, True):
+				flagged_file = os.path.join(directory, 'flagged_purchases%s.json' % component_index)
+				session = AnomalyDetection(batch_file, stream_file, flagged_file, verbose=False,
+											component_index=component_index)
+				session.analyze_batch_data()
+				session.analyze_stream_data()
+				session.close()
+				flagged.append(open(flagged_file).readlines())
+			self.assertTrue(flagged[0])
+			self.assertListEqual(flagged[0], flagged[1])
+			self.assertGreater(session.components.Nskipped, 0)
+			self.assertGreater(session.components.Nsplits, 0)
+		finally:
+			shutil.rmtree(directory)
+
+
+
+	def test_instrumentation(self):
+		''' Assert that an instrumented session records the stages, 
+			counters and latencies, and flags the same purchases '''
+		histogram = LatencyHistogram()
+		for i in range(1, 101):
+			histogram.add(i/1000.0)
+		self.assertAlmostEqual(50, histogram.get_percentile(50)*1000, delta=6)
+		self.assertAlmostEqual(99, histogram.get_percentile(99)*1000, delta=6)
+		self.assertEqual(0.1, histogram.get_percentile(100))
+
+		directory = tempfile.mkdtemp()
+		try:
+			stream_file = os.path.join(directory, 'stream_log.json')
+			f = open(stream_file, 'w')
+			f.write('{"event_type":"befriend", "timestamp":"2017-06-13 11:33:01", "id1": "2", "id2": "6"}\n')
+			f.write('{"event_type":"purchase", "timestamp":"2017-06-13 11:33:02", "id": "2", "amount": "2000.00"}\n')
+			f.close()
+
+			flagged_file = os.path.join(directory, 'flagged_purchases.json')
+			instrumentation_file = os.path.join(directory, 'instrumentation.json')
+			session = AnomalyDetection(self.session.batch_file, stream_file, flagged_file,
+										verbose=False, instrument=True)
+			session.analyze_batch_data()
+			session.analyze_stream_data()
+			session.close()
+			self.assertEqual(1, len(open(flagged_file).readlines()))
+
+			session.instrumentation.dump(instrumentation_file)
+			report = json.load(open(instrumentation_file))
+			self.assertEqual(2, report['timers']['parse']['calls'] - report['latencies']['batch.purchase']['count'] - \
+									report['latencies']['batch.befriend']['count'] - report['latencies']['batch.unfriend']['count'])
+			self.assertEqual(1, report['latencies']['stream.purchase']['count'])
+			self.assertEqual(1, report['latencies']['stream.befriend']['count'])
+			self.assertEqual(1, report['timers']['get_purchase_stats']['calls'])
+			self.assertGreater(report['counters']['purchases_scanned']['total'], 2)
+			self.assertGreater(report['counters']['bfs_nodes']['total'], 0)
+			self.assertGreater(report['timers']['output']['calls'], 0)
+
+			# the work of the purchase stats is the entries visited, 
+			# not the purchases returned
+			for history in (PurchaseHistory(2), ColumnarPurchaseHistory(2)):
+				for i in range(100):
+					history.add_purchase({'timestamp': '2017-06-13 11:33:01', 'id': str(i % 10), 'amount': '1.00'})
+				self.assertEqual(2, len(history.get_last_purchases([str(i) for i in range(20)])))
+				self.assertGreater(history.Nscanned, 2)
+
+			# users who rarely buy need the rows of the whole history
+			history = ColumnarPurchaseHistory(2)
+			history.add_purchase({'timestamp': '2017-06-13 11:33:01', 'id': 'rare', 'amount': '1.00'})
+			for i in range(99):
+				history.add_purchase({'timestamp': '2017-06-13 11:33:01', 'id': '1', 'amount': '1.00'})
+			self.assertEqual(1, len(history.get_last_purchases(['rare'])))
+			self.assertEqual(100, history.Nscanned)
+
+			# the methods of a session without instrumentation are not wrapped
+			self.assertIsNone(self.session.instrumentation)
+			self.assertNotIn('add_friend', vars(self.session.network))
+		finally:
+			shutil.rmtree(directory)
+
+
+
+	def test_slow_log(self):
+		''' Assert that the slow events are logged with their work '''
+		directory = tempfile.mkdtemp()
+		try:
+			stream_file = os.path.join(directory, 'stream_log.json')
+			f = open(stream_file, 'w')
+			f.write('{"event_type":"unfriend", "timestamp":"2017-06-13 11:33:01", "id1": "4", "id2": "5"}\n')
+			f.write('{"event_type":"befriend", "timestamp":"2017-06-13 11:33:01", "id1": "1", "id2": "5"}\n')
+			f.write('{"event_type":"purchase", "timestamp":"2017-06-13 11:33:02", "id": "2", "amount": "2000.00"}\n')
+			f.close()
+
+			slow_log_file = os.path.join(directory, 'slow_log.json')
+			session = AnomalyDetection(self.session.batch_file, stream_file, 
+										os.path.join(directory, 'flagged_purchases.json'),
+										verbose=False, slow_log_file=slow_log_file, slow_threshold=0)
+			session.analyze_batch_data()
+			Nqueries = session.instrumentation.counters['network_users'][0]
+			session.analyze_stream_data()
+			session.close()
+
+			unfriend, befriend, purchase = [json.loads(line) for line in open(slow_log_file)]
+			# the sizes of the networks are not counted as queries: 
+			# only the purchase queries its network
+			self.assertEqual(Nqueries + 1, session.instrumentation.counters['network_users'][0])
+
+			self.assertEqual('unfriend', unfriend['event']['event_type'])
+			self.assertGreater(unfriend['bfs_searches'], 0)
+			self.assertGreater(unfriend['bfs_nodes'], 0)
+			self.assertGreater(unfriend['pairs_checked'], 0)
+			self.assertEqual(set(['4', '5']), set(unfriend['neighborhoods']))
+			self.assertEqual(0, unfriend['purchases_scanned'])
+
+			# the incremental update of a befriend runs no search
+			self.assertEqual(0, befriend['bfs_searches'])
+			self.assertGreater(befriend['pairs_checked'], 0)
+
+			self.assertEqual('purchase', purchase['event']['event_type'])
+			self.assertEqual(0, purchase['bfs_searches'])
+			self.assertEqual(len(session.network.get_user_list('2')), purchase['neighborhoods']['2'])
+			self.assertGreater(purchase['purchases_scanned'], 2)
+			self.assertGreaterEqual(purchase['latency_ms'], 0)
+
+
+			# in lazy mode, the sizes are read from the cache only
+			open(slow_log_file, 'w').close()
+			session = AnomalyDetection(self.session.batch_file, stream_file, 
+										os.path.join(directory, 'flagged_purchases.json'),
+										verbose=False, lazy_network=True, 
+										slow_log_file=slow_log_file, slow_threshold=0)
+			session.analyze_batch_data()
+			session.analyze_stream_data()
+			session.close()
+
+			unfriend, befriend, purchase = [json.loads(line) for line in open(slow_log_file)]
+			self.assertEqual({'4': None, '5': None}, unfriend['neighborhoods'])
+			self.assertEqual(len(session.network.network['2']), purchase['neighborhoods']['2'])
+			self.assertEqual(['2'], list(session.network.network))
+		finally:
+			shutil.rmtree(directory)
+
+
+
+	def test_metrics_exporter(self):
+		''' Assert that the metrics are written to the textfile and 
+			served over HTTP in the Prometheus text format '''
+		directory = tempfile.mkdtemp()
+		try:
+			stream_file = os.path.join(directory, 'stream_log.json')
+			f = open(stream_file, 'w')
+			f.write('{"event_type":"purchase", "timestamp":"2017-06-13 11:33:02", "id": "2", "amount": "2000.00"}\n')
+			f.close()
+
+			session = AnomalyDetection(self.session.batch_file, stream_file, 
+										os.path.join(directory, 'flagged_purchases.json'),
+										verbose=False, instrument=True)
+			textfile = os.path.join(directory, 'metrics.prom')
+			exporter = MetricsExporter(session, textfile, ('127.0.0.1', 0), interval=60)
+			exporter.start()
+			session.analyze_batch_data()
+			session.analyze_stream_data()
+			exporter.update()
+
+			served = urllib2.urlopen('http://%s:%d/metrics' % exporter.address).read()
+			exporter.stop()
+			session.close()
+
+			text = open(textfile).read()
+			self.assertEqual(served, text)
+			self.assertIn('anomaly_flagged_purchases_total 1\n', text)
+			self.assertIn('anomaly_events_total{data_type="stream",event_type="purchase"} 1\n', text)
+			self.assertIn('anomaly_network_users %d\n' % session.network.get_number_users(), text)
+			self.assertIn('anomaly_event_latency_seconds_count{data_type="stream",event_type="purchase"} 1\n', text)
+			self.assertIn('anomaly_event_latency_seconds_bucket{data_type="stream",event_type="purchase",le="+Inf"} 1\n', text)
+			self.assertFalse(os.path.exists(textfile + '.tmp'))
+		finally:
+			shutil.rmtree(directory)
+
+
+	def test_memory_report(self):
+		''' Assert that the memory report covers the network and purchase 
+			history, and that reports are written after the batch data '''
+		session = self.session
+		report = memory_report(session, Nsamples=10, Ntop=2)
+		self.assertEqual(report['friends']['users'], session.network.get_number_users())
+		self.assertEqual(report['network']['networks'], len(session.network.network))
+		self.assertEqual(report['network']['network_size']['max'], 4)
+		self.assertEqual([user['network_size'] for user in report['network']['top_users']], [4, 4])
+		self.assertEqual(report['purchases']['retained'], session.purchases.get_number_retained())
+		self.assertEqual(report['total_bytes'], report['friends']['bytes'] + 
+							report['network']['bytes'] + report['purchases']['bytes'])
+		self.assertTrue(report['purchases']['bytes'] > 0)
+
+		directory = tempfile.mkdtemp()
+		try:
+			filename = os.path.join(directory, 'memory.json')
+			session = AnomalyDetection(session.batch_file, session.stream_file, 
+										os.path.join(directory, 'flagged_purchases.json'),
+										verbose=False, compact_network=True)
+			reporter = MemoryReporter(session, filename, interval=0)
+			reporter.start()
+			session.analyze_batch_data()
+			reporter.stop()
+			session.close()
+
+			reports = [json.loads(line) for line in open(filename)]
+			self.assertEqual([report['label'] for report in reports], ['batch', 'end'])
+			self.assertEqual(reports[0]['friends']['users'], 5)
+			self.assertEqual(session.loaded_listeners, [])
+
+			# a failed report does not stop the periodic reports
+			labels = []
+			def report(label):
+				labels.append(label)
+				if len(labels) == 1:
+					raise RuntimeError('deque mutated during iteration')
+			reporter = MemoryReporter(session, filename, interval=0.01)
+			reporter.report = report
+			thread = threading.Thread(target=reporter.run)
+			thread.start()
+			t0 = time.time()
+			while len(labels) < 2 and time.time() - t0 < 5:
+				time.sleep(0.01)
+			reporter.stopped.set()
+			thread.join()
+			self.assertTrue(len(labels) >= 2)
+		finally:
+			shutil.rmtree(directory)
+
+
 if __name__ == '__main__':
-	unittest.main()
\ No newline at end of file
+	unittest.main()